@@ -1 +1 @@
-from .parse import PdfParser, ParseResult
\ No newline at end of file
+from .parse import PdfParser, AsyncPdfParser, ParseResult, ParseChunk, ParseMetrics, LayoutAnalyser, VisionDescriber
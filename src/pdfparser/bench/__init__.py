@@ -0,0 +1,3 @@
+from .synthetic import generate_pdf, generate_corpus
+from .standin import StandInConfig, StandInServer
+from .runner import BenchmarkConfig, run_benchmark, compare_results, load_baselines, save_baseline, select_baseline
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+from pathlib import Path
+
+class BenchmarkConfig:
+    """
+    The corpus + pipeline settings for a benchmark run (args or ENV):
+        --documents=<n>             (BENCH_DOCUMENTS), the number of synthetic documents
+        --min-pages=<n>, --max-pages=<n>            the range of pages per document
+        --min-figures=<n>, --max-figures=<n>        the range of figures per page
+        --figure-sizes=small,medium,large           the figure sizes to choose from
+        --seed=<n>                  (BENCH_SEED), the seed for the corpus + stand-in services
+        --workers=thread|async|process, --file-concurrency=<n>      how the documents are parsed (as per parse-all-pdfs)
+        --corpus-dir=<dir>          reuse (or keep) the generated corpus, defaults to a temporary dir
+    """
+    documents:int = None
+    min_pages:int = None
+    max_pages:int = None
+    min_figures:int = None
+    max_figures:int = None
+    figure_sizes:list[str] = None
+    seed:int = None
+    workers:str = None
+    file_concurrency:int = None
+    corpus_dir:Path = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.documents = int(args.get('documents', os.environ.get("BENCH_DOCUMENTS", 20)))
+        self.min_pages = int(args.get('min-pages', os.environ.get("BENCH_MIN_PAGES", 1)))
+        self.max_pages = int(args.get('max-pages', os.environ.get("BENCH_MAX_PAGES", 8)))
+        self.min_figures = int(args.get('min-figures', os.environ.get("BENCH_MIN_FIGURES", 0)))
+        self.max_figures = int(args.get('max-figures', os.environ.get("BENCH_MAX_FIGURES", 3)))
+        self.figure_sizes = str(args.get('figure-sizes', os.environ.get("BENCH_FIGURE_SIZES", "small,medium,large"))).split(",")
+        self.seed = int(args.get('seed', os.environ.get("BENCH_SEED", 0)))
+        self.workers = args.get('workers', os.environ.get("WORKERS", "thread"))
+        self.file_concurrency = int(args.get('file-concurrency', os.environ.get("CONCURRENCY", (os.cpu_count() or 4) if self.workers == "process" else 4)))
+        corpus_dir = args.get('corpus-dir', os.environ.get("BENCH_CORPUS_DIR", None))
+        self.corpus_dir = Path(corpus_dir) if corpus_dir is not None else None
+
+    def to_json(self):
+        return {
+            "documents": self.documents,
+            "min-pages": self.min_pages,
+            "max-pages": self.max_pages,
+            "min-figures": self.min_figures,
+            "max-figures": self.max_figures,
+            "figure-sizes": ",".join(self.figure_sizes),
+            "seed": self.seed,
+            "workers": self.workers,
+            "file-concurrency": self.file_concurrency
+        }
+
+
+def run_benchmark(args:dict[str, str], verbose:bool = True) -> dict:
+    """
+    Generate a synthetic corpus, then parse it with the full pipeline against local stand-ins of the Document Intelligence + Azure OpenAI services.
+    Every other arg (eg. --concurrency, --cache, --use-iterative-image-analyser) is passed through to the parser.
+    :return: The benchmark results (throughput, latencies, peak RSS, and the merged parse metrics).
+    """
+    import tempfile
+    import multiprocessing
+    from pdfparser.bench.synthetic import generate_corpus
+    from pdfparser.bench.standin import StandInConfig, serve, fetch_counters
+    from pdfparser.bin.parse_all_pdfs import parse_files
+
+    config = BenchmarkConfig(args)
+    standin_config = StandInConfig(args)
+
+    with tempfile.TemporaryDirectory(prefix="pdfparser-bench-") as tmp_dir:
+        corpus_dir = config.corpus_dir if config.corpus_dir is not None else Path(tmp_dir) / "corpus"
+        if verbose: print(f"Generating {config.documents} synthetic documents in '{corpus_dir}'...")
+        corpus = generate_corpus(corpus_dir, config.documents, config.min_pages, config.max_pages, config.min_figures, config.max_figures, config.figure_sizes, config.seed)
+
+        ## Run the stand-ins in their own process, so they don't compete with the parser for the GIL
+        context = multiprocessing.get_context("spawn")
+        ready_queue = context.Queue()
+        standin = context.Process(target=serve, args=(standin_config.to_json(), "127.0.0.1", 0, ready_queue), daemon=True)
+        standin.start()
+        try:
+            endpoint = ready_queue.get(timeout=60)
+            parser_args = dict(args)
+            parser_args.update({
+                "analyser": parser_args.get("analyser", "standin"),     ## eg. --analyser=fake to profile the pipeline without the analysis round trips
+                "describer": parser_args.get("describer", "standin"),
+                "standin-endpoint": endpoint,
+                "cache": parser_args.get("cache", "none"),
+                "cache-dir": parser_args.get("cache-dir", str(Path(tmp_dir) / "cache")),
+                "verbose": parser_args.get("verbose", "false"),
+            })
+            output_dir = Path(tmp_dir) / "output"
+            output_dir.mkdir(parents=True, exist_ok=True)
+
+            if verbose: print(f"Parsing with {config.workers} workers (file concurrency {config.file_concurrency}) against the stand-ins at {endpoint}...")
+            start = time.perf_counter()
+            success_count, fail_count, run_metrics = parse_files([file for file, _, _ in corpus], output_dir, parser_args, config.workers, config.file_concurrency)
+            wall_seconds = time.perf_counter() - start
+            peak_rss_mb = _peak_rss_mb()    ## Before the stand-in process is reaped, so it isn't counted as a child
+            standin_counters = fetch_counters(endpoint)
+        finally:
+            standin.terminate()
+            standin.join()
+
+    summary = run_metrics.summary()
+    figures = summary["counters"].get("images_rendered", 0)
+    return {
+        "label": args.get("label", _package_version()),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": _python_version(),
+        "config": config.to_json(),
+        "standin": standin_config.to_json(),
+        "documents": success_count,
+        "documents_failed": fail_count,
+        "pages": sum(pages for _, pages, _ in corpus),
+        "figures": figures,
+        "wall_seconds": wall_seconds,
+        "docs_per_second": success_count / wall_seconds if wall_seconds > 0 else 0.0,
+        "figures_per_second": figures / wall_seconds if wall_seconds > 0 else 0.0,
+        "document_seconds": summary["document_seconds"],
+        "peak_rss_mb": peak_rss_mb,
+        "standin_counters": standin_counters,
+        "metrics": summary
+    }
+
+
+## The results compared against the baseline: (name, path in the results, whether higher is better)
+COMPARED_RESULTS = [
+    ("docs/sec", ("docs_per_second",), True),
+    ("figures/sec", ("figures_per_second",), True),
+    ("p50 document latency", ("document_seconds", "p50"), False),
+    ("p95 document latency", ("document_seconds", "p95"), False),
+    ("peak RSS (MB)", ("peak_rss_mb",), False)
+]
+
+def compare_results(results:dict, baseline:dict, threshold:float = 0.1) -> tuple[list[str], list[str]]:
+    """
+    Compare the results of a benchmark run with a baseline run.
+    :param threshold: The relative change that counts as a regression (eg. 0.1 = 10% worse).
+    :return: A tuple of the comparison lines (one per compared result), and the regressions.
+    """
+    lines = []
+    regressions = []
+    for name, path, higher_is_better in COMPARED_RESULTS:
+        current = _get_path(results, path)
+        previous = _get_path(baseline, path)
+        if current is None or previous is None or previous == 0:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        line = f"{name}: {previous:.3f} -> {current:.3f} ({change * 100:+.1f}%)"
+        lines.append(line)
+        if worse > threshold:
+            regressions.append(line)
+    return lines, regressions
+
+
+def load_baselines(file:Path) -> dict[str, dict]:
+    """
+    Load the baseline results, keyed by label (by default, the package version that produced them).
+    """
+    file = Path(file)
+    if not file.exists():
+        return {}
+    with open(file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(file:Path, results:dict):
+    file = Path(file)
+    baselines = load_baselines(file)
+    baselines[results["label"]] = results
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, indent=4)
+
+
+def select_baseline(baselines:dict[str, dict], label:str = None, exclude_label:str = None) -> dict:
+    """
+    Select the baseline to compare with: the given label, or the most recent baseline (other than the excluded label).
+    """
+    if label is not None:
+        return baselines.get(label, None)
+    candidates = [baseline for key, baseline in baselines.items() if key != exclude_label]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda baseline: baseline.get("timestamp", ""))
+
+
+def _get_path(data:dict, path:tuple[str]):
+    for key in path:
+        if not isinstance(data, dict): return None
+        data = data.get(key, None)
+    return data
+
+
+def _peak_rss_mb() -> float:
+    ## The peak RSS of this process, plus the largest of any (finished) child processes (ie. the process workers)
+    try:
+        import resource
+        import sys
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024     ## ru_maxrss is in bytes on macOS, KB elsewhere
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        return (own + children) / (1024 * 1024)
+    except ImportError:
+        return None     ## Not available on Windows
+
+
+def _package_version() -> str:
+    try:
+        from importlib.metadata import version
+        return version("pdfparser")
+    except Exception:
+        return "dev"
+
+
+def _python_version() -> str:
+    import platform
+    return platform.python_version()
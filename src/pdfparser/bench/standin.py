@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CLASSIFIER_CATEGORIES = [
+    ("table", "standard"), ("table", "matrix"), ("chart", "bar"), ("chart", "line"), ("chart", "pie"),
+    ("picture", "photo"), ("picture", "diagram"), ("text", "paragraph"), ("formula", "equation")
+]
+
+class StandInConfig:
+    """
+    The simulated behaviour of the stand-in services (args or ENV):
+        --docintel-latency=<seconds>        (STANDIN_DOCINTEL_LATENCY), the time to analyse a document
+        --docintel-page-latency=<seconds>   (STANDIN_DOCINTEL_PAGE_LATENCY), the extra time to analyse each page
+        --docintel-429-rate=<0..1>          (STANDIN_DOCINTEL_429_RATE), the fraction of analyze requests that are throttled
+        --llm-latency=<seconds>             (STANDIN_LLM_LATENCY), the mean time of a chat completion
+        --llm-jitter=<seconds>              (STANDIN_LLM_JITTER), the standard deviation of the chat completion time
+        --llm-429-rate=<0..1>               (STANDIN_LLM_429_RATE), the fraction of chat completions that are throttled
+        --retry-after=<seconds>             (STANDIN_RETRY_AFTER), the Retry-After sent with throttled responses
+        --poll-interval=<seconds>           (STANDIN_POLL_INTERVAL), the Retry-After sent while an analysis is running
+        --description-length=<chars>        (STANDIN_DESCRIPTION_LENGTH), the length of the generated image descriptions
+    """
+    docintel_latency:float = None
+    docintel_page_latency:float = None
+    docintel_429_rate:float = None
+    llm_latency:float = None
+    llm_jitter:float = None
+    llm_429_rate:float = None
+    retry_after:float = None
+    poll_interval:float = None
+    description_length:int = None
+    seed:int = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.docintel_latency = float(args.get('docintel-latency', os.environ.get("STANDIN_DOCINTEL_LATENCY", 1.0)))
+        self.docintel_page_latency = float(args.get('docintel-page-latency', os.environ.get("STANDIN_DOCINTEL_PAGE_LATENCY", 0.1)))
+        self.docintel_429_rate = float(args.get('docintel-429-rate', os.environ.get("STANDIN_DOCINTEL_429_RATE", 0.0)))
+        self.llm_latency = float(args.get('llm-latency', os.environ.get("STANDIN_LLM_LATENCY", 0.5)))
+        self.llm_jitter = float(args.get('llm-jitter', os.environ.get("STANDIN_LLM_JITTER", 0.1)))
+        self.llm_429_rate = float(args.get('llm-429-rate', os.environ.get("STANDIN_LLM_429_RATE", 0.0)))
+        self.retry_after = float(args.get('retry-after', os.environ.get("STANDIN_RETRY_AFTER", 0.5)))
+        self.poll_interval = float(args.get('poll-interval', os.environ.get("STANDIN_POLL_INTERVAL", 0.1)))
+        self.description_length = int(args.get('description-length', os.environ.get("STANDIN_DESCRIPTION_LENGTH", 400)))
+        self.seed = int(args.get('seed', os.environ.get("STANDIN_SEED", 0)))
+
+    def to_json(self):
+        return {
+            "docintel-latency": self.docintel_latency,
+            "docintel-page-latency": self.docintel_page_latency,
+            "docintel-429-rate": self.docintel_429_rate,
+            "llm-latency": self.llm_latency,
+            "llm-jitter": self.llm_jitter,
+            "llm-429-rate": self.llm_429_rate,
+            "retry-after": self.retry_after,
+            "poll-interval": self.poll_interval,
+            "description-length": self.description_length,
+            "seed": self.seed
+        }
+
+
+class StandInServer:
+    """
+    A local HTTP server that mimics the Document Intelligence analyze + poll API and the Azure OpenAI chat completions API,
+    so the real clients (and the whole parse pipeline) can be run without calling the services.
+
+    Analyses are built from the native content of the PDF (see `analyse_pdf_layout`), and are only returned once the
+    simulated analysis time has passed. Chat completions return a (random) category for the classifier prompt, and a
+    filler description otherwise (for each figure of a batch request). Both APIs can be configured to throttle a fraction of requests with a 429.
+    Like the provider's prompt caching, a leading (system) message of at least 1024 tokens that was seen before is reported as cached tokens.
+    """
+    config:StandInConfig = None
+    counters:dict[str, int] = None
+    _server:ThreadingHTTPServer = None
+    _thread:threading.Thread = None
+    _analyse_executor:ThreadPoolExecutor = None
+    _analyses:dict[str, tuple[float, Future]] = None
+    _rng:random.Random = None
+    _prefixes:set[int] = None
+    _lock:threading.Lock = None
+
+    def __init__(self, config:StandInConfig = None, host:str = "127.0.0.1", port:int = 0):
+        self.config = config if config is not None else StandInConfig()
+        self.counters = {}
+        self._analyses = {}
+        self._prefixes = set()
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._analyse_executor = ThreadPoolExecutor(max_workers=max(1, os.cpu_count() or 1), thread_name_prefix="standin-analyse")
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'StandInServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name="standin-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._analyse_executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _increment(self, counter:str):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def _should_throttle(self, rate:float) -> bool:
+        with self._lock:
+            return rate > 0 and self._rng.random() < rate
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass    ## Keep the benchmark output clean
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if "/documentModels/" in url.path and url.path.endswith(":analyze"):
+                    standin._begin_analyse(self, url, body)
+                elif url.path.endswith("/chat/completions"):
+                    standin._chat_completion(self, body)
+                else:
+                    standin._send_json(self, 404, { "error": { "code": "NotFound", "message": f"Unknown path '{url.path}'" } })
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if "/analyzeResults/" in url.path:
+                    standin._poll_analyse(self, url)
+                elif url.path == "/standin/counters":
+                    with standin._lock:
+                        counters = dict(standin.counters)
+                    standin._send_json(self, 200, counters)
+                else:
+                    standin._send_json(self, 404, { "error": { "code": "NotFound", "message": f"Unknown path '{url.path}'" } })
+
+        return Handler
+
+    def _send_json(self, handler:BaseHTTPRequestHandler, status:int, body:dict, headers:dict[str, str] = None):
+        data = json.dumps(body).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _send_throttled(self, handler:BaseHTTPRequestHandler, counter:str):
+        self._increment(counter)
+        self._send_json(handler, 429, { "error": { "code": "429", "message": "Rate limit exceeded (stand-in)" } }, {
+            "Retry-After": str(max(1, int(round(self.config.retry_after)))),
+            "retry-after-ms": str(int(self.config.retry_after * 1000))
+        })
+
+    def _begin_analyse(self, handler:BaseHTTPRequestHandler, url, body:bytes):
+        from pdfparser.parse.local_layout import analyse_pdf_layout
+        self._increment("docintel_requests")
+        if self._should_throttle(self.config.docintel_429_rate):
+            return self._send_throttled(handler, "docintel_throttled")
+
+        params = parse_qs(url.query)
+        pages = parse_pages(params.get("pages", [None])[0])
+        api_version = params.get("api-version", ["2024-11-30"])[0]
+        model_id = url.path.split("/documentModels/")[1].split(":")[0]
+        if handler.headers.get("Content-Type", "").startswith("application/json"):
+            import base64
+            body = base64.b64decode(json.loads(body).get("base64Source", ""))
+
+        result_id = f"{time.time_ns():x}{self._rng.randint(0, 2**32):08x}"
+        future = self._analyse_executor.submit(analyse_pdf_layout, body, pages, api_version, model_id)
+        with self._lock:
+            self._analyses[result_id] = (time.time(), future)
+
+        base_path = url.path.split(":analyze")[0]
+        self._send_json(handler, 202, {}, {
+            "Operation-Location": f"{self.endpoint}{base_path}/analyzeResults/{result_id}?api-version={api_version}",
+            "retry-after-ms": str(int(self.config.poll_interval * 1000))
+        })
+
+    def _poll_analyse(self, handler:BaseHTTPRequestHandler, url):
+        self._increment("docintel_polls")
+        result_id = url.path.split("/analyzeResults/")[1]
+        with self._lock:
+            started, future = self._analyses.get(result_id, (None, None))
+        if future is None:
+            return self._send_json(handler, 404, { "error": { "code": "NotFound", "message": f"Unknown analysis '{result_id}'" } })
+
+        created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started))
+        running = { "status": "running", "createdDateTime": created, "lastUpdatedDateTime": created }
+        retry_headers = { "retry-after-ms": str(int(self.config.poll_interval * 1000)) }
+        if not future.done():
+            return self._send_json(handler, 200, running, retry_headers)
+        try:
+            result = future.result()
+        except Exception as e:
+            return self._send_json(handler, 200, { "status": "failed", "createdDateTime": created, "lastUpdatedDateTime": created, "error": { "code": "InvalidContent", "message": str(e) } })
+
+        ## The simulated analysis time scales with the number of pages
+        ready = started + self.config.docintel_latency + self.config.docintel_page_latency * len(result.get("pages", []))
+        if time.time() < ready:
+            return self._send_json(handler, 200, running, retry_headers)
+
+        with self._lock:
+            self._analyses.pop(result_id, None)
+        self._send_json(handler, 200, { "status": "succeeded", "createdDateTime": created, "lastUpdatedDateTime": created, "analyzeResult": result })
+
+    def _chat_completion(self, handler:BaseHTTPRequestHandler, body:bytes):
+        from pdfparser.parse.image_analysis import batch_request_ids
+        self._increment("llm_requests")
+        if self._should_throttle(self.config.llm_429_rate):
+            return self._send_throttled(handler, "llm_throttled")
+
+        request = json.loads(body)
+        messages = request.get("messages", [])
+        system = next((message.get("content", "") for message in messages if message.get("role", None) == "system"), "")
+        if type(system) is not str: system = json.dumps(system)
+
+        ids = batch_request_ids(messages)
+        prefix = json.dumps(messages[0], sort_keys=True) if len(messages) > 0 else ""
+        with self._lock:
+            cached = hash(prefix) in self._prefixes
+            self._prefixes.add(hash(prefix))
+            latency = max(0.0, self._rng.gauss(self.config.llm_latency, self.config.llm_jitter))
+            categories = [self._rng.choice(CLASSIFIER_CATEGORIES) for _ in range(max(1, len(ids)))]
+        time.sleep(latency)
+
+        if "classify" in system.lower():
+            results = [{ "category": category, "sub_category": sub_category } for category, sub_category in categories]
+        else:
+            filler = "This is a stand-in description of the image. "
+            results = [(filler * (self.config.description_length // len(filler) + 1))[:self.config.description_length]] * len(categories)
+        if len(ids) > 0:
+            self._increment("llm_batch_requests")
+            content = json.dumps({ "figures": [{ "id": figure_id, "result": result } for figure_id, result in zip(ids, results)] })
+        else:
+            content = results[0] if type(results[0]) is str else json.dumps(results[0])
+
+        self._send_json(handler, 200, {
+            "id": f"chatcmpl-standin-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "standin"),
+            "choices": [{ "index": 0, "finish_reason": "stop", "message": { "role": "assistant", "content": content } }],
+            "usage": {
+                "prompt_tokens": len(body) // 4, "completion_tokens": len(content) // 4, "total_tokens": (len(body) + len(content)) // 4,
+                "prompt_tokens_details": { "cached_tokens": (len(prefix) // 4) // 128 * 128 if cached and len(prefix) // 4 >= 1024 else 0 }
+            }
+        })
+
+
+def parse_pages(pages:str) -> list[int]:
+    """
+    Parse a Document Intelligence page selection (eg. '1-3,5') into a list of page numbers.
+    """
+    if pages is None or len(pages.strip()) == 0:
+        return None
+    page_numbers = []
+    for part in pages.split(","):
+        if "-" in part:
+            start, end = part.split("-", 1)
+            page_numbers.extend(range(int(start), int(end) + 1))
+        else:
+            page_numbers.append(int(part))
+    return page_numbers
+
+
+def serve(config_json:dict, host:str, port:int, ready_queue):
+    """
+    Run a stand-in server until the process is terminated (used to run the stand-ins in their own process).
+    """
+    server = StandInServer(StandInConfig(config_json), host, port)
+    ready_queue.put(server.endpoint)
+    server._server.serve_forever()
+
+
+def fetch_counters(endpoint:str) -> dict[str, int]:
+    """
+    Fetch the request counters of a (running) stand-in server.
+    """
+    from urllib.request import urlopen
+    with urlopen(f"{endpoint}/standin/counters", timeout=10) as response:
+        return json.loads(response.read())
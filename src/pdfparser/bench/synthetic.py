@@ -0,0 +1,115 @@
+from pathlib import Path
+
+FIGURE_SIZES = {
+    "small": 120,
+    "medium": 200,
+    "large": 320
+}
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+         "Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. "
+         "Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur.")
+
+def generate_pdf(file:Path, pages:int = 3, figures_per_page:int = 2, figure_size:str = "medium", seed:int = 0) -> int:
+    """
+    Generate a synthetic PDF, with a title, a heading + some paragraphs on each page, and a mix of raster (photo like) and vector (chart) figures.
+    :param figure_size: The height of the figures, either 'small', 'medium', 'large' or a size in points.
+    :return: The number of figures in the document (figures that don't fit on a page are left out).
+    """
+    import random
+    from fitz import open as FitzOpen, Rect
+
+    rng = random.Random(seed)
+    height = FIGURE_SIZES[figure_size] if figure_size in FIGURE_SIZES else float(figure_size)
+    document = FitzOpen()
+    figure_count = 0
+    for page_idx in range(pages):
+        page = document.new_page(width=612, height=792)
+        y = 72
+        if page_idx == 0:
+            page.insert_text((72, y + 24), f"Synthetic Document {seed}", fontsize=24)
+            y += 48
+        page.insert_text((72, y + 16), f"Section {page_idx + 1}", fontsize=16)
+        y += 32
+        y = _insert_paragraph(page, y, rng)
+
+        for figure_idx in range(figures_per_page):
+            width = min(468, height * 1.5)
+            if y + height + 40 > 792 - 72: break
+            rect = Rect(72, y, 72 + width, y + height)
+            if (page_idx + figure_idx + seed) % 2 == 0:
+                _insert_raster_figure(page, rect, rng)
+            else:
+                _insert_chart_figure(page, rect, rng)
+            figure_count += 1
+            page.insert_text((72, rect.y1 + 16), f"Figure {figure_count}: A synthetic figure", fontsize=9)
+            y = rect.y1 + 28
+            y = _insert_paragraph(page, y, rng)
+
+    document.save(file, garbage=3, deflate=True)
+    document.close()
+    return figure_count
+
+
+def generate_corpus(dir:Path, documents:int = 10, min_pages:int = 1, max_pages:int = 8, min_figures:int = 0, max_figures:int = 3, figure_sizes:list[str] = None, seed:int = 0) -> list[tuple[Path, int, int]]:
+    """
+    Generate a folder of synthetic PDFs, with a (seeded) random number of pages, figures per page and figure size for each document.
+    :return: A list of (file, pages, figures) tuples.
+    """
+    import random
+    rng = random.Random(seed)
+    if figure_sizes is None: figure_sizes = list(FIGURE_SIZES.keys())
+    dir = Path(dir)
+    dir.mkdir(parents=True, exist_ok=True)
+
+    corpus = []
+    for idx in range(documents):
+        pages = rng.randint(min_pages, max_pages)
+        figures_per_page = rng.randint(min_figures, max_figures)
+        figure_size = rng.choice(figure_sizes)
+        file = dir / f"synthetic_{seed}_{idx:04d}.pdf"
+        figures = generate_pdf(file, pages, figures_per_page, figure_size, seed=seed * 100000 + idx)
+        corpus.append((file, pages, figures))
+    return corpus
+
+
+def _insert_paragraph(page, y:float, rng) -> float:
+    from fitz import Rect
+    sentences = [sentence.strip(".") for sentence in LOREM.split(". ")]
+    text = ". ".join(rng.choice(sentences) for _ in range(rng.randint(2, 4))) + "."
+    rect = Rect(72, y, 540, y + 60)
+    if rect.y1 > 792 - 72:
+        return y
+    page.insert_textbox(rect, text, fontsize=10)
+    return rect.y1 + 8
+
+
+def _insert_raster_figure(page, rect, rng):
+    ## A smooth gradient with some noise, so the image compresses like a photo rather than a flat colour
+    import numpy as np
+    from fitz import Pixmap, csRGB
+    width, height = int(rect.width * 2), int(rect.height * 2)
+    gen = np.random.default_rng(rng.randint(0, 2**31))
+    xs = np.linspace(0, 1, width, dtype=np.float32)
+    ys = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    base = np.stack([xs * 255 + ys * 0, ys * 255 + xs * 0, (1 - xs) * 128 + ys * 127], axis=-1)
+    noise = gen.normal(0, 12, size=(height, width, 3))
+    samples = np.clip(base + noise, 0, 255).astype(np.uint8)
+    pix = Pixmap(csRGB, width, height, samples.tobytes(), 0)
+    page.insert_image(rect, pixmap=pix)
+
+
+def _insert_chart_figure(page, rect, rng):
+    from fitz import Rect, Point
+    ## Axes
+    page.draw_line(Point(rect.x0 + 20, rect.y0 + 5), Point(rect.x0 + 20, rect.y1 - 20), color=(0, 0, 0), width=1)
+    page.draw_line(Point(rect.x0 + 20, rect.y1 - 20), Point(rect.x1 - 5, rect.y1 - 20), color=(0, 0, 0), width=1)
+    ## Bars
+    bars = rng.randint(3, 8)
+    bar_width = (rect.width - 40) / bars
+    for idx in range(bars):
+        bar_height = rng.uniform(0.1, 0.95) * (rect.height - 30)
+        x0 = rect.x0 + 25 + idx * bar_width
+        colour = (rng.random(), rng.random(), rng.random())
+        page.draw_rect(Rect(x0, rect.y1 - 20 - bar_height, x0 + bar_width * 0.7, rect.y1 - 20), color=colour, fill=colour)
+        page.insert_text((x0, rect.y1 - 8), f"Q{idx + 1}", fontsize=7)
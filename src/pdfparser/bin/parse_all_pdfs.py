@@ -1,23 +1,151 @@
+import time
+from pathlib import Path
+from pdfparser import ParseMetrics
+from pdfparser.util.journal import BatchJournal, STATE_QUEUED, STATE_WRITTEN, STATE_FAILED
 
+def parse_file(file:Path, parser, target_dir:Path, args:dict[str, str], journal:BatchJournal = None) -> dict:
+    """
+    Parse the file, and write the markdown to the target dir.
+    :param journal: The journal to record the progress of the file in (optional).
+    :return: The metrics of the parse (as JSON, so it can be sent back from a worker process).
+    """
+    start = time.perf_counter()
+    on_stage = (lambda stage: journal.record(file, stage, seconds=time.perf_counter() - start)) if journal is not None else None
+    try:
+        result = parser.parse(file, analyse_images=args.get("analyse-images", True), use_iterative_image_analyser=args.get("use-iterative-image-analyser", True), verbose=args.get("verbose", True) not in [False, "false", "False", "0"], on_stage=on_stage)
+        with open(target_dir / f"{file.stem}.md", "w", encoding="utf-8") as f:
+            f.write(result.markdown)
+    except Exception as e:
+        if journal is not None: journal.record(file, STATE_FAILED, seconds=time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+        raise
+    if journal is not None: journal.record(file, STATE_WRITTEN, seconds=time.perf_counter() - start)
+    return result.metrics.to_json()
 
-def main(): 
+## Each worker process holds its own parser (and so its own DocIntel + LLM clients) + journal, created once when the process starts
+_process_parser = None
+_process_journal = None
+
+def _init_process(args:dict[str, str], journal_file:Path = None):
+    global _process_parser, _process_journal
     import dotenv
     dotenv.load_dotenv(".env")
+    from pdfparser import PdfParser
+    _process_parser = PdfParser(args)
+    _process_journal = BatchJournal(journal_file) if journal_file is not None else None
 
-    from concurrent.futures import Future, ThreadPoolExecutor
-    from pdfparser.util import parse_args
+def _parse_file_in_process(file:Path, target_dir:Path, args:dict[str, str]) -> dict:
+    return parse_file(file, _process_parser, target_dir, args, _process_journal)
+
+async def parse_files_async(files:list[Path], target_dir:Path, args:dict[str, str], concurrency:int, progress_bar, run_metrics:ParseMetrics, journal:BatchJournal = None) -> tuple[int, int]:
+    import asyncio
+    from pdfparser import AsyncPdfParser
+
+    success_count = 0
+    fail_count = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    async with AsyncPdfParser(args) as parser:
+        async def parse_file_async(file:Path) -> ParseMetrics:
+            async with semaphore:
+                start = time.perf_counter()
+                on_stage = (lambda stage: journal.record(file, stage, seconds=time.perf_counter() - start)) if journal is not None else None
+                try:
+                    result = await parser.parse(file, analyse_images=args.get("analyse-images", True), use_iterative_image_analyser=args.get("use-iterative-image-analyser", True), verbose=args.get("verbose", True) not in [False, "false", "False", "0"], on_stage=on_stage)
+                    await asyncio.to_thread((target_dir / f"{file.stem}.md").write_text, result.markdown, encoding="utf-8")
+                except Exception as e:
+                    if journal is not None: journal.record(file, STATE_FAILED, seconds=time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+                    raise
+                if journal is not None: journal.record(file, STATE_WRITTEN, seconds=time.perf_counter() - start)
+                return result.metrics
+
+        for f in asyncio.as_completed([parse_file_async(file) for file in files]):
+            if progress_bar is not None: progress_bar.update(1)
+            try:
+                run_metrics.merge(await f)
+                success_count += 1
+            except Exception as e:
+                print(f"Error processing file: {e}")
+                fail_count += 1
+    return success_count, fail_count
+
+def parse_files(files:list[Path], target_dir:Path, args:dict[str, str], workers:str = "thread", concurrency:int = 4, progress_bar = None, journal:BatchJournal = None) -> tuple[int, int, ParseMetrics]:
+    """
+    Parse the files using the given kind of workers (thread, async or process), writing the markdown of each file to the target dir.
+    :param journal: The journal to record the progress of each file in (optional).
+    :return: A tuple of the number of files parsed successfully, the number that failed, and the merged metrics of all the files.
+    """
+    from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
     from pdfparser import PdfParser
-    from pathlib import Path
+
+    if workers not in ["thread", "async", "process"]:
+        raise Exception(f"Unknown workers mode '{workers}'. Use one of: thread, async, process")
+    if journal is not None:
+        for file in files:
+            journal.record(file, STATE_QUEUED)
+
+    run_metrics = ParseMetrics()
+    if workers == "async":
+        ## All files are parsed from a single event loop
+        import asyncio
+        success_count, fail_count = asyncio.run(parse_files_async(files, target_dir, args, concurrency, progress_bar, run_metrics, journal))
+        return success_count, fail_count, run_metrics
+
+    success_count = 0
+    fail_count = 0
+    if workers == "process":
+        ## Documents are spread across processes, so rendering + JSON work isn't limited to a single core by the GIL.
+        ## The processes share the same cache dir (the cache backends are safe to use from multiple processes)
+        import multiprocessing
+        executor = ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("spawn"), initializer=_init_process, initargs=(args, journal.file if journal is not None else None))
+    else:
+        parser = PdfParser(args)
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+    with executor:
+        futures = list[Future]()
+        for file in files:
+            if workers == "process":
+                futures.append(executor.submit(_parse_file_in_process, file, target_dir, args))
+            else:
+                futures.append(executor.submit(parse_file, file, parser, target_dir, args, journal))
+
+        for f in futures:
+            try:
+                run_metrics.merge(ParseMetrics.from_json(f.result()))
+                success_count += 1
+            except Exception as e:
+                print(f"Error processing file: {e}")
+                fail_count += 1
+            if progress_bar is not None: progress_bar.update(1)
+    return success_count, fail_count, run_metrics
+
+def write_metrics_summary(metrics_file:Path, run_metrics:ParseMetrics, success_count:int, fail_count:int, workers:str, concurrency:int, wall_seconds:float):
+    import json
+    summary = {
+        "workers": workers,
+        "file_concurrency": concurrency,
+        "files_succeeded": success_count,
+        "files_failed": fail_count,
+        "run_wall_seconds": wall_seconds,
+        "files_per_second": success_count / wall_seconds if wall_seconds > 0 else 0.0,
+        **run_metrics.summary()
+    }
+    with open(metrics_file, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=4)
+
+def main():
+    import dotenv
+    dotenv.load_dotenv(".env")
+
+    from pdfparser.util import parse_args
+    from pdfparser.util.journal import load_journal, is_complete
     from tqdm import tqdm
     import os
 
     args = parse_args()
 
     if args.get("help", False):
-        print("Usage: parse_all_pdfs.py [--dir <dir>] [--output <output>] [--overwrite] [--verbose] [--analyse-images] [--use-iterative-image-analyser]")
+        print("Usage: parse_all_pdfs.py [--dir <dir>] [--output <output>] [--overwrite] [--verbose] [--analyse-images] [--use-iterative-image-analyser] [--workers=thread|async|process] [--file-concurrency <n>] [--metrics-file <file>] [--journal <file>] [--resume]")
         return
 
-    parser = PdfParser(args)
     dir = args.get("dir")
     if dir is None: dir = args.get("0")
     if dir is None: raise Exception("No dir specified. Provide the '--dir' argument (or the first positional argument) to specify the dir to parse.")
@@ -25,46 +153,49 @@ def main():
     dir = Path(dir)
     if not dir.exists(): raise Exception(f"Dir '{dir}' does not exist.")
     if not dir.is_dir(): raise Exception(f"'{dir}' is not a dir.")
-    
+
     output = args.get("output")
     if output is None: output = dir / "output"
+    output = Path(output)
 
     if not output.exists(): output.mkdir(parents=True)
 
-    concurrency = int(args.get("--concurrency", os.getenv('CONCURRENCY', 4)))
-    counter = 0
-    parser = PdfParser(args)
-    with ThreadPoolExecutor(max_workers=concurrency) as executor:
-        futures = list[Future]()
-        for file in dir.iterdir():
-            if file.is_file() and file.suffix.lower() == ".pdf":
-                counter += 1
-                def parse_file(file:Path, parser:PdfParser, target_dir:Path):
-                    result = parser.parse(file, analyse_images=args.get("analyse-images", True), use_iterative_image_analyser=args.get("use-iterative-image-analyser", True))
-                    with open(target_dir / f"{file.stem}.md", "w", encoding="utf-8") as f:
-                        f.write(result.markdown)
-                    return True
-                
-                futures.append(executor.submit(parse_file, file, parser, output))
-            elif file.suffix.lower() == ".identifier":
-                continue
-            else: 
-                print(f"Skipping file: {file.name} - Not a PDF file")
-
-        progress_bar = tqdm(total=len(list(dir.iterdir())), desc="Processing files", unit="file", ncols=100, bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]")
-        executor.shutdown(wait=True)
-
-        success_count = 0
-        fail_count = 0
-        for f in futures:
-            progress_bar.update(1)
-            if f.result() == True: 
-                success_count += 1
-            else: 
-                fail_count += 1
+    files = list[Path]()
+    for file in dir.iterdir():
+        if file.is_file() and file.suffix.lower() == ".pdf":
+            files.append(file)
+        elif file.suffix.lower() == ".identifier":
+            continue
+        else:
+            print(f"Skipping file: {file.name} - Not a PDF file")
+
+    ## The journal records the progress of every file, so a run that dies part way through can be resumed
+    journal_file = args.get("journal", os.getenv('JOURNAL_FILE', output / "parse-journal.jsonl"))
+    journal_file = Path(journal_file) if str(journal_file).lower() not in ["none", "false"] else None
+    if args.get("resume", False) and journal_file is not None:
+        ## Skip the files that were completed by a previous run (and haven't changed since), failed + partially processed files are parsed again,
+        ## picking up their analysis + image descriptions from the cache
+        states = load_journal(journal_file)
+        remaining = [file for file in files if not is_complete(states, file)]
+        print(f"Resuming from '{journal_file}', skipping {len(files) - len(remaining)} completed files.")
+        files = remaining
 
-    print(f"Done, {success_count} files processed successfully, {fail_count} files failed to be processed.")
+    workers = args.get("workers", os.getenv('WORKERS', "thread"))
+    concurrency = int(args.get("file-concurrency", os.getenv('CONCURRENCY', (os.cpu_count() or 4) if workers == "process" else 4)))
+    metrics_file = Path(args.get("metrics-file", os.getenv('METRICS_FILE', output / "parse-metrics.json")))
+    start = time.perf_counter()
+    progress_bar = tqdm(total=len(files), desc="Processing files", unit="file", ncols=100, bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]")
+    journal = BatchJournal(journal_file) if journal_file is not None else None
+    try:
+        success_count, fail_count, run_metrics = parse_files(files, output, args, workers, concurrency, progress_bar, journal)
+    finally:
+        if journal is not None: journal.close()
+    progress_bar.close()
+    write_metrics_summary(metrics_file, run_metrics, success_count, fail_count, workers, concurrency, time.perf_counter() - start)
+    print(f"Done, {success_count} files processed successfully, {fail_count} files failed to be processed. Metrics written to '{metrics_file}'.")
+    if fail_count > 0 and journal is not None:
+        print(f"The errors are recorded in '{journal_file}', run again with --resume to retry the failed files.")
 
 
 if __name__ ==  '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,54 @@
+def main():
+    import json
+    import os
+    from pathlib import Path
+    from pdfparser.util import parse_args
+    from pdfparser.bench import run_benchmark, compare_results, load_baselines, save_baseline, select_baseline
+
+    args = parse_args()
+
+    if args.get("help", False):
+        print("Usage: parse_bench.py [--documents=<n>] [--min-pages=<n>] [--max-pages=<n>] [--min-figures=<n>] [--max-figures=<n>] [--figure-sizes=small,medium,large] [--seed=<n>]")
+        print("                      [--workers=thread|async|process] [--file-concurrency=<n>] [--docintel-latency=<s>] [--docintel-page-latency=<s>] [--docintel-429-rate=<0..1>]")
+        print("                      [--llm-latency=<s>] [--llm-jitter=<s>] [--llm-429-rate=<0..1>] [--output=<results.json>] [--baseline=<baselines.json>] [--compare-to=<label>]")
+        print("                      [--save-baseline] [--label=<label>] [--regression-threshold=<0..1>] [--fail-on-regression]")
+        return
+
+    results = run_benchmark(args)
+
+    print(f"Documents:      {results['documents']} ({results['documents_failed']} failed), {results['pages']} pages, {results['figures']} figures")
+    print(f"Wall time:      {results['wall_seconds']:.2f}s")
+    print(f"Throughput:     {results['docs_per_second']:.3f} docs/sec, {results['figures_per_second']:.3f} figures/sec")
+    print(f"Doc latency:    p50 {results['document_seconds']['p50']:.3f}s, p95 {results['document_seconds']['p95']:.3f}s")
+    if results["peak_rss_mb"] is not None: print(f"Peak RSS:       {results['peak_rss_mb']:.1f} MB")
+    print(f"Stand-ins:      {json.dumps(results['standin_counters'])}")
+
+    output = args.get("output", None)
+    if output is not None:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to '{output}'")
+
+    ## Compare with (and optionally save as) a baseline
+    baseline_file = Path(args.get("baseline", os.environ.get("BENCH_BASELINE", "bench-baselines.json")))
+    baseline = select_baseline(load_baselines(baseline_file), args.get("compare-to", None), results["label"])
+    regressions = []
+    if baseline is not None:
+        threshold = float(args.get("regression-threshold", os.environ.get("BENCH_REGRESSION_THRESHOLD", 0.1)))
+        lines, regressions = compare_results(results, baseline, threshold)
+        print(f"Compared with baseline '{baseline['label']}' ({baseline.get('timestamp', 'unknown')}):")
+        for line in lines:
+            print(f"  {'REGRESSION ' if line in regressions else ''}{line}")
+        if baseline.get("config", None) != results["config"] or baseline.get("standin", None) != results["standin"]:
+            print("  Note: the baseline was run with a different corpus / stand-in configuration")
+
+    if args.get("save-baseline", False):
+        save_baseline(baseline_file, results)
+        print(f"Saved results as baseline '{results['label']}' in '{baseline_file}'")
+
+    if len(regressions) > 0 and args.get("fail-on-regression", False):
+        raise SystemExit(1)
+
+
+if __name__ ==  '__main__':
+    main()
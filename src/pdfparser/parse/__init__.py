@@ -1,2 +1,5 @@
-
-from .parser import PdfParser, ParseResult
\ No newline at end of file
+from .parser import PdfParser, ParseResult, ParseChunk
+from .metrics import ParseMetrics
+from .sections import SectionIndex
+from .async_parser import AsyncPdfParser
+from .backends import LayoutAnalyser, VisionDescriber, FakeLayoutAnalyser, FakeVisionDescriber, HybridLayoutAnalyser, create_layout_analyser, create_vision_describer
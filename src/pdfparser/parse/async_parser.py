@@ -0,0 +1,210 @@
+import asyncio
+from pathlib import Path
+from typing import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from .parser import PdfParser, ParseResult, ParseChunk, STAGE_ANALYSED, STAGE_FIGURES_DONE
+from .batching import AsyncFigureBatcher
+from .pipeline import FigureJob, FigureResult, render_figure, write_figure, record_render_metrics, apply_triage
+from .image_cache import ImageDescriptionCache
+from .docintel import DocIntelAnalysis
+from .metrics import ParseMetrics, record_concurrency_limits, record_llm_pool
+from .backends import LayoutAnalyser, VisionDescriber
+
+class AsyncPdfParser(PdfParser):
+    """
+    An asyncio version of the PdfParser.
+
+    The Document Intelligence + LLM requests are made with the async (aio) clients, so many documents and figures can be in flight
+    from a single event loop, while the CPU bound rendering runs on one dedicated thread (MuPDF is not thread-safe), and file + cache IO
+    runs on a small, fixed pool of threads.
+    """
+    _render_executor:ThreadPoolExecutor = None
+    _io_executor:ThreadPoolExecutor = None
+
+    def __init__(self, args:dict[str, str], analyser:LayoutAnalyser = None, llm:VisionDescriber = None):
+        super().__init__(args, analyser, llm)
+        self._render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async-render")
+        self._io_executor = ThreadPoolExecutor(max_workers=max(1, self.write_concurrency), thread_name_prefix="async-io")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        await self.analyser.close_async()
+        if self.llm is not None:
+            await self.llm.close_async()
+        self._render_executor.shutdown(wait=True)
+        self._io_executor.shutdown(wait=True)
+
+    async def parse(self, file:Path, analyse_images:bool = True, use_iterative_image_analyser:bool = True, verbose:bool = True, on_stage:Callable[[str], None] = None) -> ParseResult:
+        import io
+        import time
+        start = time.perf_counter()
+        output_result = ParseResult()
+        output_result.metrics = ParseMetrics()
+
+        markdown = io.StringIO()
+        async for chunk in self._parse_chunks_async(file, output_result, analyse_images, use_iterative_image_analyser, verbose, on_stage):
+            markdown.write(chunk.markdown)
+        output_result.markdown = markdown.getvalue()
+
+        ## Find the first header in the document
+        if verbose: print("  - Determining Title")
+        output_result.title = self._determine_title(file, output_result.analysis, output_result.markdown)
+        output_result.metrics.wall_seconds = time.perf_counter() - start
+        return output_result
+
+    async def parse_stream(self, file:Path, analyse_images:bool = True, use_iterative_image_analyser:bool = True, verbose:bool = True, on_stage:Callable[[str], None] = None) -> AsyncIterator[ParseChunk]:
+        """
+        Parse the document, yielding the markdown page by page as soon as the figures on each page have been described.
+        :param file: The path to the PDF to parse.
+        :return: An async iterator of ParseChunk, in document order.
+        """
+        async for chunk in self._parse_chunks_async(file, ParseResult(), analyse_images, use_iterative_image_analyser, verbose, on_stage):
+            yield chunk
+
+    async def _parse_chunks_async(self, file:Path, output_result:ParseResult, analyse_images:bool, use_iterative_image_analyser:bool, verbose:bool, on_stage:Callable[[str], None] = None) -> AsyncIterator[ParseChunk]:
+        from fitz import open as FitzOpen
+        loop = asyncio.get_running_loop()
+
+        image_file_prefix = file.stem.replace(' ', '_')
+        image_folder = await loop.run_in_executor(self._io_executor, self._image_folder, file)
+        if output_result.metrics is None: output_result.metrics = ParseMetrics()
+        metrics = output_result.metrics
+
+        ## Step 1: Analyse the document using Azure Document Intelligence
+        analysis = await self._load_analysis_async(file, verbose, metrics)
+        if on_stage is not None: on_stage(STAGE_ANALYSED)
+        markdown = analysis.markdown
+        self._set_analysis(output_result, analysis)
+
+        ## Step 2: Go through each page and parse out the images and markdown
+        if verbose: print("  - Loading PDF")
+        pdf_document = None
+        batcher = None
+        chunk_tasks = []
+        try:
+            with metrics.time("load_pages"):
+                pdf_document = await loop.run_in_executor(self._render_executor, FitzOpen, file)
+                output_result.pages = await loop.run_in_executor(self._render_executor, self._load_pages, analysis, pdf_document)
+            assembler, chunk_figures = self._chunk_assembler(analysis, output_result, metrics)
+
+            ## Every figure gets a task up front, the semaphore bounds how many are rendered + described at once
+            image_cache = await loop.run_in_executor(self._io_executor, self._image_cache, file) if self._describes_images(analyse_images) else None
+            semaphore = asyncio.Semaphore(self.concurrency if self.concurrency > 0 else max(64, self._max_workers()))
+            batcher = self._figure_batcher(AsyncFigureBatcher, analyse_images, use_iterative_image_analyser, metrics)
+            for figures in chunk_figures:
+                tasks = []
+                for idx, figure, figure_replacements in figures:
+                    jobs = self._figure_jobs(idx, figure, output_result, markdown, image_folder, image_file_prefix, analyse_images, image_cache)
+                    tasks.append((figure_replacements, [asyncio.create_task(self._process_figure_async(job, semaphore, image_cache, use_iterative_image_analyser, verbose, metrics, batcher)) for job in jobs]))
+                chunk_tasks.append(tasks)
+
+            if verbose and analysis.figures: print("  - Analysing Images...")
+            for chunk_idx in range(assembler.chunk_count()):
+                ## Wait for the figures in this chunk to be rendered + described
+                for figure_replacements, tasks in chunk_tasks[chunk_idx]:
+                    for task in tasks:
+                        assembler.add(await task, figure_replacements)
+
+                chunk = assembler.chunk(chunk_idx)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            ## Cancel any figures still outstanding (eg. if the consumer stopped iterating early, or a figure failed)
+            outstanding = [task for tasks in chunk_tasks for _, figure_tasks in tasks for task in figure_tasks if not task.done()]
+            for task in outstanding:
+                task.cancel()
+            if len(outstanding) > 0:
+                await asyncio.gather(*outstanding, return_exceptions=True)
+            if batcher is not None: await batcher.close_async()
+            ## Closed on the render thread, so it happens after any render that was already running
+            if pdf_document is not None: await loop.run_in_executor(self._render_executor, pdf_document.close)
+            record_concurrency_limits(metrics)
+            record_llm_pool(metrics, self.llm)
+        if on_stage is not None: on_stage(STAGE_FIGURES_DONE)
+
+    async def _load_analysis_async(self, file:Path, verbose:bool, metrics:ParseMetrics) -> DocIntelAnalysis:
+        loop = asyncio.get_running_loop()
+        analysis, cache, cache_key = await loop.run_in_executor(self._io_executor, self._load_cached_analysis, file, verbose, metrics)
+        if analysis is None:
+            revision = await loop.run_in_executor(self._render_executor, self._plan_revision, file, cache, verbose, metrics)
+            if revision is not None and revision.is_incremental():
+                changed_analysis = None
+                if len(revision.changed) > 0:
+                    if verbose: print(f" - Analysing {len(revision.changed)} changed pages of PDF '{file}'")
+                    metrics.increment("analysis_bytes_uploaded", file.stat().st_size)
+                    with metrics.time("analysis"):
+                        changed_analysis = await self.analyser.analyse_async(file, pages=revision.changed)
+                analysis = await asyncio.to_thread(self._stitch_revision, revision, changed_analysis, metrics)
+            else:
+                if verbose: print(f" - Analysing PDF '{file}'")
+                metrics.increment("analysis_bytes_uploaded", file.stat().st_size)
+                with metrics.time("analysis"):
+                    analysis = await self.analyser.analyse_async(file)
+            await loop.run_in_executor(self._io_executor, self._store_analysis, cache, cache_key, analysis)
+            await loop.run_in_executor(self._io_executor, self._store_revision, cache, file, cache_key, revision)
+
+        if not analysis:
+            raise Exception(f"Error analysing PDF file '{file}'. No analysis result returned.")
+        return analysis
+
+    async def _process_figure_async(self, job:FigureJob, semaphore:asyncio.Semaphore, image_cache:ImageDescriptionCache, use_iterative_image_analyser:bool, verbose:bool, metrics:ParseMetrics, batcher:AsyncFigureBatcher = None) -> FigureResult:
+        loop = asyncio.get_running_loop()
+        result = FigureResult()
+        result.figure_id = job.figure_id
+        result.image_name = job.image_name
+        async with semaphore:
+            try:
+                if verbose: print(f"  - Extracting image: {job.image_name}")
+                await loop.run_in_executor(self._render_executor, self._render_figure, job, metrics)
+                result.image_name = job.image_name     ## The render may have changed the extension
+                result.image_path = job.image_path
+                apply_triage(job, result, metrics)
+            except Exception as e:
+                metrics.increment("render_errors")
+                print(f"Error processing region {job.region_idx} of figure {job.figure_id}: {e}")
+                return result
+
+            stages = []
+            if job.save_image:
+                if verbose: print(f"  - Saving image to '{job.image_path}'")
+                stages.append(loop.run_in_executor(self._io_executor, self._write_figure, job, metrics))
+            if job.describe:
+                stages.append(self._describe_image_async(job, image_cache, use_iterative_image_analyser, verbose, metrics, batcher))
+            outputs = await asyncio.gather(*stages)
+            if job.describe:
+                result.description = outputs[-1]
+            job.image_bytes = None
+        return result
+
+    def _render_figure(self, job:FigureJob, metrics:ParseMetrics):
+        with metrics.time("render"):
+            render_figure(job)
+        record_render_metrics(metrics, job)
+
+    def _write_figure(self, job:FigureJob, metrics:ParseMetrics):
+        with metrics.time("write"):
+            write_figure(job)
+
+    async def _describe_image_async(self, job:FigureJob, image_cache:ImageDescriptionCache, use_iterative_image_analyser:bool, verbose:bool, metrics:ParseMetrics, batcher:AsyncFigureBatcher = None) -> str:
+        from .image_analysis import analyse_image_data_async, analyse_image_data_iteratively_async
+
+        async def analyse():
+            if batcher is not None:
+                return await batcher.describe_async(job)
+            return await self._analyse_image(job, use_iterative_image_analyser, metrics, (analyse_image_data_async, analyse_image_data_iteratively_async))
+
+        try:
+            with metrics.time("describe"):
+                if image_cache is None:
+                    return await analyse()
+                ## If the same image is already being described (by this or another document), waits for that description instead
+                result, cache_hit = await image_cache.get_or_compute_async(job.image_bytes, self._image_variant(use_iterative_image_analyser), analyse, job.phash, self._io_executor)
+            self._record_image_cache(job, cache_hit, verbose, metrics)
+            return result
+        except Exception as e:
+            return self._image_error(e, metrics)
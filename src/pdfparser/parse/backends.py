@@ -0,0 +1,295 @@
+import os
+from pathlib import Path
+from typing import Protocol, runtime_checkable
+from .docintel import DocIntelAnalysis, DocIntelAnalyser
+
+from pdfparser.util import LLMClient
+
+@runtime_checkable
+class LayoutAnalyser(Protocol):
+    """
+    Analyses the layout of a document (text, paragraphs, figures, ...), eg. the DocIntelAnalyser.
+    """
+    def cache_key(self, file:Path) -> str:
+        """
+        A key that identifies the analysis of the document, used to cache the analysis.
+        """
+        ...
+
+    def analyse(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        """
+        :param pages: The (1-based) page numbers to analyse, defaults to all pages.
+        """
+        ...
+
+    async def analyse_async(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        ...
+
+    async def close_async(self):
+        ...
+
+
+@runtime_checkable
+class VisionDescriber(Protocol):
+    """
+    Generates the chat completions used to classify + describe the figures, eg. the LLMClient.
+    """
+    @property
+    def model(self) -> str:
+        ...
+
+    def generate(self, messages:list[dict], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None) -> str:
+        """
+        :param response_format: The format of the response (eg. a JSON schema), only passed when a structured output is wanted.
+        """
+        ...
+
+    async def generate_async(self, messages:list[dict], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None) -> str:
+        ...
+
+    async def close_async(self):
+        ...
+
+
+class FakeLayoutAnalyser:
+    """
+    An in-process layout analyser that returns canned analyses, so the rest of the pipeline can be run (and profiled) without Document Intelligence.
+    The analysis of a document is (in order): the analysis given for the file (by path or name), the '<name>.analysis.json' file
+    in the analysis dir, or a (basic) analysis built from the native content of the PDF (see `local_layout`).
+    """
+    analyses:dict[str, DocIntelAnalysis] = None
+    analysis_dir:Path = None
+    latency:float = None
+
+    def __init__(self, analyses:dict[str, DocIntelAnalysis] = None, analysis_dir:Path = None, latency:float = 0.0):
+        self.analyses = analyses if analyses is not None else {}
+        self.analysis_dir = Path(analysis_dir) if analysis_dir is not None else None
+        self.latency = latency
+
+    def cache_key(self, file:Path) -> str:
+        return _file_hash(file, "fake")
+
+    def analyse(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        import time
+        if self.latency > 0: time.sleep(self.latency)
+        return self._canned_analysis(Path(file), pages)
+
+    async def analyse_async(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        import asyncio
+        if self.latency > 0: await asyncio.sleep(self.latency)
+        return await asyncio.to_thread(self._canned_analysis, Path(file), pages)
+
+    async def close_async(self):
+        pass
+
+    def _canned_analysis(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        ## NB: Canned analyses are returned as is (for every page), only the analysis built from the native content is limited to the pages
+        import json
+        from .local_layout import analyse_pdf_layout_file
+        for key in [str(file), file.name]:
+            if key in self.analyses:
+                return self.analyses[key]
+        if self.analysis_dir is not None:
+            analysis_file = self.analysis_dir / f"{file.stem}.analysis.json"
+            if analysis_file.exists():
+                with open(analysis_file, "r", encoding="utf-8") as f:
+                    return DocIntelAnalysis.from_json(json.load(f))
+        return analyse_pdf_layout_file(file, pages)
+
+
+class HybridLayoutAnalyser:
+    """
+    Analyses the pages of a document that have a usable text layer locally (see `local_layout`), and only sends the pages
+    that need OCR (scanned pages + pages mostly covered by images) to the remote analyser, as page range requests.
+    The local + remote analyses are merged into one analysis, in page order.
+
+    NB: The local analysis is basic, eg. tables on text pages come through as paragraphs rather than tables.
+    """
+    remote:LayoutAnalyser = None
+    remote_concurrency:int = None
+
+    def __init__(self, remote:LayoutAnalyser, remote_concurrency:int = 4):
+        self.remote = remote
+        self.remote_concurrency = remote_concurrency
+
+    def cache_key(self, file:Path) -> str:
+        import hashlib
+        return hashlib.sha256(f"{self.remote.cache_key(file)}|hybrid".encode("utf-8")).hexdigest()
+
+    def route(self, data:bytes, pages:list[int] = None) -> list[tuple[bool, list[int]]]:
+        """
+        Split the pages of the document into runs of consecutive pages that are analysed the same way.
+        :return: A list of (remote, page numbers) tuples, in page order.
+        """
+        from .local_layout import probe_pages, PAGE_TEXT
+        kinds = probe_pages(data)
+        page_numbers = pages if pages is not None else list(range(1, len(kinds) + 1))
+        runs = []
+        for page_number in sorted(page_numbers):
+            remote = kinds[page_number - 1] != PAGE_TEXT
+            if len(runs) > 0 and runs[-1][0] == remote and runs[-1][1][-1] == page_number - 1:
+                runs[-1][1].append(page_number)
+            else:
+                runs.append((remote, [page_number]))
+        return runs
+
+    def analyse(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        from concurrent.futures import ThreadPoolExecutor
+        from .local_layout import analyse_pdf_layout_data
+        with open(file, "rb") as f:
+            data = f.read()
+        runs = self.route(data, pages)
+        if len(runs) == 1 and runs[0][0]:
+            return self.remote.analyse(file, pages=pages)     ## Every page needs the remote analyser
+
+        remote_runs = [run_pages for remote, run_pages in runs if remote]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.remote_concurrency, len(remote_runs))), thread_name_prefix="hybrid-analysis") as executor:
+            remote_futures = [executor.submit(self.remote.analyse, file, pages=run_pages) for run_pages in remote_runs]
+            local_analyses = [analyse_pdf_layout_data(data, run_pages) for remote, run_pages in runs if not remote]
+            remote_analyses = [future.result() for future in remote_futures]
+        return DocIntelAnalysis.merge(self._in_page_order(runs, local_analyses, remote_analyses))
+
+    async def analyse_async(self, file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+        import asyncio
+        from .local_layout import analyse_pdf_layout_data
+        data = await asyncio.to_thread(Path(file).read_bytes)
+        runs = await asyncio.to_thread(self.route, data, pages)
+        if len(runs) == 1 and runs[0][0]:
+            return await self.remote.analyse_async(file, pages=pages)
+
+        semaphore = asyncio.Semaphore(max(1, self.remote_concurrency))
+        async def analyse_remote(run_pages:list[int]) -> DocIntelAnalysis:
+            async with semaphore:
+                return await self.remote.analyse_async(file, pages=run_pages)
+
+        remote_tasks = [asyncio.create_task(analyse_remote(run_pages)) for remote, run_pages in runs if remote]
+        try:
+            local_analyses = await asyncio.to_thread(lambda: [analyse_pdf_layout_data(data, run_pages) for remote, run_pages in runs if not remote])
+            remote_analyses = await asyncio.gather(*remote_tasks)
+        except BaseException:
+            for task in remote_tasks: task.cancel()
+            raise
+        return await asyncio.to_thread(DocIntelAnalysis.merge, self._in_page_order(runs, local_analyses, remote_analyses))
+
+    async def close_async(self):
+        await self.remote.close_async()
+
+    def _in_page_order(self, runs:list[tuple[bool, list[int]]], local_analyses:list[DocIntelAnalysis], remote_analyses:list[DocIntelAnalysis]) -> list[DocIntelAnalysis]:
+        local_iter = iter(local_analyses)
+        remote_iter = iter(remote_analyses)
+        return [next(remote_iter) if remote else next(local_iter) for remote, _ in runs]
+
+
+class FakeVisionDescriber:
+    """
+    An in-process vision describer that returns a canned classification (for the classifier prompt) or description (for every other prompt),
+    for each figure of a batch request.
+    """
+    category:str = None
+    sub_category:str = None
+    description:str = None
+    latency:float = None
+
+    def __init__(self, category:str = "picture", sub_category:str = "photo", description:str = "This is a fake description of the image.", latency:float = 0.0):
+        self.category = category
+        self.sub_category = sub_category
+        self.description = description
+        self.latency = latency
+
+    @property
+    def model(self) -> str:
+        return "fake"
+
+    def generate(self, messages:list[dict], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None) -> str:
+        import time
+        if self.latency > 0: time.sleep(self.latency)
+        return self._canned_response(messages)
+
+    async def generate_async(self, messages:list[dict], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None) -> str:
+        import asyncio
+        if self.latency > 0: await asyncio.sleep(self.latency)
+        return self._canned_response(messages)
+
+    async def close_async(self):
+        pass
+
+    def _canned_response(self, messages:list[dict]) -> str:
+        import json
+        from .image_analysis import batch_request_ids
+        system = next((message.get("content", "") for message in messages if message.get("role", None) == "system"), "")
+        if type(system) is str and "classify" in system.lower():
+            result = { "category": self.category, "sub_category": self.sub_category }
+        else:
+            result = self.description
+        ids = batch_request_ids(messages)
+        if len(ids) > 0:
+            return json.dumps({ "figures": [{ "id": figure_id, "result": result } for figure_id in ids] })
+        return result if type(result) is str else json.dumps(result)
+
+
+def create_layout_analyser(args:dict[str, str]) -> LayoutAnalyser:
+    """
+    Create the layout analyser configured by the args (or ENV):
+        --analyser=azure|fake|standin|hybrid    (ANALYSER)
+        --hybrid-remote=azure|fake|standin  (HYBRID_REMOTE), the analyser for the pages the hybrid analyser can't analyse locally
+        --hybrid-concurrency=<n>            (HYBRID_CONCURRENCY), the max remote requests per document for the hybrid analyser
+        --fake-analysis-dir=<dir>           (FAKE_ANALYSIS_DIR), the canned analyses for the fake analyser
+        --fake-analysis-latency=<seconds>   (FAKE_ANALYSIS_LATENCY), the simulated latency of the fake analyser
+        --standin-endpoint=<url>            (STANDIN_ENDPOINT), the local stand-in service (see `pdfparser.bench.standin`)
+    """
+    analyser = str(args.get('analyser', os.environ.get("ANALYSER", "azure"))).lower()
+    if analyser == "hybrid":
+        remote_args = dict(args)
+        remote_args['analyser'] = args.get('hybrid-remote', os.environ.get("HYBRID_REMOTE", "azure"))
+        if remote_args['analyser'] == "hybrid": raise Exception("The hybrid analyser can't use itself as the remote analyser")
+        return HybridLayoutAnalyser(create_layout_analyser(remote_args), int(args.get('hybrid-concurrency', os.environ.get("HYBRID_CONCURRENCY", 4))))
+    elif analyser in ["azure", "docintel"]:
+        return DocIntelAnalyser(args)
+    elif analyser == "fake":
+        return FakeLayoutAnalyser(
+            analysis_dir=args.get('fake-analysis-dir', os.environ.get("FAKE_ANALYSIS_DIR", None)),
+            latency=float(args.get('fake-analysis-latency', os.environ.get("FAKE_ANALYSIS_LATENCY", 0.0))))
+    elif analyser == "standin":
+        return DocIntelAnalyser(_standin_args(args, { 'docintel-endpoint': _standin_endpoint(args), 'docintel-key': "standin" }))
+    else:
+        raise Exception(f"Unknown layout analyser '{analyser}'. Use one of: azure, fake, standin, hybrid")
+
+
+def create_vision_describer(args:dict[str, str]) -> VisionDescriber:
+    """
+    Create the vision describer configured by the args (or ENV):
+        --describer=azure|fake|standin      (DESCRIBER)
+        --fake-llm-latency=<seconds>        (FAKE_LLM_LATENCY), the simulated latency of the fake describer
+        --standin-endpoint=<url>            (STANDIN_ENDPOINT), the local stand-in service (see `pdfparser.bench.standin`)
+    """
+    describer = str(args.get('describer', os.environ.get("DESCRIBER", "azure"))).lower()
+    if describer in ["azure", "openai"]:
+        return LLMClient(args)
+    elif describer == "fake":
+        return FakeVisionDescriber(latency=float(args.get('fake-llm-latency', os.environ.get("FAKE_LLM_LATENCY", 0.0))))
+    elif describer == "standin":
+        return LLMClient(_standin_args(args, { 'llm-endpoint': _standin_endpoint(args), 'llm-api-key': "standin", 'llm-model': args.get('llm-model', "standin") }))
+    else:
+        raise Exception(f"Unknown vision describer '{describer}'. Use one of: azure, fake, standin")
+
+
+def _standin_endpoint(args:dict[str, str]) -> str:
+    endpoint = args.get('standin-endpoint', os.environ.get("STANDIN_ENDPOINT", None))
+    if endpoint is None: raise Exception("Stand-in endpoint not specified. Provide either the '--standin-endpoint' argument or specify the 'STANDIN_ENDPOINT' environment variable")
+    return endpoint
+
+
+def _standin_args(args:dict[str, str], overrides:dict[str, str]) -> dict[str, str]:
+    standin_args = dict(args)
+    standin_args.update(overrides)
+    return standin_args
+
+
+def _file_hash(file:Path, variant:str) -> str:
+    import hashlib
+    hasher = hashlib.sha256()
+    with open(file, "rb") as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b""):
+            hasher.update(block)
+    hasher.update(f"|{variant}".encode("utf-8"))
+    return hasher.hexdigest()
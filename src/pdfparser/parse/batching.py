@@ -0,0 +1,240 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import Future
+from .pipeline import FigureJob
+from .metrics import ParseMetrics
+from .routing import ModelRouting
+
+class BatchConfig:
+    """
+    How figures are batched into multi-image LLM requests (args or ENV):
+        --llm-batch-size=<n>            (LLM_BATCH_SIZE), the maximum number of figures in one request (default: 1, ie. no batching)
+        --llm-batch-max-bytes=<bytes>   (LLM_BATCH_MAX_BYTES), the maximum size of the (base64) images in one request (default: 8388608)
+        --llm-batch-linger=<seconds>    (LLM_BATCH_LINGER), how long to wait for more figures before sending a partial batch (default: 0.05)
+
+    Only figures from the same page are batched together, so they share their context.
+    """
+    batch_size:int = None
+    max_bytes:int = None
+    linger:float = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.batch_size = max(1, int(args.get('llm-batch-size', os.environ.get("LLM_BATCH_SIZE", 1))))
+        self.max_bytes = int(args.get('llm-batch-max-bytes', os.environ.get("LLM_BATCH_MAX_BYTES", 8 * 1024 * 1024)))
+        self.linger = float(args.get('llm-batch-linger', os.environ.get("LLM_BATCH_LINGER", 0.05)))
+
+    def is_enabled(self) -> bool:
+        return self.batch_size > 1
+
+
+class _BatchQueue:
+    ## The figures waiting to be batched, NB: not thread-safe
+    config:BatchConfig = None
+    pending:list[tuple[FigureJob, object]] = None
+    group:int = None
+    bytes:int = 0
+
+    def __init__(self, config:BatchConfig):
+        self.config = config
+        self.pending = []
+
+    def add(self, job:FigureJob, future) -> list[list[tuple[FigureJob, object]]]:
+        """
+        Add a figure to the queue.
+        :return: The batches that are ready to be sent.
+        """
+        ready = []
+        size = _payload_bytes(job)
+        if len(self.pending) > 0 and (job.page_number != self.group or self.bytes + size > self.config.max_bytes):
+            ready.append(self.take())
+        self.pending.append((job, future))
+        self.group = job.page_number
+        self.bytes += size
+        if len(self.pending) >= self.config.batch_size:
+            ready.append(self.take())
+        return ready
+
+    def take(self) -> list[tuple[FigureJob, object]]:
+        batch = self.pending
+        self.pending = []
+        self.group = None
+        self.bytes = 0
+        return batch
+
+
+class _Batcher:
+    ## The state + logic shared by `FigureBatcher` and `AsyncFigureBatcher`, which only differ in how they wait + send requests
+    config:BatchConfig = None
+    _llm = None
+    _iterative:bool = None
+    _metrics:ParseMetrics = None
+    _routing:ModelRouting = None
+    _queue:_BatchQueue = None
+    _timer = None
+
+    def __init__(self, config:BatchConfig, llm, iterative:bool, metrics:ParseMetrics = None, routing:ModelRouting = None):
+        self.config = config
+        self._llm = llm
+        self._iterative = iterative
+        self._metrics = metrics
+        self._routing = routing
+        self._queue = _BatchQueue(config)
+
+    def _add(self, job:FigureJob, future) -> list[list[tuple[FigureJob, object]]]:
+        ## Queue a figure, (re)setting the linger timer of the partial batch
+        ## :return: The batches that are ready to be sent
+        ready = self._queue.add(job, future)
+        if len(self._queue.pending) == 0:
+            self._cancel_timer()
+        elif self._timer is None:
+            self._timer = self._start_timer()
+        return ready
+
+    def _take(self) -> list[tuple[FigureJob, object]]:
+        self._cancel_timer()
+        return self._queue.take()
+
+    def _start_timer(self):
+        raise NotImplementedError()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _analyse(self, batch:list[tuple[FigureJob, object]], analysers:tuple):
+        ## :param analysers: The (plain, iterative) batch analysis functions
+        ## :return: The images of the batch, and the result of analysing them (a coroutine, for the async analysers)
+        images = _batch_images(batch)
+        analyse = analysers[1] if self._iterative else analysers[0]
+        return images, analyse(images, self._llm, metrics=self._metrics, routing=self._routing)
+
+    def _resolve(self, batch:list[tuple[FigureJob, object]], images:list, results:dict[str, str]):
+        for image, (_, future) in zip(images, batch):
+            if not future.done(): future.set_result(results.get(image.id, None))
+
+    def _fail(self, batch:list[tuple[FigureJob, object]], error:BaseException):
+        for _, future in batch:
+            if not future.done():
+                if isinstance(error, asyncio.CancelledError): future.cancel()
+                else: future.set_exception(error)
+
+
+class FigureBatcher(_Batcher):
+    """
+    Describes figures in batches: figures from the same page are collected (up to the batch size + payload limit, or until no
+    more figures arrive within the linger time) and described with one LLM request, rather than one request per figure.
+    `describe` blocks until the figure's batch has been described, so it is meant to be called from the describe workers.
+    """
+    _lock:threading.Lock = None
+
+    def __init__(self, config:BatchConfig, llm, iterative:bool, metrics:ParseMetrics = None, routing:ModelRouting = None):
+        super().__init__(config, llm, iterative, metrics, routing)
+        self._lock = threading.Lock()
+
+    def describe(self, job:FigureJob) -> str:
+        future = Future()
+        with self._lock:
+            ready = self._add(job, future)
+        for batch in ready:
+            self._run(batch)
+        return future.result()
+
+    def flush(self):
+        """
+        Send the figures that are waiting for a batch.
+        """
+        with self._lock:
+            batch = self._take()
+        if len(batch) > 0:
+            self._run(batch)
+
+    def close(self):
+        self.flush()
+
+    def _start_timer(self) -> threading.Timer:
+        timer = threading.Timer(self.config.linger, self.flush)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _run(self, batch:list[tuple[FigureJob, Future]]):
+        from .image_analysis import analyse_image_batch, analyse_image_batch_iteratively
+        try:
+            images, results = self._analyse(batch, (analyse_image_batch, analyse_image_batch_iteratively))
+            self._resolve(batch, images, results)
+        except Exception as e:
+            self._fail(batch, e)
+
+
+class AsyncFigureBatcher(_Batcher):
+    """
+    The asyncio version of `FigureBatcher`, for use from a single event loop.
+    """
+    _tasks:set[asyncio.Task] = None
+
+    def __init__(self, config:BatchConfig, llm, iterative:bool, metrics:ParseMetrics = None, routing:ModelRouting = None):
+        super().__init__(config, llm, iterative, metrics, routing)
+        self._tasks = set()
+
+    async def describe_async(self, job:FigureJob) -> str:
+        future = asyncio.get_running_loop().create_future()
+        for batch in self._add(job, future):
+            self._start(batch)
+        return await future
+
+    def flush(self):
+        """
+        Send the figures that are waiting for a batch.
+        """
+        batch = self._take()
+        if len(batch) > 0:
+            self._start(batch)
+
+    async def close_async(self):
+        self.flush()
+        if len(self._tasks) > 0:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start_timer(self) -> asyncio.TimerHandle:
+        return asyncio.get_running_loop().call_later(self.config.linger, self.flush)
+
+    def _start(self, batch:list[tuple[FigureJob, asyncio.Future]]):
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch:list[tuple[FigureJob, asyncio.Future]]):
+        from .image_analysis import analyse_image_batch_async, analyse_image_batch_iteratively_async
+        try:
+            images, results = self._analyse(batch, (analyse_image_batch_async, analyse_image_batch_iteratively_async))
+            self._resolve(batch, images, await results)
+        except BaseException as e:
+            self._fail(batch, e)
+            if isinstance(e, asyncio.CancelledError): raise
+
+
+def _payload_bytes(job:FigureJob) -> int:
+    ## The size of the figure in the request: the base64 encoded image, plus its context
+    size = (len(job.image_bytes) + 2) // 3 * 4 if job.image_bytes is not None else 0
+    for text in [job.section_name, job.prior_context, job.post_context]:
+        if text is not None: size += len(text)
+    return size
+
+
+def _batch_images(batch:list[tuple[FigureJob, object]]) -> list:
+    from .image_analysis import BatchImage
+    images = []
+    for idx, (job, _) in enumerate(batch):
+        image = BatchImage()
+        image.id = str(idx + 1)
+        image.data = job.image_bytes
+        image.img_ext = job.image_format
+        image.section_name = job.section_name
+        image.prior_context = job.prior_context
+        image.post_context = job.post_context
+        image.category = job.category
+        images.append(image)
+    return images
@@ -0,0 +1,161 @@
+import os
+import re
+from pdfparser.util import markdown as MarkdownUtils
+from .sections import SectionIndex
+
+## Used to estimate the tokens of a text when there is no tokenizer
+CHARS_PER_TOKEN = 4
+
+class TokenCounter:
+    """
+    Counts (+ trims text to) tokens with a local tiktoken encoding, or estimates them from the length of the text if
+    tiktoken isn't installed (pip install "pdfparser[tokens]").
+    """
+    encoding_name:str = None
+    _encoding = None
+
+    def __init__(self, encoding_name:str = "o200k_base"):
+        self.encoding_name = encoding_name
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding_name)
+        except ImportError:
+            self._encoding = None
+        except Exception as e:
+            print(f"Unable to load the '{encoding_name}' tokenizer, estimating tokens from the length of the text instead: {e}")
+            self._encoding = None
+
+    def is_exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text:str) -> int:
+        if text is None or len(text) == 0:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    def head(self, text:str, tokens:int) -> str:
+        """
+        The start of the text, up to the given number of tokens (cut at a word boundary).
+        """
+        if self.count(text) <= tokens:
+            return text
+        if self._encoding is not None:
+            cut = self._encoding.decode(self._encoding.encode(text, disallowed_special=())[:tokens])
+        else:
+            cut = text[:tokens * CHARS_PER_TOKEN]
+        space = cut.rfind(" ")
+        return (cut[:space] if space > len(cut) // 2 else cut).rstrip()
+
+    def tail(self, text:str, tokens:int) -> str:
+        """
+        The end of the text, up to the given number of tokens (cut at a word boundary).
+        """
+        if self.count(text) <= tokens:
+            return text
+        if tokens <= 0:
+            return ""
+        if self._encoding is not None:
+            cut = self._encoding.decode(self._encoding.encode(text, disallowed_special=())[-tokens:])
+        else:
+            cut = text[-tokens * CHARS_PER_TOKEN:]
+        space = cut.find(" ")
+        return (cut[space + 1:] if -1 < space < len(cut) // 2 else cut).lstrip()
+
+
+class FigureContext:
+    section_name:str = None
+    prior_context:str = None
+    post_context:str = None
+    tokens:int = 0              # The tokens of the section name + prior + post context
+    truncated:bool = False      # Whether a paragraph had to be cut to fit the budget
+
+
+class ContextBuilder:
+    """
+    Builds the section name + the text before and after a figure that are sent (with the detail step) to the LLM, within a
+    budget of tokens for each part. Whole paragraphs (as found by the layout analysis) are added, nearest first, until
+    the next one would go over the budget, a paragraph that is too long on its own is cut at a word boundary.
+    Configured with (args or ENV):
+        --context-section-tokens=<n>    (CONTEXT_SECTION_TOKENS), the tokens of the section name (default: 32)
+        --context-prior-tokens=<n>      (CONTEXT_PRIOR_TOKENS), the tokens of the text before the figure (default: 256)
+        --context-post-tokens=<n>       (CONTEXT_POST_TOKENS), the tokens of the text after the figure (default: 128)
+        --context-tokenizer=<encoding>  (CONTEXT_TOKENIZER), the tiktoken encoding to count tokens with (default: o200k_base, the encoding of gpt-4o)
+
+    A budget of 0 leaves that part out. Without tiktoken, tokens are estimated as ~4 characters each.
+    """
+    section_tokens:int = None
+    prior_tokens:int = None
+    post_tokens:int = None
+    counter:TokenCounter = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.section_tokens = int(args.get('context-section-tokens', os.environ.get("CONTEXT_SECTION_TOKENS", 32)))
+        self.prior_tokens = int(args.get('context-prior-tokens', os.environ.get("CONTEXT_PRIOR_TOKENS", 256)))
+        self.post_tokens = int(args.get('context-post-tokens', os.environ.get("CONTEXT_POST_TOKENS", 128)))
+        self.counter = TokenCounter(args.get('context-tokenizer', os.environ.get("CONTEXT_TOKENIZER", "o200k_base")))
+
+    def build(self, markdown:str, offset:int, end:int, sections:SectionIndex = None) -> FigureContext:
+        """
+        Build the context of a figure.
+        :param offset: The offset of the figure in the markdown.
+        :param end: The offset of the end of the figure in the markdown.
+        :param sections: The section index of the document (without one, the markdown is scanned for the section, and the context is cut at newlines).
+        """
+        context = FigureContext()
+        if self.section_tokens > 0:
+            section_name = sections.section_name(offset) if sections is not None else MarkdownUtils.determine_section_name_at_offset(markdown, offset)
+            context.section_name = self.counter.tail(section_name, self.section_tokens)
+        if self.prior_tokens > 0:
+            context.prior_context = self._prior(markdown, offset, sections, context)
+        if self.post_tokens > 0:
+            context.post_context = self._post(markdown, end, sections, context)
+        context.tokens = sum(self.counter.count(part) for part in [context.section_name, context.prior_context, context.post_context])
+        return context
+
+    def _prior(self, markdown:str, offset:int, sections:SectionIndex, context:FigureContext) -> str:
+        if sections is None or not sections.has_paragraphs():
+            return self._fit(_clean(MarkdownUtils.find_prior_context(markdown, offset)), self.prior_tokens, False, context)
+        ## Walk back over the paragraphs before the figure, adding the text from each paragraph's start while it fits
+        cut = offset
+        tokens = 0
+        for start, _ in sections.paragraphs_before(offset):
+            segment_tokens = self.counter.count(_clean(markdown[start:cut]))
+            if tokens + segment_tokens > self.prior_tokens:
+                if cut == offset:
+                    return self._fit(_clean(markdown[start:offset]), self.prior_tokens, False, context)
+                break
+            tokens += segment_tokens
+            cut = start
+        return _clean(markdown[cut:offset])
+
+    def _post(self, markdown:str, end:int, sections:SectionIndex, context:FigureContext) -> str:
+        if sections is None or not sections.has_paragraphs():
+            return self._fit(_clean(MarkdownUtils.find_post_context(markdown, end)), self.post_tokens, True, context)
+        ## Walk forward over the paragraphs after the figure, adding the text up to each paragraph's end while it fits
+        cut = end
+        tokens = 0
+        for _, paragraph_end in sections.paragraphs_after(end):
+            segment_tokens = self.counter.count(_clean(markdown[cut:paragraph_end]))
+            if tokens + segment_tokens > self.post_tokens:
+                if cut == end:
+                    return self._fit(_clean(markdown[end:paragraph_end]), self.post_tokens, True, context)
+                break
+            tokens += segment_tokens
+            cut = paragraph_end
+        return _clean(markdown[end:cut])
+
+    def _fit(self, text:str, budget:int, keep_start:bool, context:FigureContext) -> str:
+        ## Cut the text to the budget, keeping the part nearest the figure
+        if self.counter.count(text) <= budget:
+            return text
+        context.truncated = True
+        return self.counter.head(text, budget) if keep_start else self.counter.tail(text, budget)
+
+
+def _clean(text:str) -> str:
+    ## Drop the markdown comments (eg. page breaks, page headers + footers) and runs of blank lines
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.S)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
@@ -1,8 +1,11 @@
 from pathlib import Path
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeResult, DocumentContentFormat, DocumentAnalysisFeature
 import azure.ai.documentintelligence.models as models
+from pdfparser.util.ratelimit import RateLimiter, get_rate_limiter, is_throttled, retry_after_seconds, retry_delay
+from pdfparser.util.concurrency import AdaptiveConcurrency, create_concurrency_controller, concurrency_slot, concurrency_slot_async
 
 class DocIntelAnalysisSpan:
     offset:int = None
@@ -153,6 +156,7 @@ class DocIntelAnalysisPage:
     lines:list[DocIntelAnalysisLine] = None
     barcodes:list[DocIntelBarcode] = None
     formulas:list[DocIntelAnalysisFormula] = None
+    spans:list[DocIntelAnalysisSpan] = None
 
     def from_result_page(page:models.DocumentPage):
         dpage = DocIntelAnalysisPage()
@@ -165,6 +169,7 @@ class DocIntelAnalysisPage:
         dpage.lines = [DocIntelAnalysisLine.from_result_line(line) for line in page.lines] if page.lines is not None else []
         dpage.barcodes = [DocIntelBarcode.from_result_barcode(barcode) for barcode in page.barcodes] if page.barcodes is not None else []
         dpage.formulas = [DocIntelAnalysisFormula.from_result_formula(formula) for formula in page.formulas] if page.formulas is not None else []
+        dpage.spans = [DocIntelAnalysisSpan.from_result_span(span) for span in page.spans] if page.spans is not None else []
         return dpage
     def to_json(self):
         return {
@@ -176,7 +181,8 @@ class DocIntelAnalysisPage:
             "words": [word.to_json() for word in self.words],
             "lines": [line.to_json() for line in self.lines],
             "barcodes": [barcode.to_json() for barcode in self.barcodes],
-            "formulas": [formula.to_json() for formula in self.formulas]
+            "formulas": [formula.to_json() for formula in self.formulas],
+            "spans": [span.to_json() for span in self.spans]
         }
     def from_json(json:dict):
         dpage = DocIntelAnalysisPage()
@@ -189,6 +195,7 @@ class DocIntelAnalysisPage:
         dpage.lines = [DocIntelAnalysisLine.from_json(line) for line in json.get("lines", [])]
         dpage.barcodes = [DocIntelBarcode.from_json(barcode) for barcode in json.get("barcodes", [])]
         dpage.formulas = [DocIntelAnalysisFormula.from_json(formula) for formula in json.get("formulas", [])]
+        dpage.spans = [DocIntelAnalysisSpan.from_json(span) for span in json.get("spans", [])]
         return dpage
 
 class DocIntelAnalysisBoundingRegion:
@@ -662,13 +669,183 @@ class DocIntelAnalysis:
         analysis.documents = [DocIntelAnalysisDocument.from_json(document) for document in json.get("documents", [])]
         analysis.warnings = [DocIntelAnalysisWarning.from_json(warning) for warning in json.get("warnings", [])]
         return analysis
+
+    def page_ranges(self) -> list[tuple[int, int, int]]:
+        """
+        Split the markdown into contiguous ranges, one per page.
+        :return: A list of (page_number, start, end) tuples, in markdown order, that together cover the whole markdown string.
+        """
+        starts = []
+        for page in self.pages:
+            ## Prefer the page span, fallback to the first word on the page
+            start = None
+            if page.spans is not None and len(page.spans) > 0:
+                start = page.spans[0].offset
+            elif page.words is not None and len(page.words) > 0:
+                start = min(word.span.offset for word in page.words)
+            if start is None: continue
+            if len(starts) > 0 and start <= starts[-1][1]: continue   ## Out of order pages are merged into the previous page
+            starts.append((page.page_number, start))
+
+        markdown_length = len(self.markdown) if self.markdown is not None else 0
+        if len(starts) == 0:
+            return [(1, 0, markdown_length)]
+
+        ranges = []
+        for idx, (page_number, start) in enumerate(starts):
+            if idx == 0: start = 0
+            end = starts[idx+1][1] if idx + 1 < len(starts) else markdown_length
+            ranges.append((page_number, start, end))
+        return ranges
+
+    def merge(analyses:list['DocIntelAnalysis']) -> 'DocIntelAnalysis':
+        """
+        Merge the analyses of different pages of the same document (eg. pages analysed locally + pages analysed by Document Intelligence) into one analysis.
+        The markdown of each analysis is appended in order (separated by a page break), with the spans shifted + the element references (eg. '/paragraphs/3') renumbered to match.
+        :param analyses: The analyses to merge, in page order.
+        """
+        import re
+        element_ref = re.compile(r"^/(paragraphs|tables|figures|sections)/(\d+)")
+
+        merged = { "markdown": "" }
+        for analysis in analyses:
+            if len(merged["markdown"]) > 0 and analysis.markdown is not None and len(analysis.markdown) > 0:
+                merged["markdown"] += PAGE_BREAK
+            shift = len(merged["markdown"])
+            ## The number of each kind of element already merged, to renumber the element references of this analysis
+            bases = { key: len(merged.get(key, [])) for key in ["paragraphs", "tables", "figures", "sections"] }
+
+            def remap(value):
+                if type(value) is dict:
+                    if set(value.keys()) == {"offset", "length"} and value["offset"] is not None:
+                        return { "offset": value["offset"] + shift, "length": value["length"] }
+                    return { key: remap(item) for key, item in value.items() }
+                elif type(value) is list:
+                    return [remap(item) for item in value]
+                elif type(value) is str:
+                    return element_ref.sub(lambda m: f"/{m.group(1)}/{int(m.group(2)) + bases[m.group(1)]}", value)
+                return value
+
+            json = analysis.to_json()
+            merged["markdown"] += json.pop("markdown") or ""
+            for key, items in json.items():
+                merged.setdefault(key, []).extend(remap(items))
+        return DocIntelAnalysis.from_json(merged)
+
+    def renumber_pages(self, page_numbers:list[int]|dict[int, int]) -> 'DocIntelAnalysis':
+        """
+        Renumber the pages of an analysis, eg. of some pages extracted from a document, back to their page numbers in the document.
+        :param page_numbers: The page number in the document of each (1-based) page of the analysed extract, or a dict of old -> new page numbers.
+        :return: A copy of the analysis, with the pages + bounding regions renumbered.
+        """
+        if type(page_numbers) is not dict:
+            page_numbers = { idx + 1: page_number for idx, page_number in enumerate(page_numbers) }
+
+        def remap(value):
+            if type(value) is dict:
+                return { key: (page_numbers.get(item, item) if key == "page_number" and type(item) is int else remap(item)) for key, item in value.items() }
+            elif type(value) is list:
+                return [remap(item) for item in value]
+            return value
+        return DocIntelAnalysis.from_json(remap(self.to_json()))
+
+    def split_pages(self, page_numbers:list[int]) -> list['DocIntelAnalysis']:
+        """
+        Split out the analysis of each of the given pages, with the markdown of the page, and the words, paragraphs, figures, etc. on the page.
+        The spans are rebased onto the markdown of the page, and references to elements that aren't on the page are dropped.
+        Pages that aren't in the analysis (or that have no markdown) are skipped, so check the page numbers of the result.
+        :return: The analysis of each page, in the order of the page numbers.
+        """
+        import re
+        element_ref = re.compile(r"^/(paragraphs|tables|figures|sections)/(\d+)")
+        ranges = { page_number: (start, end) for page_number, start, end in self.page_ranges() } if len(self.pages) > 0 else {}
+        json = self.to_json()
+        markdown = json.pop("markdown") or ""
+        json.pop("warnings", None)
+
+        def spans_of(value) -> list[dict]:
+            if type(value) is dict:
+                if set(value.keys()) == {"offset", "length"}: return [value]
+                return [span for item in value.values() for span in spans_of(item)]
+            elif type(value) is list:
+                return [span for item in value for span in spans_of(item)]
+            return []
+
+        results = []
+        for page_number in page_numbers:
+            if page_number not in ranges: continue
+            start, end = ranges[page_number]
+            if markdown[start:end].endswith(PAGE_BREAK): end -= len(PAGE_BREAK)
+            length = end - start
+
+            ## Keep the page itself + every element with a span on the page, and work out the new index of each kept element
+            kept = {}
+            indexes = {}
+            for key, items in json.items():
+                kept[key] = []
+                indexes[key] = {}
+                for idx, item in enumerate(items):
+                    if key == "pages":
+                        keep = item.get("page_number", None) == page_number
+                    else:
+                        keep = any(span["offset"] is not None and start <= span["offset"] < end for span in spans_of(item))
+                    if keep:
+                        indexes[key][idx] = len(kept[key])
+                        kept[key].append(item)
+
+            def remap(value, in_list:bool = False):
+                if type(value) is dict:
+                    if set(value.keys()) == {"offset", "length"} and value["offset"] is not None:
+                        offset = value["offset"] - start
+                        if (offset < 0 or offset >= length) and in_list: return None     ## A span that's not on this page
+                        offset = min(max(offset, 0), length)
+                        return { "offset": offset, "length": max(0, min(value["length"], length - offset)) }
+                    return { key: remap(item) for key, item in value.items() }
+                elif type(value) is list:
+                    return [item for item in (remap(item, True) for item in value) if item is not None]
+                elif type(value) is str:
+                    match = element_ref.match(value)
+                    if match is not None:
+                        idx = indexes.get(match.group(1), {}).get(int(match.group(2)), None)
+                        if idx is None: return None
+                        return f"/{match.group(1)}/{idx}" + value[match.end():]
+                return value
+
+            page_json = { key: [remap(item) for item in items] for key, items in kept.items() }
+            page_json["markdown"] = markdown[start:end]
+            results.append(DocIntelAnalysis.from_json(page_json))
+        return results
         
 
+## The separator DocIntel puts between the markdown of each page
+PAGE_BREAK = "\n<!-- PageBreak -->\n"
+
+def format_pages(pages:list[int]) -> str:
+    """
+    Format (1-based) page numbers as a Document Intelligence page selection, eg. [1, 2, 3, 5] -> '1-3,5'.
+    """
+    ranges = []
+    for page in sorted(set(pages)):
+        if len(ranges) > 0 and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ",".join(f"{start}-{end}" if start != end else f"{start}" for start, end in ranges)
+
+
 class DocIntelAnalyser:
     _endpoint:str = None    
     _key:str = None
     _api_version:str = None
+    window_pages:int = None         # Split documents with more pages than this into windows analysed in parallel (0 = never split)
+    window_concurrency:int = None   # The max number of windows of a document being analysed at once
+    max_retries:int = None          # The number of times a throttled analysis is retried
     client:DocumentIntelligenceClient = None
+    async_client:AsyncDocumentIntelligenceClient = None
+    _rate_limiter:RateLimiter = None
+    _concurrency:AdaptiveConcurrency = None
+    model_id:str = "prebuilt-layout"
+    features:list[DocumentAnalysisFeature] = [ DocumentAnalysisFeature.FORMULAS, DocumentAnalysisFeature.STYLE_FONT, DocumentAnalysisFeature.OCR_HIGH_RESOLUTION ]
 
     def __init__(self, args:dict[str, str]):
         import os
@@ -679,22 +856,164 @@ class DocIntelAnalyser:
         if self._key is None: raise Exception("Document Intelligence key not specified. Provide either the '--docintel-key' argument or specify the 'DOCINTEL_KEY' environment variable")
 
         self._api_version = args.get('docintel-api-version', os.environ.get("DOCINTEL_API_VERSION", os.environ.get("AZURE_FORM_RECOGNIZER_API_VERSION", "2024-07-31-preview")))
+        self.window_pages = int(args.get('docintel-window-pages', os.environ.get("DOCINTEL_WINDOW_PAGES", 0)))
+        self.window_concurrency = int(args.get('docintel-window-concurrency', os.environ.get("DOCINTEL_WINDOW_CONCURRENCY", 4)))
+        self.max_retries = int(args.get('docintel-max-retries', os.environ.get("DOCINTEL_MAX_RETRIES", 3)))
+
+        ## Every analyser of the same endpoint (in this process) shares one rate limiter
+        self._rate_limiter = get_rate_limiter(f"docintel:{self._endpoint}", float(args.get('docintel-rpm', os.environ.get("DOCINTEL_RPM", 0))))
+        self._concurrency = create_concurrency_controller(f"docintel:{self._endpoint}", args, 'docintel-max-concurrency', "DOCINTEL_MAX_CONCURRENCY", 16)
 
         self.client = DocumentIntelligenceClient(endpoint=self._endpoint, credential=AzureKeyCredential(self._key), api_version=self._api_version)
 
-    def analyse(self, file:Path, features:list[DocumentAnalysisFeature] = [ DocumentAnalysisFeature.FORMULAS, DocumentAnalysisFeature.STYLE_FONT, DocumentAnalysisFeature.OCR_HIGH_RESOLUTION ] ) -> DocIntelAnalysis:
+    def cache_key(self, file:Path, features:list[DocumentAnalysisFeature] = None) -> str:
+        """
+        A key that identifies the analysis of the document: the SHA-256 of the file content, plus the model + features used to analyse it.
+        """
+        import hashlib
+        if features is None: features = self.features
+        hasher = hashlib.sha256()
+        with open(file, "rb") as fd:
+            for block in iter(lambda: fd.read(1024 * 1024), b""):
+                hasher.update(block)
+        hasher.update(f"|{self.model_id}|{self._api_version}|{','.join(sorted(str(f) for f in features))}".encode("utf-8"))
+        return hasher.hexdigest()
+
+    def analyse(self, file:Path, features:list[DocumentAnalysisFeature] = None, pages:list[int] = None) -> DocIntelAnalysis:
         """
         Analyze a document using Azure Document Intelligence.
+        If the document has more than `window_pages` pages, it is split into windows of pages that are analysed in parallel, then merged.
         :param file: The path to the document to analyze.
+        :param pages: The (1-based) page numbers to analyse, defaults to all pages.
         :return: The analysis result.
         """
-        with open(file, "rb") as fd:
-            poller = self.client.begin_analyze_document(
-                "prebuilt-layout",
-                fd,  # File stream
-                output_content_format=DocumentContentFormat.MARKDOWN,
-                features=features,
-                content_type="application/octet-stream"
-            )
-            analysis_result = poller.result()
-            return DocIntelAnalysis.from_result(analysis_result)
+        from concurrent.futures import ThreadPoolExecutor
+        if features is None: features = self.features
+        windows = self._windows(file, pages)
+        if windows is None:
+            with open(file, "rb") as fd:
+                return self._analyse_stream(fd, features, pages)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.window_concurrency), thread_name_prefix="docintel-window") as executor:
+            futures = [executor.submit(self._analyse_window, data, window, features) for window, data in windows]
+            return DocIntelAnalysis.merge([future.result() for future in futures])
+
+    async def analyse_async(self, file:Path, features:list[DocumentAnalysisFeature] = None, pages:list[int] = None) -> DocIntelAnalysis:
+        """
+        Analyze a document using Azure Document Intelligence, without blocking the event loop while the analysis is polled.
+        If the document has more than `window_pages` pages, it is split into windows of pages that are analysed concurrently, then merged.
+        :param file: The path to the document to analyze.
+        :param pages: The (1-based) page numbers to analyse, defaults to all pages.
+        :return: The analysis result.
+        """
+        import asyncio
+        if features is None: features = self.features
+        windows = await asyncio.to_thread(self._windows, file, pages)
+        if windows is None:
+            data = await asyncio.to_thread(Path(file).read_bytes)
+            return await self._analyse_data_async(data, features, pages)
+
+        semaphore = asyncio.Semaphore(max(1, self.window_concurrency))
+        async def analyse_window(window:list[int], data:bytes) -> DocIntelAnalysis:
+            async with semaphore:
+                analysis = await self._analyse_data_async(data, features)
+                return await asyncio.to_thread(analysis.renumber_pages, window)
+
+        tasks = [asyncio.create_task(analyse_window(window, data)) for window, data in windows]
+        try:
+            analyses = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks: task.cancel()
+            raise
+        return await asyncio.to_thread(DocIntelAnalysis.merge, analyses)
+
+    def _windows(self, file:Path, pages:list[int] = None) -> list[tuple[list[int], bytes]]:
+        ## Split the (selected) pages into windows, each extracted into its own PDF so only the pages in the window are uploaded
+        ## :return: A list of (page numbers, PDF content) tuples, or None if the document doesn't need to be split
+        if self.window_pages <= 0:
+            return None
+        from fitz import open as FitzOpen
+        document = FitzOpen(file)
+        try:
+            page_numbers = sorted(set(pages)) if pages is not None else list(range(1, document.page_count + 1))
+            if len(page_numbers) <= self.window_pages:
+                return None
+            windows = []
+            for idx in range(0, len(page_numbers), self.window_pages):
+                window = page_numbers[idx:idx + self.window_pages]
+                extract = FitzOpen()
+                try:
+                    for page_number in window:
+                        extract.insert_pdf(document, from_page=page_number - 1, to_page=page_number - 1)
+                    windows.append((window, extract.tobytes(garbage=1)))
+                finally:
+                    extract.close()
+            return windows
+        finally:
+            document.close()
+
+    def _analyse_window(self, data:bytes, window:list[int], features:list[DocumentAnalysisFeature]) -> DocIntelAnalysis:
+        import io
+        return self._analyse_stream(io.BytesIO(data), features).renumber_pages(window)
+
+    def _analyse_stream(self, stream, features:list[DocumentAnalysisFeature], pages:list[int] = None) -> DocIntelAnalysis:
+        import time
+        attempt = 0
+        while True:
+            self._rate_limiter.acquire()
+            try:
+                ## The time an analysis takes depends on the document, so only failures adapt the concurrency
+                with concurrency_slot(self._concurrency, measure_latency=False):
+                    poller = self.client.begin_analyze_document(
+                        self.model_id,
+                        stream,
+                        output_content_format=DocumentContentFormat.MARKDOWN,
+                        features=features,
+                        pages=format_pages(pages) if pages is not None else None,
+                        content_type="application/octet-stream"
+                    )
+                    analysis_result = poller.result()
+                return DocIntelAnalysis.from_result(analysis_result)
+            except Exception as e:
+                if not self._on_error(e, attempt): raise
+                time.sleep(retry_delay(e, attempt))
+                stream.seek(0)
+                attempt += 1
+
+    async def _analyse_data_async(self, data:bytes, features:list[DocumentAnalysisFeature], pages:list[int] = None) -> DocIntelAnalysis:
+        import io
+        import asyncio
+        if self.async_client is None:
+            self.async_client = AsyncDocumentIntelligenceClient(endpoint=self._endpoint, credential=AzureKeyCredential(self._key), api_version=self._api_version)
+
+        attempt = 0
+        while True:
+            await self._rate_limiter.acquire_async()
+            try:
+                async with concurrency_slot_async(self._concurrency, measure_latency=False):
+                    poller = await self.async_client.begin_analyze_document(
+                        self.model_id,
+                        io.BytesIO(data),
+                        output_content_format=DocumentContentFormat.MARKDOWN,
+                        features=features,
+                        pages=format_pages(pages) if pages is not None else None,
+                        content_type="application/octet-stream"
+                    )
+                    analysis_result = await poller.result()
+                return await asyncio.to_thread(DocIntelAnalysis.from_result, analysis_result)
+            except Exception as e:
+                if not self._on_error(e, attempt): raise
+                await asyncio.sleep(retry_delay(e, attempt))
+                attempt += 1
+
+    def _on_error(self, error:Exception, attempt:int) -> bool:
+        ## :return: Whether to retry the analysis (only throttled analyses are retried, the SDK retries other transient errors itself)
+        if not is_throttled(error):
+            return False
+        self._rate_limiter.on_throttled(retry_after_seconds(error))
+        return attempt < self.max_retries
+
+    async def close_async(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
@@ -2,6 +2,18 @@ import base64
 import time
 import json
 from pdfparser.util import LLMClient
+from pdfparser.util.ratelimit import is_throttled, retry_delay
+from .metrics import ParseMetrics
+from .routing import ModelRouting, STEP_CLASSIFIER, STEP_DETAIL, STEP_BATCH
+
+## The number of times a throttled (429) request is retried, after waiting for as long as the service asks
+MAX_THROTTLED_RETRIES = 8
+
+## The number of times the classifier step is asked again when its output can't be parsed (or isn't a known category)
+MAX_PARSE_RETRIES = 1
+
+## Outputs that start with these are the model declining (or unable) to analyse the image
+REFUSAL_PREFIXES = ("i'm sorry", "i am sorry", "sorry,", "i can't", "i cannot", "i'm unable", "i am unable", "unable to")
 
 
 ITERATIVE_ANALYSIS_CLASSIFIER_STEP = """Look at the provided image and classify it into a category + sub-category as described below:
@@ -672,138 +684,793 @@ Below, between [START POST CONTEXT] and [END POST CONTEXT], is a paragraph or tw
 The information in the prior and post context may be helpful for determining both the context of the image and also the meaning of the content within.
 """
 
-def analyse_image_data(data:bytes|str, img_ext:str, llm:LLMClient, analysis_msg:str = None, max_retries:int = 3, section_name:str = None, prior_context:str = None, post_context:str = None) -> str:
+## The rules of the default analysis message (the static instructions), and the context of each figure, which is sent after them
+DEFAULT_ANALYSIS_RULES = DEFAULT_ANALYSIS_MESSAGE[:DEFAULT_ANALYSIS_MESSAGE.index("For your reference")]
+ANALYSIS_CONTEXT_TEMPLATE = DEFAULT_ANALYSIS_MESSAGE[DEFAULT_ANALYSIS_MESSAGE.index("For your reference"):]
+
+def _system_message(instructions:str) -> dict:
+    return {
+        "role": "system",
+        "type": "text",
+        "content": instructions
+    }
+
+
+def prompt_prefix_hash(messages:list[dict]) -> str:
+    """
+    A short hash of the leading (system) message of a request, ie. the static instructions that every request with the same
+    prompt starts with. Requests with the same hash can reuse the provider's cached prompt prefix.
+    """
+    import hashlib
+    return hashlib.sha256(json.dumps(messages[0], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def build_analysis_messages(data:bytes|str, img_ext:str, analysis_msg:str = None, section_name:str = None, prior_context:str = None, post_context:str = None, with_context:bool = True) -> list[dict]:
+    """
+    Build the messages to analyse an image: the (static) instructions first, so they are a stable prefix the provider can
+    cache across figures, then the section + context of the figure and the image.
+    :param analysis_msg: The instructions, defaults to the rules of the default analysis message.
+    :param with_context: Whether to send the section + context (the classifier step never needs them, see `_sends_context`).
+    """
     ## Base64 the image content (if it's bytes)
     base64_data = base64.b64encode(data).decode('utf-8') if type(data) is not str else data  # Assume already base64 if the image data is str
-    msg = analysis_msg
-    if analysis_msg is None:
-        msg = DEFAULT_ANALYSIS_MESSAGE.format(
-                    section_name=section_name if section_name is not None else "Unknown", 
-                    prior_context=prior_context if prior_context is not None else "No prior context", 
-                    post_context=post_context if post_context is not None else "No post context")
-
-    messages = [
-        {
-            "role": "system",
+    content = []
+    if with_context:
+        content.append({
             "type": "text",
-            "content": msg
-        },
+            "text": ANALYSIS_CONTEXT_TEMPLATE.format(
+                section_name=section_name if section_name is not None else "Unknown", 
+                prior_context=prior_context if prior_context is not None else "No prior context", 
+                post_context=post_context if post_context is not None else "No post context")
+        })
+    content.append({
+        "type": "image_url",
+        "image_url": {
+            "url": f'data:image/{img_ext};base64,{base64_data}',
+            "detail": "high"
+        }
+    })
+
+    return [
+        _system_message(analysis_msg if analysis_msg is not None else DEFAULT_ANALYSIS_RULES),
         {
             "role": "user",
-            "content": [{
-                "type": "image_url",
-                "image_url": {
-                    "url": f'data:image/{img_ext};base64,{base64_data}',
-                    "detail": "high"
-                }
-            }]
+            "content": content
         }
     ]
 
-    retries = max_retries
-    for attempt in range(retries):
-        try:
-            return llm.generate(messages)
-        except Exception as e:
-            if attempt < retries - 1:
-                time.sleep(0.5 + (0.5 * attempt))
-            else:
-                raise e
-            
 
-def analyse_image_data_iteratively(data:bytes|str, img_ext:str, llm:LLMClient, max_retries:int = 3, section_name:str = None, prior_context:str = None, post_context:str = None) -> str:
-    analysis_msg = ITERATIVE_ANALYSIS_CLASSIFIER_STEP
-    output = analyse_image_data(data, img_ext, llm, analysis_msg, max_retries, section_name, prior_context, post_context)
+class AnalysisPrompt:
+    name:str = None             # eg. 'chart/bar'
+    instructions:str = None
+    prefix_hash:str = None      # The hash of the leading message of the prompt's requests (see `prompt_prefix_hash`)
+
+
+class PromptRegistry:
+    """
+    The detail prompts of the iterative image analysis, keyed by (category, sub-category). A category's '*' entry is used for
+    any sub-category without its own prompt, and the ('*', '*') entry for any other category.
+    """
+    _prompts:dict[tuple[str, str], AnalysisPrompt] = None
+
+    def __init__(self):
+        self._prompts = {}
+
+    def register(self, category:str, sub_category:str, instructions:str) -> AnalysisPrompt:
+        prompt = AnalysisPrompt()
+        prompt.name = f"{category}/{sub_category}"
+        prompt.instructions = instructions
+        prompt.prefix_hash = prompt_prefix_hash([_system_message(instructions)])
+        self._prompts[(category, sub_category)] = prompt
+        return prompt
+
+    def get(self, category:str, sub_category:str = None) -> AnalysisPrompt:
+        prompt = self._prompts.get((category, sub_category), None)
+        if prompt is None: prompt = self._prompts.get((category, "*"), None)
+        if prompt is None: prompt = self._prompts[("*", "*")]
+        return prompt
+
+    def prompts(self) -> list[AnalysisPrompt]:
+        return list(self._prompts.values())
+
+
+PROMPTS = PromptRegistry()
+for _category, _sub_category, _instructions in [
+    ("table", "standard", ITERATIVE_ANALYSIS_TABLE_RULES_STANDARD),
+    ("table", "matrix", ITERATIVE_ANALYSIS_TABLE_RULES_MATRIX),
+    ("table", "pivot", ITERATIVE_ANALYSIS_TABLE_RULES_PIVOT),
+    ("table", "cross-tab", ITERATIVE_ANALYSIS_TABLE_RULES_CROSSTAB),
+    ("table", "nested", ITERATIVE_ANALYSIS_TABLE_RULES_NESTED),
+    ("table", "*", ITERATIVE_ANALYSIS_TABLE_RULES_OTHER),
+    ("chart", "bar", ITERATIVE_ANALYSIS_CHART_RULES_BAR),
+    ("chart", "line", ITERATIVE_ANALYSIS_CHART_RULES_LINE),
+    ("chart", "pie", ITERATIVE_ANALYSIS_CHART_RULES_PIE),
+    ("chart", "scatter", ITERATIVE_ANALYSIS_CHART_RULES_SCATTER),
+    ("chart", "histogram", ITERATIVE_ANALYSIS_CHART_RULES_HISTOGRAM),
+    ("chart", "box", ITERATIVE_ANALYSIS_CHART_RULES_BOX),
+    ("chart", "time-series", ITERATIVE_ANALYSIS_CHART_RULES_TIME_SERIES),
+    ("chart", "heat-map", ITERATIVE_ANALYSIS_CHART_RULES_HEAT_MAP),
+    ("chart", "network", ITERATIVE_ANALYSIS_CHART_RULES_NETWORK),
+    ("chart", "venn", ITERATIVE_ANALYSIS_CHART_RULES_VENN),
+    ("chart", "sankey", ITERATIVE_ANALYSIS_CHART_RULES_SANKEY),
+    ("chart", "tree", ITERATIVE_ANALYSIS_CHART_RULES_TREE),
+    ("chart", "radar", ITERATIVE_ANALYSIS_CHART_RULES_RADAR),
+    ("chart", "bubble", ITERATIVE_ANALYSIS_CHART_RULES_BUBBLE),
+    ("chart", "waterfall", ITERATIVE_ANALYSIS_CHART_RULES_WATERFALL),
+    ("chart", "gantt", ITERATIVE_ANALYSIS_CHART_RULES_GANTT),
+    ("chart", "*", ITERATIVE_ANALYSIS_CHART_RULES_OTHER),
+    ("formula", "*", ITERATIVE_ANALYSIS_FORMULA),
+    ("text", "*", ITERATIVE_ANALYSIS_TEXT),
+    ("picture", "diagram", ITERATIVE_ANALYSIS_PICTURE_DIAGRAM),
+    ("picture", "photo", ITERATIVE_ANALYSIS_PICTURE_PHOTO),
+    ("picture", "drawing", ITERATIVE_ANALYSIS_PICTURE_DRAWING),
+    ("picture", "*", ITERATIVE_ANALYSIS_PICTURE_OTHER),
+    ("radiograph", "x-ray", ITERATIVE_ANALYSIS_RADIOGRAPH_XRAY),
+    ("radiograph", "mri", ITERATIVE_ANALYSIS_RADIOGRAPH_MRI),
+    ("radiograph", "ct", ITERATIVE_ANALYSIS_RADIOGRAPH_CT),
+    ("radiograph", "*", ITERATIVE_ANALYSIS_RADIOGRAPH_OTHER),
+    ("*", "*", ITERATIVE_ANALYSIS_OTHER),
+]:
+    PROMPTS.register(_category, _sub_category, _instructions)
+
+
+def select_analysis_prompt(category:str, sub_category:str) -> str:
+    ## Select the appropriate prompt based on the category and sub-category
+    return PROMPTS.get(category, sub_category).instructions
+
+
+## The categories + sub-categories of the classifier step (see ITERATIVE_ANALYSIS_CLASSIFIER_STEP + select_analysis_prompt)
+CLASSIFIER_TAXONOMY = {
+    "table": ["standard", "matrix", "pivot", "cross-tab", "nested", "other"],
+    "chart": ["bar", "line", "pie", "scatter", "histogram", "box", "time-series", "heat-map", "network", "venn", "sankey", "tree", "radar", "bubble", "waterfall", "gantt", "other"],
+    "formula": ["equation", "expression", "other"],
+    "text": ["paragraph", "list", "title", "other"],
+    "picture": ["diagram", "photo", "drawing", "other"],
+    "radiograph": ["x-ray", "mri", "ct", "other"],
+    "other": ["other"],
+}
+
+def _json_schema_format(name:str, schema:dict) -> dict:
+    return { "type": "json_schema", "json_schema": { "name": name, "strict": True, "schema": schema } }
+
+## The structured (JSON schema) outputs of the classifier step, the detail step + batch requests
+CLASSIFIER_RESPONSE_FORMAT = _json_schema_format("figure_category", {
+    "type": "object",
+    "properties": {
+        "category": { "type": "string", "enum": list(CLASSIFIER_TAXONOMY.keys()) },
+        "sub_category": { "type": "string", "enum": sorted(set(sub_category for sub_categories in CLASSIFIER_TAXONOMY.values() for sub_category in sub_categories)) }
+    },
+    "required": ["category", "sub_category"],
+    "additionalProperties": False
+})
+DETAIL_RESPONSE_FORMAT = _json_schema_format("figure_analysis", {
+    "type": "object",
+    "properties": { "content": { "type": "string" } },
+    "required": ["content"],
+    "additionalProperties": False
+})
+BATCH_RESPONSE_FORMAT = _json_schema_format("figure_batch", {
+    "type": "object",
+    "properties": {
+        "figures": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": { "id": { "type": "string" }, "result": { "type": "string" } },
+                "required": ["id", "result"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["figures"],
+    "additionalProperties": False
+})
+
+## The deployments that rejected a structured output (eg. an older API version), which are sent plain requests instead
+_structured_unsupported:set[str] = set()
+
+
+def extract_json(output:str):
+    """
+    Tolerantly extract JSON from the output of a model: the whole output, the contents of a ``` code fence, or the first
+    JSON object (or array) within the text, eg. when the model wraps the JSON in an explanation.
+    :return: The parsed JSON, or None if the output has none.
+    """
+    import re
     if output is None:
-        return output
-    
-    classifier_data = json.loads(output)
-    category = classifier_data.get("category", None)
-    sub_category = classifier_data.get("sub_category", None)
-    if category is None:
         return None
-    if sub_category is None:
+    text = output.strip()
+    try:
+        return json.loads(text)
+    except Exception:
+        pass
+    fence = re.search(r"```[a-zA-Z]*\s*\n?(.*?)```", text, re.S)
+    if fence is not None:
+        try:
+            return json.loads(fence.group(1).strip())
+        except Exception:
+            pass
+    decoder = json.JSONDecoder()
+    for index, char in enumerate(text):
+        if char not in "{[": continue
+        try:
+            value, _ = decoder.raw_decode(text, index)
+            return value
+        except ValueError:
+            continue
+    return None
+
+
+def parse_classifier_output(output:str) -> tuple[str, str]:
+    """
+    Parse the output of the classifier step, checking the category + sub-category against the taxonomy.
+    :return: The (category, sub-category), with an unknown sub-category as 'other', or (None, None) if the output has no known category.
+    """
+    classifier_data = extract_json(output)
+    if type(classifier_data) is str: classifier_data = extract_json(classifier_data)      ## JSON within a JSON string (eg. a batch result)
+    if type(classifier_data) is list and len(classifier_data) > 0: classifier_data = classifier_data[0]
+    if type(classifier_data) is not dict:
+        return None, None
+    category = _taxonomy_name(classifier_data.get("category", None))
+    sub_category = _taxonomy_name(classifier_data.get("sub_category", classifier_data.get("subcategory", None)))
+    if category not in CLASSIFIER_TAXONOMY:
+        return None, None
+    if sub_category not in CLASSIFIER_TAXONOMY[category]:
         sub_category = "other"
-    
-    ## Select the appropriate prompt based on the category and sub-category
-    prompt = None
-    if category == "table": 
-        if sub_category == "standard":
-            prompt = ITERATIVE_ANALYSIS_TABLE_RULES_STANDARD
-        elif sub_category == "matrix":
-            prompt = ITERATIVE_ANALYSIS_TABLE_RULES_MATRIX
-        elif sub_category == "pivot":
-            prompt = ITERATIVE_ANALYSIS_TABLE_RULES_PIVOT
-        elif sub_category == "cross-tab":
-            prompt = ITERATIVE_ANALYSIS_TABLE_RULES_CROSSTAB
-        elif sub_category == "nested":
-            prompt = ITERATIVE_ANALYSIS_TABLE_RULES_NESTED
-        else:
-            prompt = ITERATIVE_ANALYSIS_TABLE_RULES_OTHER
-    elif category == "chart":
-        if sub_category == "bar":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_BAR
-        elif sub_category == "line":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_LINE
-        elif sub_category == "pie":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_PIE
-        elif sub_category == "scatter":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_SCATTER
-        elif sub_category == "histogram":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_HISTOGRAM
-        elif sub_category == "box":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_BOX
-        elif sub_category == "time-series":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_TIME_SERIES
-        elif sub_category == "heat-map":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_HEAT_MAP
-        elif sub_category == "network":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_NETWORK
-        elif sub_category == "venn":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_VENN
-        elif sub_category == "sankey":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_SANKEY
-        elif sub_category == "tree":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_TREE
-        elif sub_category == "radar":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_RADAR
-        elif sub_category == "bubble":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_BUBBLE
-        elif sub_category == "waterfall":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_WATERFALL
-        elif sub_category == "gantt":
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_GANTT
-        else:
-            prompt = ITERATIVE_ANALYSIS_CHART_RULES_OTHER
-    elif category == "formula":
-        prompt = ITERATIVE_ANALYSIS_FORMULA
-    elif category == "text":
-        prompt = ITERATIVE_ANALYSIS_TEXT
-    elif category == "picture":
-        if sub_category == "diagram":
-            prompt = ITERATIVE_ANALYSIS_PICTURE_DIAGRAM
-        elif sub_category == "photo":
-            prompt = ITERATIVE_ANALYSIS_PICTURE_PHOTO
-        elif sub_category == "drawing":
-            prompt = ITERATIVE_ANALYSIS_PICTURE_DRAWING
-        else:
-            prompt = ITERATIVE_ANALYSIS_PICTURE_OTHER
-    elif category == "radiograph":
-        if sub_category == "x-ray":
-            prompt = ITERATIVE_ANALYSIS_RADIOGRAPH_XRAY
-        elif sub_category == "mri":
-            prompt = ITERATIVE_ANALYSIS_RADIOGRAPH_MRI
-        elif sub_category == "ct":
-            prompt = ITERATIVE_ANALYSIS_RADIOGRAPH_CT
-        else:
-            prompt = ITERATIVE_ANALYSIS_RADIOGRAPH_OTHER
+    return category, sub_category
+
+
+def _taxonomy_name(value) -> str:
+    ## eg. 'Time Series' -> 'time-series', 'X_Ray' -> 'x-ray'
+    if value is None:
+        return None
+    return "-".join(str(value).strip().lower().replace("_", " ").replace("-", " ").split())
+
+
+def unwrap_structured_output(output:str) -> str:
+    """
+    The content of a structured detail step output ({ "content": ... }), or the output itself if it isn't one (eg. a plain request).
+    """
+    if output is None or not output.strip().startswith(("{", "```")):
+        return output
+    data = extract_json(output)
+    if type(data) is dict and type(data.get("content", None)) is str:
+        return data["content"]
+    return output
+
+
+def _should_retry(error:Exception, failures:list[int], max_retries:int, metrics:ParseMetrics = None) -> bool:
+    ## Throttled requests have their own retry budget, as the service says when to retry them
+    ## :param failures: The [failed, throttled] attempts so far, updated in place
+    if is_throttled(error):
+        failures[1] += 1
+        if metrics is not None: metrics.increment("llm_throttled")
+        retry = failures[1] <= MAX_THROTTLED_RETRIES
     else:
-        prompt = ITERATIVE_ANALYSIS_OTHER
-    
-    output = analyse_image_data(data, img_ext, llm, prompt, max_retries, section_name, prior_context, post_context)
+        failures[0] += 1
+        retry = failures[0] < max_retries
+    if retry and metrics is not None: metrics.increment("llm_retries")
+    return retry
+
+
+def validate_classifier_output(output:str) -> bool:
+    """
+    Whether the output of the classifier step is a category that can be used.
+    """
+    category, _ = parse_classifier_output(output)
+    return category is not None
+
+
+def validate_analysis_output(output:str, category:str = None) -> bool:
+    """
+    A cheap check of the output of a detail step, eg. that the markdown table of a table is well formed.
+    """
+    if output is None or len(output.strip()) == 0:
+        return False
+    text = output.strip()
+    if text.lower().startswith(REFUSAL_PREFIXES):
+        return False
+    if category == "table":
+        return _is_latex_table(text) or _is_markdown_table(text)
+    if category == "formula":
+        return text.count("$$") % 2 == 0
+    return True
+
+
+def _is_latex_table(text:str) -> bool:
+    return "\\begin{tabular}" in text and "\\end{tabular}" in text
+
+
+def _is_markdown_table(text:str) -> bool:
+    ## A header row, a separator row, and rows that all have the same number of cells
+    import re
+    rows = [line.strip() for line in text.split("\n") if line.strip().startswith("|")]
+    if len(rows) < 2:
+        return False
+    cells = [len(row.strip("|").split("|")) for row in rows]
+    if not re.fullmatch(r"\|?(\s*:?-{3,}:?\s*\|)*\s*:?-{3,}:?\s*\|?", rows[1]):
+        return False
+    return all(count == cells[0] for count in cells)
+
+
+def _step_model(llm:LLMClient, routing:ModelRouting, step:str, category:str = None) -> str:
+    ## The deployment of the step, or None for the LLM model
+    model = routing.model_for(step, category) if routing is not None else None
+    return model if model != llm.model else None
+
+
+def _should_escalate(output:str, model:str, routing:ModelRouting, step:str, category:str = None, metrics:ParseMetrics = None) -> bool:
+    ## Whether to re-run the step with the LLM model, because the output of the step's (smaller) deployment failed validation
+    if model is None or not routing.escalate:
+        return False
+    valid = validate_classifier_output(output) if step == STEP_CLASSIFIER else validate_analysis_output(output, category)
+    if not valid and metrics is not None:
+        metrics.increment("llm_escalations")
+        metrics.increment(f"llm_escalations:{step}")
+    return not valid
+
+
+def _response_format(routing:ModelRouting, step:str) -> dict:
+    ## The JSON schema of the step's output, or None for a plain text output (without routing, as per the default routing from the ENV)
+    structured = (routing if routing is not None else ModelRouting()).uses_structured_outputs(step)
+    if not structured:
+        return None
+    return { STEP_CLASSIFIER: CLASSIFIER_RESPONSE_FORMAT, STEP_DETAIL: DETAIL_RESPONSE_FORMAT, STEP_BATCH: BATCH_RESPONSE_FORMAT }[step]
+
+
+def _sends_context(routing:ModelRouting, step:str) -> bool:
+    ## Whether the requests of the step are sent the section + context of the figure: the classifier never is, and the detail prompts
+    ## (which were written for the image alone) only when asked for, as the context's tokens are added to every detail request
+    if step in [STEP_CLASSIFIER, "batch_classifier"]:
+        return False
+    if step in [STEP_DETAIL, "batch_detail"]:
+        return (routing if routing is not None else ModelRouting()).detail_context
+    return True
+
+
+def _generate_args(llm:LLMClient, model:str, response_format:dict) -> dict:
+    ## The response format is only passed when it's wanted (+ supported), so describers without structured outputs still work
+    generate_args = { "model": model }
+    if response_format is not None and (model or llm.model) not in _structured_unsupported:
+        generate_args["response_format"] = response_format
+    ## The request is retried by `_generate` (with its own retry + throttle budgets), so the LLM client mustn't retry it as well
+    if isinstance(llm, LLMClient): generate_args["max_retries"] = 0
+    return generate_args
+
+
+def _rejects_response_format(error:Exception, llm:LLMClient, model:str, metrics:ParseMetrics = None) -> bool:
+    ## Whether the request failed because the deployment (or API version) doesn't support structured outputs, if so it's remembered
+    if getattr(error, "status_code", None) != 400 or ("response_format" not in str(error) and "json_schema" not in str(error)):
+        return False
+    _structured_unsupported.add(model or llm.model)
+    if metrics is not None: metrics.increment("llm_structured_unsupported")
+    print(f"Structured outputs aren't supported by '{model or llm.model}', sending plain requests instead: {error}")
+    return True
+
+
+class _Request:
+    """
+    One LLM request of an analysis plan (see `_run`).
+    """
+    messages:list[dict] = None
+    model:str = None                    # The deployment to send the request to, or None for the LLM model
+    response_format:dict = None
+    step:str = None                     # The step the request's time is recorded under
+    category:str = None
+    images:int = None                   # The number of images of a batch request, or None if it isn't one
+
+    def __init__(self, messages:list[dict], model:str = None, response_format:dict = None, step:str = None, category:str = None, images:int = None):
+        self.messages = messages
+        self.model = model
+        self.response_format = response_format
+        self.step = step
+        self.category = category
+        self.images = images
+
+
+## The analysis is written once, as a "plan": a generator that yields the `_Request`s it needs (or a list of sub-plans, which may run at once),
+## and is sent their outputs (or thrown their errors). `_run` + `_run_async` are the only places where the requests are actually sent.
+
+def _run(plan, llm:LLMClient, max_retries:int, metrics:ParseMetrics = None):
+    ## Run a plan, sending its requests (+ running its sub-plans one after the other)
+    ## :return: The return value of the plan
+    output, error = None, None
+    while True:
+        try:
+            request = plan.send(output) if error is None else plan.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        output, error = None, None
+        try:
+            if type(request) is list:
+                output = [_run(sub_plan, llm, max_retries, metrics) for sub_plan in request]
+            else:
+                start = _start_request(request, metrics)
+                output = _generate(request, llm, max_retries, metrics)
+                _finish_request(request, start, metrics)
+        except Exception as e:
+            error = e
+
+
+async def _run_async(plan, llm:LLMClient, max_retries:int, metrics:ParseMetrics = None):
+    ## Run a plan, sending its requests (+ running its sub-plans at once)
+    import asyncio
+    output, error = None, None
+    while True:
+        try:
+            request = plan.send(output) if error is None else plan.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        output, error = None, None
+        try:
+            if type(request) is list:
+                output = await asyncio.gather(*[_run_async(sub_plan, llm, max_retries, metrics) for sub_plan in request])
+            else:
+                start = _start_request(request, metrics)
+                output = await _generate_async(request, llm, max_retries, metrics)
+                _finish_request(request, start, metrics)
+        except Exception as e:
+            error = e
+
+
+def _start_request(request:_Request, metrics:ParseMetrics = None) -> float:
+    if metrics is not None:
+        metrics.increment(f"llm_prefix:{prompt_prefix_hash(request.messages)}")
+        if request.model is not None: metrics.increment(f"llm_routed:{request.model}")
+    return time.perf_counter()
+
+
+def _finish_request(request:_Request, start:float, metrics:ParseMetrics = None):
+    ## Only successful requests are recorded under their step
+    if metrics is None:
+        return
+    metrics.record_llm(request.step, time.perf_counter() - start, request.category)
+    if request.images is not None:
+        metrics.increment("llm_batches")
+        metrics.increment("llm_batch_images", request.images)
+
+
+def _failure_delay(error:Exception, generate_args:dict, failures:list[int], llm:LLMClient, request:_Request, max_retries:int, metrics:ParseMetrics = None) -> float:
+    ## How long to wait before retrying a failed request (0 to retry it straight away, without the response format the deployment rejected)
+    ## Raises the error if the request isn't retried
+    if "response_format" in generate_args and _rejects_response_format(error, llm, request.model, metrics):
+        return 0
+    if not _should_retry(error, failures, max_retries, metrics):
+        raise error
+    return retry_delay(error, sum(failures) - 1)
+
+
+def _generate(request:_Request, llm:LLMClient, max_retries:int, metrics:ParseMetrics = None) -> str:
+    failures = [0, 0]
+    while True:
+        generate_args = _generate_args(llm, request.model, request.response_format)
+        try:
+            return llm.generate(request.messages, **generate_args)
+        except Exception as e:
+            time.sleep(_failure_delay(e, generate_args, failures, llm, request, max_retries, metrics))
+
+
+async def _generate_async(request:_Request, llm:LLMClient, max_retries:int, metrics:ParseMetrics = None) -> str:
+    import asyncio
+    failures = [0, 0]
+    while True:
+        generate_args = _generate_args(llm, request.model, request.response_format)
+        try:
+            return await llm.generate_async(request.messages, **generate_args)
+        except Exception as e:
+            await asyncio.sleep(_failure_delay(e, generate_args, failures, llm, request, max_retries, metrics))
+
+
+def _single_plan(data:bytes|str, img_ext:str, analysis_msg:str = None, section_name:str = None, prior_context:str = None, post_context:str = None):
+    return (yield _Request(build_analysis_messages(data, img_ext, analysis_msg, section_name, prior_context, post_context), step="single"))
+
+
+def _step_plan(messages:list[dict], llm:LLMClient, metrics:ParseMetrics, routing:ModelRouting, step:str, category:str = None):
+    ## Generate the output of a step with the step's deployment, escalating to the LLM model if the output fails validation
+    model = _step_model(llm, routing, step, category)
+    response_format = _response_format(routing, step)
+    output = yield _Request(messages, model, response_format, step, category)
+    if step == STEP_DETAIL and response_format is not None: output = unwrap_structured_output(output)
+    if _should_escalate(output, model, routing, step, category, metrics):
+        output = yield _Request(messages, None, response_format, step, category)
+        if step == STEP_DETAIL and response_format is not None: output = unwrap_structured_output(output)
     return output
 
 
+def _classify_plan(messages:list[dict], llm:LLMClient, metrics:ParseMetrics, routing:ModelRouting):
+    ## Classify an image, asking again when the output can't be parsed
+    ## :return: The (category, sub-category), or (None, None) if the image couldn't be classified
+    for attempt in range(MAX_PARSE_RETRIES + 1):
+        if attempt > 0 and metrics is not None: metrics.increment("llm_parse_retries")
+        category, sub_category = parse_classifier_output((yield from _step_plan(messages, llm, metrics, routing, STEP_CLASSIFIER)))
+        if category is not None:
+            return category, sub_category
+        if metrics is not None: metrics.increment("llm_parse_failures")
+    return None, None
+
+
+def _iterative_plan(data:bytes|str, img_ext:str, llm:LLMClient, section_name:str = None, prior_context:str = None, post_context:str = None, metrics:ParseMetrics = None, routing:ModelRouting = None, category:tuple[str, str] = None):
+    if category is not None:
+        if metrics is not None: metrics.increment("llm_classifier_calls_saved")
+        category, sub_category = category
+    else:
+        analysis_msg = ITERATIVE_ANALYSIS_CLASSIFIER_STEP
+        category, sub_category = yield from _classify_plan(build_analysis_messages(data, img_ext, analysis_msg, with_context=_sends_context(routing, STEP_CLASSIFIER)), llm, metrics, routing)
+        if category is None:
+            ## Rather than failing the figure, analyse it with the default (single step) analysis message
+            if metrics is not None: metrics.increment("llm_classifier_fallbacks")
+            return (yield from _single_plan(data, img_ext, None, section_name, prior_context, post_context))
+
+    prompt = select_analysis_prompt(category, sub_category)
+    messages = build_analysis_messages(data, img_ext, prompt, section_name, prior_context, post_context, _sends_context(routing, STEP_DETAIL))
+    return (yield from _step_plan(messages, llm, metrics, routing, STEP_DETAIL, category))
+
+
+def analyse_image_data(data:bytes|str, img_ext:str, llm:LLMClient, analysis_msg:str = None, max_retries:int = 3, section_name:str = None, prior_context:str = None, post_context:str = None, metrics:ParseMetrics = None) -> str:
+    return _run(_single_plan(data, img_ext, analysis_msg, section_name, prior_context, post_context), llm, max_retries, metrics)
+            
+
+def analyse_image_data_iteratively(data:bytes|str, img_ext:str, llm:LLMClient, max_retries:int = 3, section_name:str = None, prior_context:str = None, post_context:str = None, metrics:ParseMetrics = None, routing:ModelRouting = None, category:tuple[str, str] = None) -> str:
+    """
+    Classify the image, then analyse it with the prompt for its category.
+    :param routing: The deployment of each step (defaults to the LLM model for both steps).
+    :param category: The (category, sub-category) of the image, if it is already known (eg. from the local classifier), which skips the classifier step.
+    """
+    return _run(_iterative_plan(data, img_ext, llm, section_name, prior_context, post_context, metrics, routing, category), llm, max_retries, metrics)
+
+
+async def analyse_image_data_async(data:bytes|str, img_ext:str, llm:LLMClient, analysis_msg:str = None, max_retries:int = 3, section_name:str = None, prior_context:str = None, post_context:str = None, metrics:ParseMetrics = None) -> str:
+    return await _run_async(_single_plan(data, img_ext, analysis_msg, section_name, prior_context, post_context), llm, max_retries, metrics)
+
+
+async def analyse_image_data_iteratively_async(data:bytes|str, img_ext:str, llm:LLMClient, max_retries:int = 3, section_name:str = None, prior_context:str = None, post_context:str = None, metrics:ParseMetrics = None, routing:ModelRouting = None, category:tuple[str, str] = None) -> str:
+    return await _run_async(_iterative_plan(data, img_ext, llm, section_name, prior_context, post_context, metrics, routing, category), llm, max_retries, metrics)
+
+
+## The instructions appended to a prompt when several images are analysed in one request
+BATCH_ANALYSIS_INSTRUCTIONS = """
+You will be given several images. Each image is preceded by a text part, starting with "Figure <figure id>", which may also have the section of the document the image is in, and the text before + after the image.
+
+Follow the instructions above for each image separately, and return the results for all of the images in the following JSON format:
+
+{ "figures": [ { "id": "<figure id>", "result": <the result for the image> } ] }
+
+Return exactly one entry for each figure id. The result for an image is exactly what you would return for that image on its own, as a JSON string (or as a JSON object if the instructions ask for JSON). Only return the JSON.
+"""
+
+class BatchImage:
+    id:str = None
+    data:bytes|str = None
+    img_ext:str = None
+    section_name:str = None
+    prior_context:str = None
+    post_context:str = None
+    category:tuple[str, str] = None     # The (category, sub-category) of the image, if it is already known
+
+
+def build_batch_messages(images:list[BatchImage], analysis_msg:str = None, with_context:bool = True) -> list[dict]:
+    """
+    Build the messages to analyse several images in one request, with one text part (the figure id + context) and one image part per image.
+    :param analysis_msg: The instructions for each image, defaults to the rules of the default analysis message.
+    :param with_context: Whether to send the section + context of each image (the classifier step never needs them, see `_sends_context`).
+    """
+    msg = (analysis_msg if analysis_msg is not None else DEFAULT_ANALYSIS_RULES) + "\n" + BATCH_ANALYSIS_INSTRUCTIONS
+    content = [{ "type": "text", "text": f"There are {len(images)} images." }]
+    for image in images:
+        base64_data = base64.b64encode(image.data).decode('utf-8') if type(image.data) is not str else image.data
+        content.append({
+            "type": "text",
+            "text": f"Figure {image.id}\n\nSection: {image.section_name if image.section_name is not None else 'Unknown'}\n\n[START PRIOR CONTEXT]\n{image.prior_context if image.prior_context is not None else 'No prior context'}\n[END PRIOR CONTEXT]\n\n[START POST CONTEXT]\n{image.post_context if image.post_context is not None else 'No post context'}\n[END POST CONTEXT]" if with_context else f"Figure {image.id}"
+        })
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f'data:image/{image.img_ext};base64,{base64_data}',
+                "detail": "high"
+            }
+        })
+    return [
+        _system_message(msg),
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
+
+
+def parse_batch_output(output:str, ids:list[str]) -> dict[str, str]:
+    """
+    Parse the output of a batch request.
+    :return: The result of each figure id that is in the output (figures that are missing or unparseable are left out).
+    """
+    data = extract_json(output)
+    if data is None:
+        return {}
+    entries = data.get("figures", None) if type(data) is dict else data
+    if type(entries) is dict:
+        entries = [{ "id": key, "result": value } for key, value in entries.items()]
+    if type(entries) is not list:
+        return {}
+    results = {}
+    for entry in entries:
+        if type(entry) is not dict: continue
+        figure_id = str(entry.get("id", "")).strip()
+        if figure_id.lower().startswith("figure "): figure_id = figure_id[len("figure "):].strip()
+        result = entry.get("result", None)
+        if figure_id not in ids or result is None: continue
+        results[figure_id] = result if type(result) is str else json.dumps(result)
+    return results
+
+
+def batch_request_ids(messages:list[dict]) -> list[str]:
+    """
+    The figure ids of a batch request (see `build_batch_messages`), or an empty list if the messages are not a batch request.
+    """
+    ids = []
+    for message in messages:
+        if message.get("role", None) != "user" or type(message.get("content", None)) is not list: continue
+        for part in message["content"]:
+            if type(part) is dict and part.get("type", None) == "text" and str(part.get("text", "")).startswith("Figure "):
+                ids.append(part["text"][len("Figure "):].split("\n", 1)[0].strip())
+    return ids
+
+
+def _batch_by_prompt(images:list[BatchImage], categories:dict[str, tuple[str, str]]) -> tuple[dict[str, list[BatchImage]], dict[str, str]]:
+    ## Group the images by their detail prompt (so each group can be analysed in one request)
+    groups = {}
+    categories_by_prompt = {}
+    for image in images:
+        category, sub_category = categories[image.id]
+        prompt = select_analysis_prompt(category, sub_category)
+        groups.setdefault(prompt, []).append(image)
+        categories_by_prompt[prompt] = category
+    return groups, categories_by_prompt
+
+
+def _parse_batch_categories(output:str, ids:list[str]) -> dict[str, tuple[str, str]]:
+    categories = {}
+    for figure_id, result in parse_batch_output(output, ids).items():
+        category, sub_category = parse_classifier_output(result)
+        if category is not None:
+            categories[figure_id] = (category, sub_category)
+    return categories
+
+
+def _escalated_results(results:dict[str, str], model:str, routing:ModelRouting, category:str, metrics:ParseMetrics = None) -> set[str]:
+    ## Remove the results of a batch (sent to a smaller deployment) that fail validation
+    ## :return: The ids of the removed results, which are re-run with the LLM model
+    escalated = set()
+    for figure_id, result in list(results.items()):
+        if _should_escalate(result, model, routing, STEP_DETAIL, category, metrics):
+            del results[figure_id]
+            escalated.add(figure_id)
+    return escalated
+
+
+def _batch_request_plan(images:list[BatchImage], analysis_msg:str, step:str, category:str = None, model:str = None, routing:ModelRouting = None):
+    ## :return: The output of the batch request, or None if it failed (so its images are analysed one at a time)
+    try:
+        return (yield _Request(build_batch_messages(images, analysis_msg, _sends_context(routing, step)), model, _response_format(routing, STEP_BATCH), step, category, len(images)))
+    except Exception as e:
+        print(f"Error analysing a batch of {len(images)} images, falling back to analysing them one at a time: {e}")
+        return None
+
+
+def _batch_plan(images:list[BatchImage], metrics:ParseMetrics = None, routing:ModelRouting = None):
+    if len(images) == 1:
+        image = images[0]
+        return { image.id: (yield from _single_plan(image.data, image.img_ext, None, image.section_name, image.prior_context, image.post_context)) }
+    ids = [image.id for image in images]
+    results = parse_batch_output((yield from _batch_request_plan(images, None, "batch", routing=routing)), ids)
+    for image in images:
+        if image.id not in results:
+            if metrics is not None: metrics.increment("llm_batch_fallbacks")
+            results[image.id] = yield from _single_plan(image.data, image.img_ext, None, image.section_name, image.prior_context, image.post_context)
+    return results
+
+
+def _batch_group_plan(group:list[BatchImage], prompt:str, category:str, llm:LLMClient, metrics:ParseMetrics = None, routing:ModelRouting = None):
+    ## Analyse the images that share a detail prompt in one request
+    group_results = {}
+    escalated = set()
+    if len(group) > 1:
+        model = _step_model(llm, routing, STEP_DETAIL, category)
+        group_results = parse_batch_output((yield from _batch_request_plan(group, prompt, "batch_detail", category, model, routing)), [image.id for image in group])
+        escalated = _escalated_results(group_results, model, routing, category, metrics)
+    for image in group:
+        if image.id not in group_results:
+            if len(group) > 1 and image.id not in escalated and metrics is not None: metrics.increment("llm_batch_fallbacks")
+            messages = build_analysis_messages(image.data, image.img_ext, prompt, image.section_name, image.prior_context, image.post_context, _sends_context(routing, STEP_DETAIL))
+            group_results[image.id] = yield from _step_plan(messages, llm, metrics, routing if image.id not in escalated else None, STEP_DETAIL, category)
+    return group_results
+
+
+def _iterative_batch_plan(images:list[BatchImage], llm:LLMClient, metrics:ParseMetrics = None, routing:ModelRouting = None):
+    if len(images) == 1:
+        image = images[0]
+        return { image.id: (yield from _iterative_plan(image.data, image.img_ext, llm, image.section_name, image.prior_context, image.post_context, metrics, routing, image.category)) }
+    results = {}
+    ## Only the images that weren't classified locally are sent to the classifier
+    categories = { image.id: image.category for image in images if image.category is not None }
+    if len(categories) > 0 and metrics is not None: metrics.increment("llm_classifier_calls_saved", len(categories))
+    unclassified = [image for image in images if image.category is None]
+    if len(unclassified) > 1:
+        output = yield from _batch_request_plan(unclassified, ITERATIVE_ANALYSIS_CLASSIFIER_STEP, "batch_classifier", model=_step_model(llm, routing, STEP_CLASSIFIER), routing=routing)
+        categories.update(_parse_batch_categories(output, [image.id for image in unclassified]))
+    for image in images:
+        if image.id not in categories:
+            if len(unclassified) > 1 and metrics is not None: metrics.increment("llm_batch_fallbacks")
+            results[image.id] = yield from _iterative_plan(image.data, image.img_ext, llm, image.section_name, image.prior_context, image.post_context, metrics, routing)
+
+    ## The detail requests of the groups are sub-plans, so the async path sends them at once
+    groups, categories_by_prompt = _batch_by_prompt([image for image in images if image.id in categories], categories)
+    for group_results in (yield [_batch_group_plan(group, prompt, categories_by_prompt[prompt], llm, metrics, routing) for prompt, group in groups.items()]):
+        results.update(group_results)
+    return results
+
+
+def analyse_image_batch(images:list[BatchImage], llm:LLMClient, max_retries:int = 3, metrics:ParseMetrics = None, routing:ModelRouting = None) -> dict[str, str]:
+    """
+    Analyse several images in one request (with the default analysis message).
+    Any image that is missing from the response (or the whole batch, if the request fails) is analysed on its own.
+    :param routing: Only used for whether the request asks for a structured output.
+    :return: The analysis of each image, keyed by image id.
+    """
+    return _run(_batch_plan(images, metrics, routing), llm, max_retries, metrics)
+
+
+def analyse_image_batch_iteratively(images:list[BatchImage], llm:LLMClient, max_retries:int = 3, metrics:ParseMetrics = None, routing:ModelRouting = None) -> dict[str, str]:
+    """
+    Classify several images in one request, then analyse the images in one request per detail prompt.
+    Any image that is missing from a response (or the whole batch, if a request fails) is analysed on its own.
+    :param routing: The deployment of each step (defaults to the LLM model for both steps).
+    :return: The analysis of each image, keyed by image id.
+    """
+    return _run(_iterative_batch_plan(images, llm, metrics, routing), llm, max_retries, metrics)
+
+
+async def analyse_image_batch_async(images:list[BatchImage], llm:LLMClient, max_retries:int = 3, metrics:ParseMetrics = None, routing:ModelRouting = None) -> dict[str, str]:
+    """
+    The async version of `analyse_image_batch`.
+    """
+    return await _run_async(_batch_plan(images, metrics, routing), llm, max_retries, metrics)
+
+
+async def analyse_image_batch_iteratively_async(images:list[BatchImage], llm:LLMClient, max_retries:int = 3, metrics:ParseMetrics = None, routing:ModelRouting = None) -> dict[str, str]:
+    """
+    The async version of `analyse_image_batch_iteratively`, which sends the detail requests of the groups at once.
+    """
+    return await _run_async(_iterative_batch_plan(images, llm, metrics, routing), llm, max_retries, metrics)
+
+
+def prompt_prefixes() -> dict[str, str]:
+    """
+    The name of the prompt of each prefix hash (see `prompt_prefix_hash`), to make sense of the 'llm_prefix:<hash>' counters.
+    """
+    prefixes = {
+        prompt_prefix_hash([_system_message(ITERATIVE_ANALYSIS_CLASSIFIER_STEP)]): "classifier",
+        prompt_prefix_hash([_system_message(DEFAULT_ANALYSIS_RULES)]): "default",
+        prompt_prefix_hash([_system_message(ITERATIVE_ANALYSIS_CLASSIFIER_STEP + "\n" + BATCH_ANALYSIS_INSTRUCTIONS)]): "batch:classifier",
+        prompt_prefix_hash([_system_message(DEFAULT_ANALYSIS_RULES + "\n" + BATCH_ANALYSIS_INSTRUCTIONS)]): "batch:default",
+    }
+    for prompt in PROMPTS.prompts():
+        prefixes.setdefault(prompt.prefix_hash, prompt.name)
+        prefixes.setdefault(prompt_prefix_hash([_system_message(prompt.instructions + "\n" + BATCH_ANALYSIS_INSTRUCTIONS)]), f"batch:{prompt.name}")
+    return prefixes
+
+
+def prompt_version() -> str:
+    """
+    A short hash of all of the analysis prompts (+ the context sent with them), used to invalidate cached image descriptions whenever the prompts change.
+    """
+    import hashlib
+    hasher = hashlib.sha256()
+    for name, value in sorted(globals().items()):
+        if (name.startswith("ITERATIVE_ANALYSIS_") or name in ["DEFAULT_ANALYSIS_MESSAGE", "ANALYSIS_CONTEXT_TEMPLATE", "BATCH_ANALYSIS_INSTRUCTIONS"]) and type(value) is str:
+            hasher.update(name.encode("utf-8"))
+            hasher.update(value.encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
 
 if __name__ ==  '__main__':
     from dotenv import load_dotenv
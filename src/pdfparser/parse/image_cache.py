@@ -0,0 +1,214 @@
+import json
+import threading
+from typing import Awaitable, Callable
+from concurrent.futures import Executor, Future
+from pdfparser.util.cache import CacheBackend
+
+class ImageDescriptionCache:
+    """
+    A content addressed cache of image descriptions, shared across documents.
+
+    Entries are keyed by a hash of the encoded image bytes plus a variant string (the model + prompt version used to
+    describe the image), so the same image is only ever described once, regardless of which document (or file name) it came from.
+    Optionally, a perceptual hash of the image can be used to find near-duplicate images that have already been described
+    (with the same variant, nearest first).
+    """
+    NAMESPACE = "image-descriptions"
+    PHASH_NAMESPACE = "image-phash"
+
+    _backend:CacheBackend = None
+    _phash_distance:int = 0
+    _phashes:dict[str, dict[int, list[str]]] = None     # The keys of each perceptual hash, by variant id
+    _in_flight:dict[str, Future] = None
+    _lock:threading.Lock = None
+
+    def __init__(self, backend:CacheBackend, phash_distance:int = 0):
+        self._backend = backend
+        self._phash_distance = phash_distance
+        self._phashes = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        if self._phash_distance > 0:
+            self._load_phash_index()
+
+    def key(self, image_bytes:bytes, variant:str) -> str:
+        import hashlib
+        hasher = hashlib.sha256()
+        hasher.update(variant.encode("utf-8"))
+        hasher.update(b"\0")
+        hasher.update(image_bytes)
+        return hasher.hexdigest()
+
+    def get(self, key:str, phash:int = None, variant:str = None) -> str:
+        """
+        Get the cached description for the key, or a near-duplicate of the image (if a perceptual hash + the variant are provided).
+        :return: The cached description, or None if there is no cached description.
+        """
+        entry = self._read_entry(key)
+        if entry is None and phash is not None and variant is not None and self._phash_distance > 0:
+            entry = self._find_similar(phash, variant)
+        return entry.get("description", None) if entry is not None else None
+
+    def put(self, key:str, description:str, variant:str = None, phash:int = None):
+        import time
+        self._backend.put_text(self.NAMESPACE, key, json.dumps({
+            "description": description,
+            "variant": variant,
+            "phash": f"{phash:016x}" if phash is not None else None,
+            "created": time.time()
+        }, indent=4))
+
+        if phash is not None and variant is not None and self._phash_distance > 0:
+            variant_id = _variant_id(variant)
+            self._backend.put_text(self.PHASH_NAMESPACE, f"{variant_id}-{phash:016x}-{key}", key)
+            with self._lock:
+                keys = self._phashes.setdefault(variant_id, {}).setdefault(phash, [])
+                if key not in keys: keys.append(key)
+
+    def get_or_compute(self, image_bytes:bytes, variant:str, compute:Callable[[], str], phash:int = None) -> tuple[str, bool]:
+        """
+        Get the description of the image from the cache, or compute (and cache) it.
+        If the same image is already being computed by another thread, wait for that result instead of computing it again.
+        :return: A tuple of the description, and whether it was served from the cache.
+        """
+        key = self.key(image_bytes, variant)
+        description = self.get(key, phash, variant)
+        if description is not None:
+            return description, True
+
+        future, owner = self._claim(key)
+        if not owner:
+            return future.result(), True
+
+        try:
+            description = compute()
+            self._finish(key, future, description, variant, phash)
+            return description, False
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+
+    async def get_or_compute_async(self, image_bytes:bytes, variant:str, compute:Callable[[], Awaitable[str]], phash:int = None, executor:Executor = None) -> tuple[str, bool]:
+        """
+        The async version of `get_or_compute`, which waits for the same image being computed by another task (or thread).
+        :param executor: The executor the cache IO runs on (defaults to the loop's default executor).
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        key = self.key(image_bytes, variant)
+        description = await loop.run_in_executor(executor, self.get, key, phash, variant)
+        if description is not None:
+            return description, True
+
+        future, owner = self._claim(key)
+        if not owner:
+            ## Shielded, so a waiter being cancelled doesn't cancel the computation it's waiting for
+            return await asyncio.shield(asyncio.wrap_future(future)), True
+
+        try:
+            description = await compute()
+            await loop.run_in_executor(executor, self._finish, key, future, description, variant, phash)
+            return description, False
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+
+    def _claim(self, key:str) -> tuple[Future, bool]:
+        ## :return: The future of the key's description, and whether the caller owns it (ie. has to compute the description)
+        with self._lock:
+            future = self._in_flight.get(key, None)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+        return future, owner
+
+    def _finish(self, key:str, future:Future, description:str, variant:str, phash:int):
+        try:
+            if description is not None:
+                self.put(key, description, variant, phash)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+        future.set_result(description)
+
+    def _fail(self, key:str, future:Future, error:BaseException):
+        import asyncio
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(error)
+
+    def _read_entry(self, key:str) -> dict:
+        try:
+            value = self._backend.get_text(self.NAMESPACE, key)
+            return json.loads(value) if value is not None else None
+        except Exception as e:
+            print(f"Error loading cached image description '{key}', will ignore it. Error: {e}")
+            return None
+
+    def _find_similar(self, phash:int, variant:str) -> dict:
+        ## The entry of the nearest image (within the distance) described with the same variant, skipping entries that are gone (eg. evicted)
+        variant_id = _variant_id(variant)
+        with self._lock:
+            candidates = [((phash ^ other).bit_count(), other, key) for other, keys in self._phashes.get(variant_id, {}).items() for key in keys]
+        for distance, other, key in sorted(candidates):
+            if distance > self._phash_distance:
+                break
+            entry = self._read_entry(key)
+            if entry is not None and entry.get("variant", None) == variant:
+                return entry
+            if entry is None:
+                self._forget(variant_id, other, key)
+        return None
+
+    def _forget(self, variant_id:str, phash:int, key:str):
+        ## Drop the index entry of a description that is no longer cached
+        with self._lock:
+            keys = self._phashes.get(variant_id, {}).get(phash, [])
+            if key in keys: keys.remove(key)
+        self._backend.delete(self.PHASH_NAMESPACE, f"{variant_id}-{phash:016x}-{key}")
+
+    def _load_phash_index(self):
+        ## The index entries are named '<variant id>-<phash>-<key>' (older entries, without a variant, are ignored)
+        for name in self._backend.keys(self.PHASH_NAMESPACE):
+            parts = name.split("-")
+            if len(parts) != 3: continue
+            try:
+                phash = int(parts[1], 16)
+            except ValueError:
+                continue
+            keys = self._phashes.setdefault(parts[0], {}).setdefault(phash, [])
+            if parts[2] not in keys: keys.append(parts[2])
+
+
+def _variant_id(variant:str) -> str:
+    import hashlib
+    return hashlib.sha256(variant.encode("utf-8")).hexdigest()[:16]
+
+
+def perceptual_hash(pix) -> int:
+    """
+    Calculate a 64-bit difference hash (dHash) of a pixmap, similar images have hashes with a small hamming distance.
+    """
+    import numpy as np
+    from fitz import Pixmap, csGRAY
+
+    if pix.n - pix.alpha != 1:
+        pix = Pixmap(csGRAY, pix)
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)[:, :, 0].astype(np.float32)
+
+    ## Downscale to 9x8 by averaging blocks of pixels
+    rows = np.array_split(np.arange(pix.height), 8) if pix.height >= 8 else [np.arange(pix.height)] * 8
+    cols = np.array_split(np.arange(pix.width), 9) if pix.width >= 9 else [np.arange(pix.width)] * 9
+    small = np.array([[samples[np.ix_(r, c)].mean() for c in cols] for r in rows])
+
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    phash = 0
+    for bit in bits:
+        phash = (phash << 1) | int(bit)
+    return phash
@@ -0,0 +1,86 @@
+from pathlib import Path
+from .docintel import DocIntelAnalysis
+
+## The resolution pages are rendered at for their fingerprint, just enough to catch changes to images + fonts that leave the content stream as is
+FINGERPRINT_DPI = 24
+
+class RevisionPlan:
+    """
+    How to analyse a revision of a previously analysed document: the pages that are unchanged are reused from the previous analysis,
+    and only the pages that changed (or are new) are analysed.
+    """
+    fingerprints:list[str] = None           # The fingerprint of each page of the revised document
+    previous:DocIntelAnalysis = None        # The analysis of the previous revision (None if there is no previous revision)
+    reused:dict[int, int] = None            # The page number in the previous revision of each unchanged page
+    changed:list[int] = None                # The pages that need to be analysed
+
+    def __init__(self, fingerprints:list[str], previous:DocIntelAnalysis = None, previous_fingerprints:list[str] = None):
+        self.fingerprints = fingerprints
+        self.previous = previous
+        self.reused = {}
+        self.changed = []
+
+        ## Match pages by fingerprint (rather than position), so unchanged pages are reused even if pages were inserted or removed before them
+        previous_pages = {}
+        if previous is not None and previous_fingerprints is not None:
+            analysed_pages = set(page_number for page_number, _, _ in previous.page_ranges()) if len(previous.pages) > 0 else set()
+            for idx, fingerprint in enumerate(previous_fingerprints):
+                if idx + 1 in analysed_pages and fingerprint not in previous_pages:
+                    previous_pages[fingerprint] = idx + 1
+        for idx, fingerprint in enumerate(fingerprints):
+            if fingerprint in previous_pages:
+                self.reused[idx + 1] = previous_pages[fingerprint]
+            else:
+                self.changed.append(idx + 1)
+
+    def is_incremental(self) -> bool:
+        """
+        Whether any of the previous analysis can be reused.
+        """
+        return self.previous is not None and len(self.reused) > 0
+
+
+def page_fingerprints(file:Path) -> list[str]:
+    """
+    Fingerprint each page of a PDF by its content stream(s) and a low resolution render of the page.
+    :return: The fingerprint of each page, in page order.
+    """
+    import hashlib
+    from fitz import open as FitzOpen, csGRAY
+    document = FitzOpen(file)
+    try:
+        fingerprints = []
+        for page in document:
+            hasher = hashlib.sha256()
+            hasher.update(page.read_contents())
+            hasher.update(f"|{page.rect.width}x{page.rect.height}|{page.rotation}|".encode("utf-8"))
+            hasher.update(page.get_pixmap(dpi=FINGERPRINT_DPI, colorspace=csGRAY, alpha=False).samples)
+            fingerprints.append(hasher.hexdigest())
+        return fingerprints
+    finally:
+        document.close()
+
+
+def stitch_analysis(plan:RevisionPlan, changed_analysis:DocIntelAnalysis = None) -> DocIntelAnalysis:
+    """
+    Stitch the analysis of a revised document together from the analysis of the unchanged pages in the previous revision,
+    and the analysis of the changed pages.
+    :param changed_analysis: The analysis of (at least) the changed pages of the revised document.
+    """
+    reused_pages = sorted(plan.reused.items())
+    previous_parts = plan.previous.split_pages([previous_page for _, previous_page in reused_pages])
+    previous_parts = { part.pages[0].page_number: part for part in previous_parts if len(part.pages) > 0 }
+    changed_parts = changed_analysis.split_pages(plan.changed) if changed_analysis is not None and len(plan.changed) > 0 else []
+    changed_parts = { part.pages[0].page_number: part for part in changed_parts if len(part.pages) > 0 }
+
+    parts = []
+    for page_number in range(1, len(plan.fingerprints) + 1):
+        if page_number in plan.reused:
+            previous_page = plan.reused[page_number]
+            if previous_page in previous_parts:
+                parts.append(previous_parts[previous_page].renumber_pages({ previous_page: page_number }))
+        elif page_number in changed_parts:
+            parts.append(changed_parts[page_number])
+    analysis = DocIntelAnalysis.merge(parts)
+    if changed_analysis is not None: analysis.warnings = list(changed_analysis.warnings)
+    return analysis
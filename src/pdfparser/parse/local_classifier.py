@@ -0,0 +1,145 @@
+import os
+from .triage import polygon_bounds, text_coverage
+from .render_policy import PHOTO_COLOUR_COUNT
+
+## Lines of text that start with one of these are list items
+LIST_MARKERS = ("•", "◦", "▪", "■", "●", "-", "*", "–", "—")
+
+class FigureSignals:
+    """
+    What the layout analysis found within a figure's region, for the local classifier.
+    """
+    table_overlap:float = 0.0       # The largest fraction of the figure covered by one of the tables on the page
+    table_nested:bool = False       # Whether that table has cells that span several rows or columns
+    formula_overlap:float = 0.0     # The fraction of the figure covered by (display) formulas
+    text_coverage:float = 0.0       # The fraction of the figure covered by words
+    word_count:int = 0              # The number of words within the figure
+    line_count:int = 0              # The number of lines of text within the figure
+    line_width:float = 0.0          # The mean width of the lines of text, as a fraction of the figure's width
+    list_lines:float = 0.0          # The fraction of the lines of text that start with a list marker (or number)
+
+
+class LocalClassification:
+    category:str = None
+    sub_category:str = None
+    confidence:float = None
+    reason:str = None               # The signal the classification is based on
+
+
+class LocalClassifier:
+    """
+    Classifies figures (into the categories of the LLM classifier step) from cheap, local signals: the tables + formulas the
+    layout analysis found in the figure's region, the density + layout of the words within it, and the colours of the rendered image.
+    When the local classifier is confident, the figure goes straight to its detail prompt, saving the LLM classifier request.
+    Configured with (args or ENV):
+        --local-classifier=true|false               (LOCAL_CLASSIFIER), classify the figures locally when possible (default: true)
+        --local-classifier-min-confidence=<0-1>     (LOCAL_CLASSIFIER_MIN_CONFIDENCE), the confidence needed to skip the LLM classifier (default: 0.8)
+
+    Charts, diagrams + drawings can't be told apart reliably from these signals, so they are always left to the LLM.
+    """
+    min_confidence:float = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.min_confidence = float(args.get('local-classifier-min-confidence', os.environ.get("LOCAL_CLASSIFIER_MIN_CONFIDENCE", 0.8)))
+
+    def classify(self, signals:FigureSignals, pix) -> LocalClassification:
+        """
+        Classify a rendered figure.
+        :param signals: The layout signals of the figure's region (see `figure_signals`).
+        :param pix: The rendered figure.
+        :return: The most likely classification (check `is_confident`), or None if there is no likely category.
+        """
+        if signals is None:
+            return None
+        if signals.table_overlap >= 0.5:
+            return _classification("table", "nested" if signals.table_nested else "standard", min(0.97, signals.table_overlap), "table_overlap")
+        if signals.formula_overlap >= 0.3 and signals.word_count <= 40:
+            return _classification("formula", "equation", min(0.95, 0.5 + signals.formula_overlap), "formula_overlap")
+
+        colours = _distinct_colours(pix)
+        if signals.text_coverage >= 0.2 and signals.line_count >= 3 and colours <= PHOTO_COLOUR_COUNT:
+            ## Running text fills the width of the figure, while the labels of charts + diagrams are short + scattered
+            confidence = 0.5 + 0.5 * min(1.0, signals.text_coverage / 0.5) * min(1.0, signals.line_width)
+            return _classification("text", "list" if signals.list_lines >= 0.5 else "paragraph", confidence, "text_layout")
+        if colours > PHOTO_COLOUR_COUNT and signals.text_coverage < 0.02:
+            return _classification("picture", "photo", min(0.95, 0.7 + 0.25 * min(1.0, colours / (4 * PHOTO_COLOUR_COUNT))), "colours")
+        return None
+
+    def is_confident(self, classification:LocalClassification) -> bool:
+        return classification is not None and classification.confidence >= self.min_confidence
+
+
+def figure_signals(page, tables:list, polygon:list[float]) -> FigureSignals:
+    """
+    Gather the layout signals of a figure's region.
+    :param page: The page the region is on (DocIntelAnalysisPage).
+    :param tables: The tables of the document (DocIntelAnalysisTable).
+    :param polygon: The (DocIntel) polygon of the region.
+    """
+    signals = FigureSignals()
+    if page is None or polygon is None or len(polygon) < 8:
+        return signals
+    x0, y0, x1, y1 = polygon_bounds(polygon)
+    area = (x1 - x0) * (y1 - y0)
+    if area <= 0:
+        return signals
+
+    for table in tables or []:
+        for region in table.bounding_regions or []:
+            if region.page_number != page.page_number or region.polygon is None or len(region.polygon) < 8: continue
+            overlap = _overlap((x0, y0, x1, y1), polygon_bounds(region.polygon)) / area
+            if overlap > signals.table_overlap:
+                signals.table_overlap = min(1.0, overlap)
+                signals.table_nested = any((cell.row_span or 1) > 1 or (cell.column_span or 1) > 1 for cell in table.cells or [])
+
+    formulas = [formula for formula in page.formulas or [] if formula.kind == "display" and formula.polygon is not None and len(formula.polygon) >= 8]
+    signals.formula_overlap = min(1.0, sum(_overlap((x0, y0, x1, y1), polygon_bounds(formula.polygon)) for formula in formulas) / area)
+
+    signals.text_coverage = text_coverage(page.words, polygon)
+    signals.word_count = sum(1 for word in page.words or [] if word.polygon is not None and len(word.polygon) >= 8 and _centre_within(polygon_bounds(word.polygon), (x0, y0, x1, y1)))
+    lines = [line for line in page.lines or [] if line.polygon is not None and len(line.polygon) >= 8 and _centre_within(polygon_bounds(line.polygon), (x0, y0, x1, y1))]
+    signals.line_count = len(lines)
+    if len(lines) > 0:
+        widths = [(bounds[2] - bounds[0]) / (x1 - x0) for bounds in [polygon_bounds(line.polygon) for line in lines]]
+        signals.line_width = min(1.0, sum(widths) / len(widths))
+        signals.list_lines = sum(1 for line in lines if _is_list_item(line.content)) / len(lines)
+    return signals
+
+
+def _classification(category:str, sub_category:str, confidence:float, reason:str) -> LocalClassification:
+    classification = LocalClassification()
+    classification.category = category
+    classification.sub_category = sub_category
+    classification.confidence = confidence
+    classification.reason = reason
+    return classification
+
+
+def _overlap(a:tuple[float, float, float, float], b:tuple[float, float, float, float]) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    return width * height if width > 0 and height > 0 else 0.0
+
+
+def _centre_within(bounds:tuple[float, float, float, float], region:tuple[float, float, float, float]) -> bool:
+    cx = (bounds[0] + bounds[2]) / 2
+    cy = (bounds[1] + bounds[3]) / 2
+    return region[0] <= cx <= region[2] and region[1] <= cy <= region[3]
+
+
+def _is_list_item(content:str) -> bool:
+    text = (content or "").strip()
+    if text.startswith(LIST_MARKERS):
+        return True
+    head = text.split(" ", 1)[0].rstrip(".)")
+    return len(head) > 0 and len(head) <= 3 and (head.isdigit() or (len(head) == 1 and head.isalpha() and text[len(head):len(head) + 1] in [".", ")"]))
+
+
+def _distinct_colours(pix) -> int:
+    ## The number of distinct colours in a sample of the pixels
+    import numpy as np
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)[::4, ::4, :].reshape(-1, pix.n)
+    if len(samples) == 0:
+        return 0
+    return len(np.unique(samples, axis=0))
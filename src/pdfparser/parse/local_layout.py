@@ -0,0 +1,267 @@
+from pathlib import Path
+from .docintel import DocIntelAnalysis, PAGE_BREAK
+
+## Text that is at least this much larger than the body text of the document is treated as a heading
+HEADING_SIZE_RATIO = 1.25
+TITLE_SIZE_RATIO = 1.6
+
+## Drawings smaller than this (in points) are treated as rules / underlines, rather than figures
+MIN_FIGURE_SIZE = 24
+
+## The kinds of page found by `probe_pages`
+PAGE_TEXT = "text"      # The page has a text layer (and maybe some figures), so it can be analysed locally
+PAGE_IMAGE = "image"    # The page has no (usable) text layer, but has images, ie. a scanned page that needs OCR
+PAGE_MIXED = "mixed"    # The page has a text layer, but most of the page is covered by images (that may contain text)
+
+## A page needs at least this many (legible) characters to count as having a text layer
+MIN_TEXT_CHARS = 20
+## The fraction of the page that images need to cover (along with a text layer) for a page to be mixed
+MIXED_IMAGE_COVERAGE = 0.5
+## The fraction of illegible characters (eg. a font without a unicode mapping) above which the text layer is ignored
+MAX_ILLEGIBLE_RATIO = 0.1
+
+def probe_pages(data:bytes) -> list[str]:
+    """
+    Classify each page of a PDF by whether it can be analysed from its native text layer.
+    :param data: The PDF file content.
+    :return: The kind of each page (PAGE_TEXT, PAGE_IMAGE or PAGE_MIXED), in page order.
+    """
+    from fitz import open as FitzOpen, Rect
+    document = FitzOpen(stream=data, filetype="pdf")
+    try:
+        kinds = []
+        for page in document:
+            text = "".join(page.get_text("text").split())
+            illegible = text.count("\ufffd")
+            has_text = len(text) - illegible >= MIN_TEXT_CHARS and illegible <= len(text) * MAX_ILLEGIBLE_RATIO
+
+            page_area = page.rect.get_area()
+            image_area = sum((Rect(image["bbox"]) & page.rect).get_area() for image in page.get_image_info())
+            coverage = image_area / page_area if page_area > 0 else 0.0
+
+            if not has_text:
+                kinds.append(PAGE_IMAGE if image_area > 0 else PAGE_TEXT)    ## A blank (or vector only) page has nothing to OCR
+            elif coverage >= MIXED_IMAGE_COVERAGE:
+                kinds.append(PAGE_MIXED)
+            else:
+                kinds.append(PAGE_TEXT)
+        return kinds
+    finally:
+        document.close()
+
+def analyse_pdf_layout(data:bytes, pages:list[int] = None, api_version:str = "2024-11-30", model_id:str = "prebuilt-layout") -> dict:
+    """
+    Build a (basic) Document Intelligence layout result from the native content of a PDF, without calling the service.
+
+    Text blocks become paragraphs (large text becomes a heading), and embedded images + clusters of vector drawings become figures.
+    Scanned pages (with no text layer) produce no text, so this is only a substitute for the service for born-digital pages.
+    :param data: The PDF file content.
+    :param pages: The (1-based) page numbers to include, defaults to all pages.
+    :return: The analysis, in the same (JSON) shape as the 'analyzeResult' returned by the Document Intelligence REST API.
+    """
+    from fitz import open as FitzOpen
+    import io
+
+    document = FitzOpen(stream=data, filetype="pdf")
+    try:
+        page_numbers = pages if pages is not None else list(range(1, document.page_count + 1))
+        page_blocks = [(page_number, _page_blocks(document.load_page(page_number - 1))) for page_number in page_numbers]
+        body_size = _body_font_size([block for _, (blocks, _) in page_blocks for block in blocks])
+
+        markdown = io.StringIO()
+        offset = 0
+        result_pages = []
+        paragraphs = []
+        figures = []
+        title_found = False
+
+        def write(text:str) -> dict:
+            nonlocal offset
+            markdown.write(text)
+            span = { "offset": offset, "length": len(text) }
+            offset += len(text)
+            return span
+
+        for page_idx, (page_number, (blocks, page_rect)) in enumerate(page_blocks):
+            if page_idx > 0:
+                write(PAGE_BREAK)
+            page_start = offset
+            words = []
+            lines = []
+
+            for block in blocks:
+                if block["type"] == "figure":
+                    figure_start = offset
+                    write("<figure>\n\n")
+                    elements = []
+                    for text_block in block["text"]:
+                        elements.append(f"/paragraphs/{len(paragraphs)}")
+                        paragraphs.append(_write_paragraph(write, text_block, page_number, None, words, lines))
+                        write("\n\n")
+                    write("</figure>\n\n")
+                    figures.append({
+                        "id": f"{page_number}.{len([f for f in figures if f['boundingRegions'][0]['pageNumber'] == page_number]) + 1}",
+                        "boundingRegions": [{ "pageNumber": page_number, "polygon": _polygon(block["rect"]) }],
+                        "spans": [{ "offset": figure_start, "length": offset - figure_start }],
+                        "elements": elements
+                    })
+                    continue
+
+                role = None
+                if block["size"] >= body_size * TITLE_SIZE_RATIO and not title_found:
+                    role = "title"
+                    title_found = True
+                    write("# ")
+                elif block["size"] >= body_size * HEADING_SIZE_RATIO:
+                    role = "sectionHeading"
+                    write("## ")
+                paragraphs.append(_write_paragraph(write, block, page_number, role, words, lines))
+                write("\n\n")
+
+            result_pages.append({
+                "pageNumber": page_number,
+                "angle": 0,
+                "width": page_rect.width / 72,
+                "height": page_rect.height / 72,
+                "unit": "inch",
+                "words": words,
+                "lines": lines,
+                "spans": [{ "offset": page_start, "length": offset - page_start }]
+            })
+
+        return {
+            "apiVersion": api_version,
+            "modelId": model_id,
+            "stringIndexType": "textElements",
+            "content": markdown.getvalue(),
+            "contentFormat": "markdown",
+            "pages": result_pages,
+            "paragraphs": paragraphs,
+            "figures": figures,
+            "sections": []
+        }
+    finally:
+        document.close()
+
+
+def analyse_pdf_layout_file(file:Path, pages:list[int] = None) -> DocIntelAnalysis:
+    """
+    Build a (basic) layout analysis of the PDF file from its native content, see `analyse_pdf_layout`.
+    """
+    with open(file, "rb") as f:
+        data = f.read()
+    return analyse_pdf_layout_data(data, pages)
+
+
+def analyse_pdf_layout_data(data:bytes, pages:list[int] = None) -> DocIntelAnalysis:
+    """
+    Build a (basic) layout analysis of the PDF content from its native content, see `analyse_pdf_layout`.
+    """
+    from azure.ai.documentintelligence.models import AnalyzeResult
+    return DocIntelAnalysis.from_result(AnalyzeResult(analyse_pdf_layout(data, pages)))
+
+
+def _page_blocks(page) -> tuple[list[dict], object]:
+    from fitz import Rect, TEXTFLAGS_DICT, TEXT_PRESERVE_IMAGES
+
+    ## Figures: embedded images + clusters of vector drawings (ignoring rules, underlines and full page backgrounds)
+    page_rect = page.rect
+    figure_rects = [Rect(image["bbox"]) for image in page.get_image_info()]
+    try:
+        figure_rects.extend(page.cluster_drawings())
+    except Exception:
+        pass    ## Older versions of PyMuPDF can't cluster drawings
+    figure_rects = [rect & page_rect for rect in figure_rects]
+    figure_rects = [rect for rect in figure_rects if rect.width >= MIN_FIGURE_SIZE and rect.height >= MIN_FIGURE_SIZE and rect.get_area() < page_rect.get_area() * 0.9]
+    figure_rects = _merge_rects(figure_rects)
+    figures = [{ "type": "figure", "rect": rect, "text": [] } for rect in figure_rects]
+
+    ## Text: one block per paragraph, text that lies within a figure is kept as part of the figure
+    blocks = []
+    for block in page.get_text("dict", flags=TEXTFLAGS_DICT & ~TEXT_PRESERVE_IMAGES)["blocks"]:
+        if block.get("type", 0) != 0: continue
+        spans = [span for line in block["lines"] for span in line["spans"] if len(span["text"].strip()) > 0]
+        if len(spans) == 0: continue
+        text_block = {
+            "type": "text",
+            "rect": Rect(block["bbox"]),
+            "size": max(span["size"] for span in spans),
+            "spans": spans
+        }
+        container = next((figure for figure in figures if (figure["rect"] & text_block["rect"]).get_area() > text_block["rect"].get_area() * 0.5), None)
+        if container is not None:
+            container["text"].append(text_block)
+        else:
+            blocks.append(text_block)
+
+    blocks.extend(figures)
+    blocks.sort(key=lambda b: (round(b["rect"].y0), b["rect"].x0))
+    return blocks, page_rect
+
+
+def _merge_rects(rects:list) -> list:
+    merged = list(rects)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                if merged[i].intersects(merged[j]):
+                    merged[i] = merged[i] | merged[j]
+                    del merged[j]
+                    changed = True
+                    break
+            if changed: break
+    return merged
+
+
+def _body_font_size(blocks:list[dict]) -> float:
+    ## The most common font size (weighted by the amount of text)
+    sizes = {}
+    for block in blocks:
+        if block["type"] != "text": continue
+        for span in block["spans"]:
+            size = round(span["size"], 1)
+            sizes[size] = sizes.get(size, 0) + len(span["text"])
+    if len(sizes) == 0:
+        return 10.0
+    return max(sizes.items(), key=lambda s: s[1])[0]
+
+
+def _polygon(rect) -> list[float]:
+    x0, y0, x1, y1 = rect.x0 / 72, rect.y0 / 72, rect.x1 / 72, rect.y1 / 72
+    return [x0, y0, x1, y0, x1, y1, x0, y1]
+
+
+def _write_paragraph(write, block:dict, page_number:int, role:str, words:list[dict], lines:list[dict]) -> dict:
+    from fitz import Rect
+    paragraph_spans = []
+    paragraph_text = []
+    for span_idx, span in enumerate(block["spans"]):
+        text = " ".join(span["text"].split())
+        if span_idx > 0:
+            write(" ")
+        line_span = write(text)
+        paragraph_spans.append(line_span)
+        paragraph_text.append(text)
+        lines.append({ "content": text, "polygon": _polygon(Rect(span["bbox"])), "spans": [line_span] })
+
+        ## Split the span into words, dividing the span's box by the number of characters in each word
+        bbox = Rect(span["bbox"])
+        char_width = bbox.width / max(1, len(text))
+        word_offset = 0
+        for word in text.split(" "):
+            word_rect = Rect(bbox.x0 + word_offset * char_width, bbox.y0, bbox.x0 + (word_offset + len(word)) * char_width, bbox.y1)
+            words.append({ "content": word, "polygon": _polygon(word_rect), "confidence": 1.0, "span": { "offset": line_span["offset"] + word_offset, "length": len(word) } })
+            word_offset += len(word) + 1
+
+    start = paragraph_spans[0]["offset"]
+    end = paragraph_spans[-1]["offset"] + paragraph_spans[-1]["length"]
+    paragraph = {
+        "content": " ".join(paragraph_text),
+        "boundingRegions": [{ "pageNumber": page_number, "polygon": _polygon(block["rect"]) }],
+        "spans": [{ "offset": start, "length": end - start }]
+    }
+    if role is not None:
+        paragraph["role"] = role
+    return paragraph
@@ -0,0 +1,177 @@
+import time
+import threading
+from contextlib import contextmanager
+
+class ParseMetrics:
+    """
+    Timings + counters collected while parsing a document (or, once merged, a whole run of documents).
+
+    Stage times are the total time spent in each stage, summed over every thread, so a stage that runs
+    in parallel (eg. describing the figures) can add up to more than the wall time of the parse.
+    """
+    wall_seconds:float = None                   # The wall time of the parse
+    stage_seconds:dict[str, float] = None       # The total time spent in each stage (analysis, render, describe, ...)
+    counters:dict[str, int] = None              # Counts + sizes (cache hits/misses, llm retries, bytes uploaded, image bytes, ...)
+    llm_seconds:dict[str, list[float]] = None   # The latency of each LLM request, keyed by step (+ category), eg. 'classifier', 'detail', 'detail:table'
+    document_seconds:list[float] = None         # The wall time of each document that has been merged into these metrics
+    figures:list[dict] = None                   # The size of each rendered figure (page, figure, region, pixels, bytes, scale, format, trimmed), its local classification (category, confidence, preclassified) + the tokens of its context
+    gauges:dict[str, float] = None              # The latest value of things that go up + down, eg. the adaptive concurrency limit of each service
+    _lock:threading.Lock = None
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.stage_seconds = {}
+        self.counters = {}
+        self.llm_seconds = {}
+        self.document_seconds = []
+        self.figures = []
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage:str, seconds:float):
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def increment(self, counter:str, amount:int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def record_llm(self, step:str, seconds:float, category:str = None):
+        with self._lock:
+            self.llm_seconds.setdefault(step, []).append(seconds)
+            if category is not None:
+                self.llm_seconds.setdefault(f"{step}:{category}", []).append(seconds)
+
+    def set_gauge(self, gauge:str, value:float):
+        with self._lock:
+            self.gauges[gauge] = value
+
+    def record_figure(self, page_number:int, figure_id:int, region_idx:int, pixels:int, image_bytes:int, scale:float = None, image_format:str = None, trimmed:bool = False, category:str = None, confidence:float = None, preclassified:bool = False, context_tokens:int = None):
+        with self._lock:
+            self.figures.append({
+                "page": page_number,
+                "figure": figure_id,
+                "region": region_idx,
+                "pixels": pixels,
+                "bytes": image_bytes,
+                "scale": scale,
+                "format": image_format,
+                "trimmed": trimmed,
+                "category": category,
+                "confidence": confidence,
+                "preclassified": preclassified,
+                "context_tokens": context_tokens
+            })
+
+    def merge(self, other:'ParseMetrics'):
+        """
+        Add the timings + counters of another parse to these metrics.
+        """
+        with self._lock:
+            self.wall_seconds += other.wall_seconds
+            if len(other.document_seconds) > 0:
+                self.document_seconds.extend(other.document_seconds)
+            else:
+                self.document_seconds.append(other.wall_seconds)
+            for stage, seconds in other.stage_seconds.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            for counter, amount in other.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+            for key, latencies in other.llm_seconds.items():
+                self.llm_seconds.setdefault(key, []).extend(latencies)
+            self.figures.extend(other.figures)
+            self.gauges.update(other.gauges)
+
+    def summary(self) -> dict:
+        """
+        :return: The stage times + counters, along with the count, mean, p50, p95 + max latency of the documents and each kind of LLM request,
+                 the distribution of the size (bytes + pixels) of the rendered figures, of the confidence of the local classifier, and of the tokens of context sent with each figure.
+        """
+        with self._lock:
+            return {
+                "wall_seconds": self.wall_seconds,
+                "document_seconds": latency_summary(self.document_seconds),
+                "stage_seconds": dict(sorted(self.stage_seconds.items())),
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": dict(sorted(self.gauges.items())),
+                "llm_seconds": {key: latency_summary(latencies) for key, latencies in sorted(self.llm_seconds.items())},
+                "figure_bytes": latency_summary([figure["bytes"] for figure in self.figures]),
+                "figure_pixels": latency_summary([figure["pixels"] for figure in self.figures]),
+                "local_classifier_confidence": latency_summary([figure["confidence"] for figure in self.figures if figure.get("confidence", None) is not None]),
+                "figure_context_tokens": latency_summary([figure["context_tokens"] for figure in self.figures if figure.get("context_tokens", None) is not None])
+            }
+
+    def to_json(self):
+        with self._lock:
+            return {
+                "wall_seconds": self.wall_seconds,
+                "stage_seconds": dict(self.stage_seconds),
+                "counters": dict(self.counters),
+                "llm_seconds": {key: list(latencies) for key, latencies in self.llm_seconds.items()},
+                "document_seconds": list(self.document_seconds),
+                "figures": [dict(figure) for figure in self.figures],
+                "gauges": dict(self.gauges)
+            }
+
+    @staticmethod
+    def from_json(json:dict):
+        metrics = ParseMetrics()
+        metrics.wall_seconds = json.get("wall_seconds", 0.0)
+        metrics.stage_seconds = dict(json.get("stage_seconds", {}))
+        metrics.counters = dict(json.get("counters", {}))
+        metrics.llm_seconds = {key: list(latencies) for key, latencies in json.get("llm_seconds", {}).items()}
+        metrics.document_seconds = list(json.get("document_seconds", []))
+        metrics.figures = [dict(figure) for figure in json.get("figures", [])]
+        metrics.gauges = dict(json.get("gauges", {}))
+        return metrics
+
+
+def record_concurrency_limits(metrics:ParseMetrics):
+    """
+    Record the current limit (and requests in flight) of every adaptive concurrency controller as gauges, eg. 'concurrency_limit:llm:<endpoint>|<deployment>'.
+    """
+    from pdfparser.util.concurrency import concurrency_snapshot
+    for name, stats in concurrency_snapshot().items():
+        metrics.set_gauge(f"concurrency_limit:{name}", stats["limit"])
+        metrics.set_gauge(f"concurrency_in_flight:{name}", stats["in_flight"])
+
+
+def record_llm_pool(metrics:ParseMetrics, llm):
+    """
+    Record the requests, failures, ejections, fail overs + (cached) prompt tokens of each deployment in the LLM client's pool as gauges, eg. 'llm_pool_requests:<endpoint>|<deployment>'.
+    """
+    pool_stats = getattr(llm, "pool_stats", None)
+    if pool_stats is None:
+        return
+    for name, stats in pool_stats().items():
+        for stat in ["requests", "failures", "ejections", "failovers", "prompt_tokens", "cached_tokens"]:
+            metrics.set_gauge(f"llm_pool_{stat}:{name}", stats.get(stat, 0))
+
+
+def latency_summary(latencies:list[float]) -> dict:
+    """
+    :return: The count, mean, p50, p95 + max of the latencies (or any other values).
+    """
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) if len(ordered) > 0 else 0.0,
+        "p50": _percentile(ordered, 0.5),
+        "p95": _percentile(ordered, 0.95),
+        "max": ordered[-1] if len(ordered) > 0 else 0.0
+    }
+
+
+def _percentile(ordered:list[float], percentile:float) -> float:
+    if len(ordered) == 0:
+        return 0.0
+    idx = min(len(ordered) - 1, max(0, int(round(percentile * (len(ordered) - 1)))))
+    return ordered[idx]
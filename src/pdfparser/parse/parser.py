@@ -1,87 +1,398 @@
+import os
+import threading
+from contextlib import nullcontext
 from pathlib import Path
+from typing import Callable, Iterator
 from fitz import Page as FitzPage
-from .docintel import DocIntelAnalyser, DocIntelAnalysisPage, DocIntelAnalysis
-
-from pdfparser.util import LLMClient
+from .docintel import DocIntelAnalysisPage, DocIntelAnalysis, DocIntelAnalysisSpan
+from .pipeline import FigurePipeline, FigureJob, FigureResult
+from .render_policy import RenderPolicy
+from .triage import FigureTriage, text_coverage
+from .local_classifier import LocalClassifier, figure_signals
+from .batching import BatchConfig, FigureBatcher
+from .routing import ModelRouting
+from .context import ContextBuilder
+from .sections import SectionIndex
+from .image_cache import ImageDescriptionCache
+from .metrics import ParseMetrics, record_concurrency_limits, record_llm_pool
+from .incremental import RevisionPlan
+from .backends import LayoutAnalyser, VisionDescriber, create_layout_analyser, create_vision_describer
 from pdfparser.util import markdown as MarkdownUtils
+from pdfparser.util.cache import CacheBackend, create_cache_backend
+
+ANALYSIS_CACHE_NAMESPACE = "docintel-analysis"
+REVISION_CACHE_NAMESPACE = "docintel-revisions"
+
+## The stages reported to the `on_stage` callback of a parse
+STAGE_ANALYSED = "analysed"             # The layout analysis has been loaded (from the cache) or done
+STAGE_FIGURES_DONE = "figures_done"     # Every figure has been described, and the markdown assembled
 
 class ResultPage:
     page_number:int = None
     doc_page:DocIntelAnalysisPage = None
-    pdf_page:FitzPage = None
+    pdf_page:FitzPage = None            # NB: only usable during the parse, the PDF is closed once the parse is done
     xRatio:float = None
     yRatio:float = None
-    
+
 class ParseResult:
     markdown:str = None
     pages:list[ResultPage] = None
     images:list[Path] = None
     title:str = None
     analysis:DocIntelAnalysis = None
+    sections:SectionIndex = None        # The section index of the (analysis) markdown, eg. for chunking the markdown by section
+    metrics:ParseMetrics = None
+
+class ParseChunk:
+    page_number:int = None              # The (1-based) page number the chunk starts on
+    markdown:str = None                 # The markdown for the chunk, with the image descriptions already applied
+    span:DocIntelAnalysisSpan = None    # The offset + length of the chunk within the source (DocIntel) markdown
+    images:list[Path] = None            # The images extracted from the chunk
+    sections:SectionIndex = None        # The section index of the whole document's (source) markdown, shared by every chunk
 
 class PdfParser():
-    analyser:DocIntelAnalyser = None
-    llmclient:LLMClient = None
+    analyser:LayoutAnalyser = None
+    llm:VisionDescriber = None
     concurrency:int = None
     save_images:bool = None
+    stream_lookahead:int = None
+    write_concurrency:int = None
+    use_image_cache:bool = None
+    image_cache_phash_distance:int = None
+    incremental_analysis:bool = None
+    render_policy:RenderPolicy = None
+    figure_triage:FigureTriage = None
+    local_classifier:LocalClassifier = None
+    batch_config:BatchConfig = None
+    model_routing:ModelRouting = None
+    context_builder:ContextBuilder = None
+    _args:dict[str, str] = None
+    _cache_dir:Path = None
+    _cache_backends:dict[Path, CacheBackend] = None
+    _image_caches:dict[CacheBackend, ImageDescriptionCache] = None
+    _cache_lock:threading.Lock = None
 
-    def __init__(self, args:dict[str, str]):
-        self.analyser = DocIntelAnalyser(args)
-        self.llm = LLMClient(args) if args.get('use-llm', True) else None
+    def __init__(self, args:dict[str, str], analyser:LayoutAnalyser = None, llm:VisionDescriber = None):
+        """
+        :param analyser: The layout analyser to use, defaults to the one named by the '--analyser' arg (see `create_layout_analyser`).
+        :param llm: The vision describer to use, defaults to the one named by the '--describer' arg (see `create_vision_describer`).
+        """
+        self.analyser = analyser if analyser is not None else create_layout_analyser(args)
+        if llm is not None:
+            self.llm = llm
+        else:
+            self.llm = create_vision_describer(args) if args.get('use-llm', True) else None
         self.concurrency = int(args.get('concurrency', 0))
         self.save_images = args.get('save-images', True)
+        self.stream_lookahead = int(args.get('stream-lookahead', 0))
+        self.write_concurrency = int(args.get('write-concurrency', 2))
+        self.use_image_cache = args.get('image-cache', True) not in [False, "false", "False", "0"]
+        self.image_cache_phash_distance = int(args.get('image-cache-phash-distance', 0))
+        self.incremental_analysis = args.get('incremental-analysis', os.environ.get("INCREMENTAL_ANALYSIS", False)) not in [False, "false", "False", "0"]
+        self.render_policy = RenderPolicy(args)
+        self.batch_config = BatchConfig(args)
+        self.model_routing = ModelRouting(args)
+        self.context_builder = ContextBuilder(args)
+        self.figure_triage = FigureTriage(args) if args.get('figure-triage', os.environ.get("FIGURE_TRIAGE", True)) not in [False, "false", "False", "0"] else None
+        self.local_classifier = LocalClassifier(args) if args.get('local-classifier', os.environ.get("LOCAL_CLASSIFIER", True)) not in [False, "false", "False", "0"] else None
+        self._args = args
+        self._cache_dir = Path(args.get('cache-dir', os.environ.get("CACHE_DIR"))) if args.get('cache-dir', os.environ.get("CACHE_DIR")) is not None else None
+        self._cache_backends = {}
+        self._image_caches = {}
+        self._cache_lock = threading.Lock()
 
-    def parse(self, file:Path, analyse_images:bool = True, use_iterative_image_analyser:bool = True, verbose:bool = True):
-        import os
-        from concurrent.futures import ThreadPoolExecutor
-        from fitz import Pixmap, Matrix
+    def parse(self, file:Path, analyse_images:bool = True, use_iterative_image_analyser:bool = True, verbose:bool = True, on_stage:Callable[[str], None] = None) -> ParseResult:
+        import io
+        import time
+        start = time.perf_counter()
+        output_result = ParseResult()
+        output_result.metrics = ParseMetrics()
+
+        markdown = io.StringIO()
+        for chunk in self._parse_chunks(file, output_result, analyse_images, use_iterative_image_analyser, verbose, on_stage):
+            markdown.write(chunk.markdown)
+        output_result.markdown = markdown.getvalue()
+
+        ## Find the first header in the document
+        if verbose: print("  - Determining Title")
+        output_result.title = self._determine_title(file, output_result.analysis, output_result.markdown)
+        output_result.metrics.wall_seconds = time.perf_counter() - start
+        return output_result
+
+    def parse_stream(self, file:Path, analyse_images:bool = True, use_iterative_image_analyser:bool = True, verbose:bool = True, on_stage:Callable[[str], None] = None) -> Iterator[ParseChunk]:
+        """
+        Parse the document, yielding the markdown page by page as soon as the figures on each page have been described.
+        Joining the markdown of all the yielded chunks gives the same markdown as `parse`.
+        :param file: The path to the PDF to parse.
+        :param on_stage: Called with the name of each stage of the parse as it completes (STAGE_ANALYSED, STAGE_FIGURES_DONE).
+        :return: An iterator of ParseChunk, in document order.
+        """
+        yield from self._parse_chunks(file, ParseResult(), analyse_images, use_iterative_image_analyser, verbose, on_stage)
+
+    def _parse_chunks(self, file:Path, output_result:ParseResult, analyse_images:bool, use_iterative_image_analyser:bool, verbose:bool, on_stage:Callable[[str], None] = None) -> Iterator[ParseChunk]:
+        from collections import deque
         from fitz import open as FitzOpen
-        from .docintel import DocIntelAnalysis
 
         image_file_prefix = file.stem.replace(' ', '_')
-        file_folder = file.parent
-        image_folder = file_folder / "images"
-        if not image_folder.exists():
-            image_folder.mkdir(parents=True)
+        image_folder = self._image_folder(file)
+        if output_result.metrics is None: output_result.metrics = ParseMetrics()
+        metrics = output_result.metrics
+
+        ## Step 1: Analyse the document using Azure Document Intelligence
+        analysis = self._load_analysis(file, verbose, metrics)
+        if on_stage is not None: on_stage(STAGE_ANALYSED)
+
+        ## Save the analysis result to the output result
+        markdown = analysis.markdown
+        self._set_analysis(output_result, analysis)
+
+        ## Step 2: Go through each page and parse out the images and markdown
+        if verbose: print("  - Loading PDF")
+        pdf_document = None
+        batcher = None
+        try:
+            with metrics.time("load_pages"):
+                pdf_document = FitzOpen(file)
+                output_result.pages = self._load_pages(analysis, pdf_document)
+            assembler, chunk_figures = self._chunk_assembler(analysis, output_result, metrics)
+
+            max_workers = self._max_workers()
+            lookahead = self.stream_lookahead if self.stream_lookahead > 0 else max_workers * 2
+            image_cache = self._image_cache(file) if self._describes_images(analyse_images) else None
+            batcher = self._figure_batcher(FigureBatcher, analyse_images, use_iterative_image_analyser, metrics)
+            describe = lambda job: self._describe_image(job, image_cache, use_iterative_image_analyser, verbose, metrics, batcher)
+            with FigurePipeline(describe, describe_workers=max_workers, write_workers=self.write_concurrency, verbose=verbose, metrics=metrics) as pipeline:
+                ## Figures are submitted ahead of the chunk being emitted, up to the lookahead limit
+                pending = deque()   # (chunk_idx, figure_replacements, [futures])
+                in_flight = 0
+                next_figure_chunk = 0
+                next_figure_idx = 0
+
+                def submit_more(min_chunk_idx:int):
+                    nonlocal in_flight, next_figure_chunk, next_figure_idx
+                    while next_figure_chunk < len(chunk_figures):
+                        figures = chunk_figures[next_figure_chunk]
+                        if next_figure_idx >= len(figures):
+                            next_figure_chunk += 1
+                            next_figure_idx = 0
+                            continue
+                        if in_flight >= lookahead and next_figure_chunk > min_chunk_idx:
+                            break
+                        idx, figure, figure_replacements = figures[next_figure_idx]
+                        next_figure_idx += 1
+                        jobs = self._figure_jobs(idx, figure, output_result, markdown, image_folder, image_file_prefix, analyse_images, image_cache)
+                        futures = [pipeline.submit(job) for job in jobs]
+                        pending.append((next_figure_chunk, figure_replacements, futures))
+                        in_flight += len(futures)
+
+                if verbose and analysis.figures: print("  - Analysing Images...")
+                for chunk_idx in range(assembler.chunk_count()):
+                    submit_more(chunk_idx)
+
+                    ## Wait for the figures in this chunk to be rendered + described
+                    while len(pending) > 0 and pending[0][0] <= chunk_idx:
+                        _, figure_replacements, futures = pending.popleft()
+                        for future in futures:
+                            in_flight -= 1
+                            assembler.add(future.result(), figure_replacements)
+
+                    chunk = assembler.chunk(chunk_idx)
+                    if chunk is not None:
+                        yield chunk
+        finally:
+            ## Also runs if the consumer stopped iterating early, or a figure failed (the pipeline has been shut down by now, so nothing is still rendering)
+            if batcher is not None: batcher.close()
+            if pdf_document is not None: pdf_document.close()
+            record_concurrency_limits(metrics)
+            record_llm_pool(metrics, self.llm)
+        if on_stage is not None: on_stage(STAGE_FIGURES_DONE)
+
+    def _image_folder(self, file:Path) -> Path:
+        image_folder = file.parent / "images"
+        image_folder.mkdir(parents=True, exist_ok=True)    ## Several documents in the same folder may be parsed at once
         if not image_folder.is_dir():
             raise Exception(f"Image folder '{image_folder}' is not a directory.")
+        return image_folder
 
-        output_result = ParseResult()
+    def _plan_chunks(self, analysis:DocIntelAnalysis, output_result:ParseResult) -> tuple[list[tuple[int, int, int]], list[list[tuple]], MarkdownUtils.MarkdownSplicer]:
+        ## Work out which chunk (page) each figure belongs to, and register the figure replacements with the splicer
+        from bisect import bisect_right
+        markdown = analysis.markdown
+        page_ranges = analysis.page_ranges()
+        range_starts = [start for _, start, _ in page_ranges]
+        chunk_figures = [[] for _ in page_ranges]
+        splicer = MarkdownUtils.MarkdownSplicer(markdown)
+        if analysis.figures and len(analysis.figures) > 0:
+            output_result.images = []
+            for idx, figure in enumerate(analysis.figures):
+                figure_replacements = self._figure_replacements(markdown, figure, idx)
+                for rep in figure_replacements:
+                    splicer.add(rep["start"], rep["end"], lambda rep=rep: self._format_replacement(rep))
+                if len(figure.spans) > 0:
+                    chunk_idx = max(0, bisect_right(range_starts, figure.spans[0].offset) - 1)
+                else:
+                    chunk_idx = 0
+                chunk_figures[chunk_idx].append((idx, figure, figure_replacements))
+        return page_ranges, chunk_figures, splicer
 
-        ## Step 1: Analyse the document using Azure Document Intelligence
-        cached_analysis = file_folder / f"{file.stem}.analysis.json"
-        analysis = None
-        if cached_analysis.exists():
-            if verbose: print(f" - Loading cached analysis from '{cached_analysis}'")
-            with open(cached_analysis, "r", encoding="utf-8") as f:
-                json_data = f.read()
-                if len(json_data) > 0:
-                    try:
-                        import json
-                        analysis = DocIntelAnalysis.from_json(json.loads(json_data))
-                    except Exception as e:
-                        print(f"Error loading cached analysis, will fallback to re-analysing the document. Error: {e}")
-                        analysis = None
-        
+    def _chunk_assembler(self, analysis:DocIntelAnalysis, output_result:ParseResult, metrics:ParseMetrics) -> tuple["_ChunkAssembler", list[list[tuple]]]:
+        ## :return: The assembler of the chunks, and the (idx, figure, figure replacements) of the figures in each chunk
+        page_ranges, chunk_figures, splicer = self._plan_chunks(analysis, output_result)
+        return _ChunkAssembler(self, splicer, page_ranges, output_result, metrics), chunk_figures
+
+    def _set_analysis(self, output_result:ParseResult, analysis:DocIntelAnalysis):
+        output_result.analysis = analysis
+        output_result.sections = SectionIndex(analysis.markdown, analysis)
+
+    def _describes_images(self, analyse_images:bool) -> bool:
+        return analyse_images and self.llm is not None
+
+    def _figure_batcher(self, batcher_class:type, analyse_images:bool, use_iterative_image_analyser:bool, metrics:ParseMetrics):
+        ## :param batcher_class: FigureBatcher or AsyncFigureBatcher
+        ## :return: The batcher of the figures, or None if they aren't batched
+        if not self._describes_images(analyse_images) or not self.batch_config.is_enabled():
+            return None
+        return batcher_class(self.batch_config, self.llm, use_iterative_image_analyser, metrics, self.model_routing)
+
+    def _max_workers(self) -> int:
+        if self.concurrency > 0:
+            return self.concurrency
+        ## With adaptive concurrency, the LLM client's controllers limit the requests in flight, so the pool must not be the bottleneck
+        max_concurrency = getattr(self.llm, "max_concurrency", None)
+        if max_concurrency is not None:
+            return max_concurrency
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    def _apply_figure_result(self, figure_result:FigureResult, figure_replacements:list[dict], output_result:ParseResult, chunk_images:list[Path]):
+        if figure_result.skip:
+            ## Drop the figure, unless another of its regions was kept
+            for rep in figure_replacements:
+                rep.setdefault("skip", True)
+            return
+        if figure_result.image_path is None: return
+        chunk_images.append(figure_result.image_path)
+        output_result.images.append(figure_result.image_path)
+        for rep in figure_replacements:
+            rep["skip"] = False
+        if figure_result.description is not None and len(figure_replacements) > 0:
+            figure_replacements[0]["description"] = figure_result.description
+            figure_replacements[0]["image_name"] = figure_result.image_name
+
+    def _build_chunk(self, splicer:MarkdownUtils.MarkdownSplicer, page_number:int, start:int, end:int, images:list[Path]) -> ParseChunk:
+        ## Apply the image replacements in a single pass over the page (a figure that runs over the end of the page is kept whole within this chunk)
+        import io
+        chunk_markdown = io.StringIO()
+        chunk_end = splicer.write(chunk_markdown, start, end)
+
+        chunk = ParseChunk()
+        chunk.page_number = page_number
+        chunk.markdown = chunk_markdown.getvalue()
+        chunk.span = DocIntelAnalysisSpan()
+        chunk.span.offset = start
+        chunk.span.length = max(0, chunk_end - start)
+        chunk.images = images
+        return chunk
+
+    def _load_analysis(self, file:Path, verbose:bool, metrics:ParseMetrics = None) -> DocIntelAnalysis:
+        analysis, cache, cache_key = self._load_cached_analysis(file, verbose, metrics)
         if analysis is None:
-            if verbose: print(f" - Analysing PDF and saving to '{cached_analysis}'")
-            analysis = self.analyser.analyse(file)
-            with open(cached_analysis, "w", encoding="utf-8") as f:
-                import json
-                f.write(json.dumps(analysis.to_json(), indent=4))
+            revision = self._plan_revision(file, cache, verbose, metrics)
+            if revision is not None and revision.is_incremental():
+                ## Only analyse the pages that changed since the previous revision of the document
+                changed_analysis = None
+                if len(revision.changed) > 0:
+                    if verbose: print(f" - Analysing {len(revision.changed)} changed pages of PDF '{file}'")
+                    if metrics is not None: metrics.increment("analysis_bytes_uploaded", file.stat().st_size)
+                    with metrics.time("analysis") if metrics is not None else nullcontext():
+                        changed_analysis = self.analyser.analyse(file, pages=revision.changed)
+                analysis = self._stitch_revision(revision, changed_analysis, metrics)
+            else:
+                if verbose: print(f" - Analysing PDF '{file}'")
+                if metrics is not None: metrics.increment("analysis_bytes_uploaded", file.stat().st_size)
+                with metrics.time("analysis") if metrics is not None else nullcontext():
+                    analysis = self.analyser.analyse(file)
+            self._store_analysis(cache, cache_key, analysis)
+            self._store_revision(cache, file, cache_key, revision)
 
         if not analysis:
             raise Exception(f"Error analysing PDF file '{file}'. No analysis result returned.")
-        
-        ## Save the analysis result to the output result
-        output_result.markdown = analysis.markdown
-        output_result.analysis = analysis
+        return analysis
 
-        ## Step 2: Go through each page and parse out the images and markdown
-    
-        if verbose: print("  - Loading PDF")
-        pdf_document = FitzOpen(file)
-        output_result.pages = []
+    def _load_cached_analysis(self, file:Path, verbose:bool, metrics:ParseMetrics = None) -> tuple[DocIntelAnalysis, CacheBackend, str]:
+        import json
+        import time
+        start = time.perf_counter()
+        cache = self._cache_backend(file)
+        cache_key = self.analyser.cache_key(file) if cache is not None else None
+        analysis = None
+        if cache is not None:
+            json_data = cache.get_text(ANALYSIS_CACHE_NAMESPACE, cache_key)
+            if json_data is not None and len(json_data) > 0:
+                if verbose: print(f" - Loading cached analysis '{cache_key}'")
+                try:
+                    analysis = DocIntelAnalysis.from_json(json.loads(json_data))
+                except Exception as e:
+                    print(f"Error loading cached analysis, will fallback to re-analysing the document. Error: {e}")
+                    analysis = None
+
+        ## NB: The (legacy) '<name>.analysis.json' file next to the PDF is not read, it is keyed by the file name, so it may be the analysis of an older revision of the document
+        if metrics is not None:
+            metrics.add_time("analysis_cache", time.perf_counter() - start)
+            metrics.increment("analysis_cache_hits" if analysis is not None else "analysis_cache_misses")
+        return analysis, cache, cache_key
+
+    def _store_analysis(self, cache:CacheBackend, cache_key:str, analysis:DocIntelAnalysis):
+        import json
+        if analysis and cache is not None:
+            cache.put_text(ANALYSIS_CACHE_NAMESPACE, cache_key, json.dumps(analysis.to_json()))
+
+    def _plan_revision(self, file:Path, cache:CacheBackend, verbose:bool, metrics:ParseMetrics = None) -> RevisionPlan:
+        ## Fingerprint the pages, and match them against the pages of the previous revision of the document (if it was analysed before)
+        import json
+        from .incremental import page_fingerprints
+        if not self.incremental_analysis or cache is None:
+            return None
+        with metrics.time("fingerprint") if metrics is not None else nullcontext():
+            fingerprints = page_fingerprints(file)
+        previous = None
+        previous_fingerprints = None
+        try:
+            record = cache.get_text(REVISION_CACHE_NAMESPACE, self._revision_key(file))
+            if record is not None:
+                record = json.loads(record)
+                previous_json = cache.get_text(ANALYSIS_CACHE_NAMESPACE, record.get("analysis_key", ""))
+                if previous_json is not None:
+                    previous = DocIntelAnalysis.from_json(json.loads(previous_json))
+                    previous_fingerprints = record.get("fingerprints", None)
+        except Exception as e:
+            print(f"Error loading the previous revision of the document, will fallback to analysing the whole document. Error: {e}")
+            previous = None
+        revision = RevisionPlan(fingerprints, previous, previous_fingerprints)
+        if revision.is_incremental():
+            if verbose: print(f" - Reusing the analysis of {len(revision.reused)} unchanged pages from the previous revision")
+            if metrics is not None:
+                metrics.increment("analysis_pages_reused", len(revision.reused))
+                metrics.increment("analysis_pages_changed", len(revision.changed))
+        return revision
+
+    def _stitch_revision(self, revision:RevisionPlan, changed_analysis:DocIntelAnalysis, metrics:ParseMetrics = None) -> DocIntelAnalysis:
+        from .incremental import stitch_analysis
+        with metrics.time("stitch") if metrics is not None else nullcontext():
+            return stitch_analysis(revision, changed_analysis)
+
+    def _store_revision(self, cache:CacheBackend, file:Path, cache_key:str, revision:RevisionPlan):
+        ## Remember the fingerprints of this revision of the document, so the next revision only needs its changed pages analysed
+        import json
+        if revision is not None and cache is not None:
+            cache.put_text(REVISION_CACHE_NAMESPACE, self._revision_key(file), json.dumps({ "analysis_key": cache_key, "fingerprints": revision.fingerprints }))
+
+    def _revision_key(self, file:Path) -> str:
+        ## Revisions of a document are tracked by its path, as the content (and so the analysis cache key) changes with each revision
+        import hashlib
+        return hashlib.sha256(str(Path(file).resolve()).encode("utf-8")).hexdigest()
+
+    def _load_pages(self, analysis:DocIntelAnalysis, pdf_document) -> list[ResultPage]:
+        pages = []
         for page in analysis.pages:
             pdfpage = pdf_document.load_page(page.page_number - 1)
             xRatio = (pdfpage.rect.x1 - pdfpage.rect.x0) / page.width
@@ -92,157 +403,228 @@ class PdfParser():
             result_page.pdf_page = pdfpage
             result_page.xRatio = xRatio
             result_page.yRatio = yRatio
-            output_result.pages.append(result_page)
-            
-        with ThreadPoolExecutor(max_workers=self.concurrency if self.concurrency > 0 else None) as executor:
-            futures = []
-            replacements = []
-            if analysis.figures and len(analysis.figures) > 0:
-                output_result.images = []
-                for idx, figure in enumerate(analysis.figures):
-                    for span in figure.spans:
-                        # print(f"  Span: {span.offset} ({span.length}) [In MD: {markdown[span.offset:span.offset+span.length]}]")
-                        figure_content = output_result.markdown[span.offset:span.offset+span.length]
-                        caption_start = 0
-                        if '<figure>' in figure_content:
-                            caption_start = figure_content.find('<figure>') + len('<figure>')
-                        elif '<figcaption>' in figure_content:
-                            caption_start = figure_content.find('<figcaption>') + len('<figcaption>')
-                        
-                        caption_end = -1
-                        if '</figure>' in figure_content:
-                            caption_end = figure_content.find('</figure>')
-                        elif '</figcaption>' in figure_content:
-                            caption_end = figure_content.find('</figcaption>')
-                        if caption_start == -1 or caption_end == -1:
-                            caption_start = 0
-                            caption_end = len(figure_content)
-                        if caption_start > caption_end:
-                            caption_start = 0
-                            caption_end = len(figure_content)
-                        if caption_start == -1:
-                            caption_start = 0
-                        if caption_end == -1:
-                            caption_end = len(figure_content)
-                        caption = figure_content[caption_start:caption_end]
-                        replacements.append({
-                            "content": caption.strip().replace("\\n", " "),
-                            "start": span.offset,
-                            "end": span.offset+span.length,
-                            "figure_id": idx,
-                            "description": "<!-- No description available -->",
-                            "image_name": ""
-                        })
-
-                    for region_idx,region in enumerate(figure.bounding_regions):
-                        try:
-                            page_info = output_result.pages[region.page_number-1]
-                            xRatio = page_info.xRatio
-                            yRatio = page_info.yRatio
-                            pdf_page = page_info.pdf_page
-                            x0 = region.polygon[0] * xRatio
-                            y0 = region.polygon[1] * yRatio
-                            x1 = region.polygon[4] * xRatio
-                            y1 = region.polygon[5] * yRatio
-                            image_name = f"{image_file_prefix}_{region.page_number}_{idx}_{region_idx}.png"
-                            if verbose: print(f"  - Extracting image: {image_name}")
-                            pix = pdf_page.get_pixmap(clip=[x0, y0, x1, y1], matrix=Matrix(2, 2))
-                            img_path = os.path.join(image_folder, image_name)
-                            if self.save_images:
-                                if verbose: print(f"  - Saving image to '{img_path}'")
-                                pix.save(img_path)
-                            output_result.images.append(Path(img_path))
-                            image_bytes = pix.tobytes("png")
-
-                            if analyse_images and self.llm is not None:
-                                section_name = MarkdownUtils.determine_section_name_at_offset(output_result.markdown, span.offset)
-                                prior_context = MarkdownUtils.find_prior_context(output_result.markdown, span.offset)
-                                post_context = MarkdownUtils.find_post_context(output_result.markdown, span.offset+span.length)
-                                cached_image_analysis_file = image_folder / f"{image_file_prefix}_{region.page_number}_{idx}_{region_idx}.analysis.json"
-                                def describe_image(image_bytes, figure_id, llm, section_name, prior_context, post_context, image_name, cached_image_analysis_file):
-                                    from .image_analysis import analyse_image_data, analyse_image_data_iteratively
-                                    try:
-                                        image_analysis = None
-                                        if cached_image_analysis_file.exists():
-                                            if verbose: print(f" - Loading cached image analysis from '{cached_image_analysis_file}'")
-                                            with open(cached_image_analysis_file, "r", encoding="utf-8") as f:
-                                                json_data = f.read()
-                                                if len(json_data) > 0:
-                                                    try:
-                                                        import json
-                                                        image_analysis = json.loads(json_data)
-                                                    except Exception as e:
-                                                        print(f"Error loading cached image analysis, will fallback to re-analysing the image. Error: {e}")
-                                                        image_analysis = None
-                                        
-                                        if image_analysis is None:
-                                            if use_iterative_image_analyser:
-                                                result = analyse_image_data_iteratively(image_bytes, "png", llm, section_name=section_name, prior_context=prior_context, post_context=post_context)
-                                            else: 
-                                                result = analyse_image_data(image_bytes, "png", llm, section_name=section_name, prior_context=prior_context, post_context=post_context)
-                                            
-                                            if result is not None: 
-                                                with open(cached_image_analysis_file, "w", encoding="utf-8") as f:
-                                                    import json
-                                                    f.write(json.dumps({
-                                                        "description": result,
-                                                        "section_name": section_name,
-                                                        "prior_context": prior_context,
-                                                        "post_context": post_context
-                                                    }, indent=4))
-                                        else:
-                                            result = image_analysis.get("description", "<!-- No description available -->")
-                                    except Exception as e:
-                                        result = "<!-- There was an error analysing the image -->"
-                                        print(f"Error analysing image: {e}")
-                                    return (figure_id, result, image_name)
-                                
-                                futures.append(executor.submit(describe_image, image_bytes, figure_id=idx, llm=self.llm, section_name=section_name, prior_context=prior_context, post_context=post_context, image_name=image_name, cached_image_analysis_file=cached_image_analysis_file))
-                        except Exception as e:
-                            print(f"Error processing region {region_idx} of figure {idx} in pdf {file.stem}: {e}")
-                            continue
-                    
-            ## Wait for all futures to complete1
-            if verbose: print("  - Analysing Images...")
-            for future in futures:
-                figure_id, desc, image_name = future.result()
-                for rep in replacements:
-                    if rep["figure_id"] == figure_id:
-                        rep["description"] = desc
-                        rep["image_name"] = image_name
-                        break
-            
-            # Sort the replacements in reverse order of start index (to avoid messing up the indexes as we apply the replacements)
-            replacements.sort(key=lambda x: x["start"], reverse=True)
-
-            # Replace the content in the markdown
-            if verbose: print("  - Applying image replacements")
-            for rep in replacements:
-                output_result.markdown = output_result.markdown[:rep["start"]] + "<!-- Start of description of image at this position in the source document -->\n\n<!-- Image Path: " + rep["image_name"] + " -->\n\n**Caption:** " + rep["content"] + "\n\n**Description:** " + rep["description"] + "\n<!-- End of Image Description -->" + output_result.markdown[rep["end"]:]
+            pages.append(result_page)
+        return pages
 
-        ## Find the first header in the document
-        if verbose: print("  - Determining Title")
+    def _figure_replacements(self, markdown:str, figure, figure_id:int) -> list[dict]:
+        replacements = []
+        for span in figure.spans:
+            # print(f"  Span: {span.offset} ({span.length}) [In MD: {markdown[span.offset:span.offset+span.length]}]")
+            figure_content = markdown[span.offset:span.offset+span.length]
+            caption_start = 0
+            if '<figure>' in figure_content:
+                caption_start = figure_content.find('<figure>') + len('<figure>')
+            elif '<figcaption>' in figure_content:
+                caption_start = figure_content.find('<figcaption>') + len('<figcaption>')
+
+            caption_end = -1
+            if '</figure>' in figure_content:
+                caption_end = figure_content.find('</figure>')
+            elif '</figcaption>' in figure_content:
+                caption_end = figure_content.find('</figcaption>')
+            if caption_start == -1 or caption_end == -1:
+                caption_start = 0
+                caption_end = len(figure_content)
+            if caption_start > caption_end:
+                caption_start = 0
+                caption_end = len(figure_content)
+            if caption_start == -1:
+                caption_start = 0
+            if caption_end == -1:
+                caption_end = len(figure_content)
+            caption = figure_content[caption_start:caption_end]
+            replacements.append({
+                "content": caption.strip().replace("\\n", " "),
+                "start": span.offset,
+                "end": span.offset+span.length,
+                "figure_id": figure_id,
+                "description": "<!-- No description available -->",
+                "image_name": ""
+            })
+        return replacements
+
+    def _format_replacement(self, rep:dict) -> str:
+        if rep.get("skip", False):
+            return rep["content"] + "\n" if len(rep["content"]) > 0 else ""   ## A triaged figure, keep its caption (if any) as plain text
+        return "<!-- Start of description of image at this position in the source document -->\n\n<!-- Image Path: " + rep["image_name"] + " -->\n\n**Caption:** " + rep["content"] + "\n\n**Description:** " + rep["description"] + "\n<!-- End of Image Description -->"
+
+    def _figure_jobs(self, idx:int, figure, output_result:ParseResult, markdown:str, image_folder:Path, image_file_prefix:str, analyse_images:bool, image_cache:ImageDescriptionCache = None) -> list[FigureJob]:
+        jobs = []
+        for region_idx,region in enumerate(figure.bounding_regions):
+            try:
+                page_info = output_result.pages[region.page_number-1]
+                xRatio = page_info.xRatio
+                yRatio = page_info.yRatio
+                job = FigureJob()
+                job.figure_id = idx
+                job.region_idx = region_idx
+                job.page_number = region.page_number
+                job.pdf_page = page_info.pdf_page
+                x0 = region.polygon[0] * xRatio
+                y0 = region.polygon[1] * yRatio
+                x1 = region.polygon[4] * xRatio
+                y1 = region.polygon[5] * yRatio
+                job.clip = [x0, y0, x1, y1]
+                job.render_policy = self.render_policy
+                if self.figure_triage is not None:
+                    job.triage = self.figure_triage
+                    job.text_coverage = text_coverage(page_info.doc_page.words, region.polygon) if page_info.doc_page is not None else None
+                job.image_name = f"{image_file_prefix}_{region.page_number}_{idx}_{region_idx}.png"
+                job.image_path = image_folder / job.image_name
+                job.save_image = self.save_images
+                job.compute_phash = image_cache is not None and self.image_cache_phash_distance > 0
 
+                if self._describes_images(analyse_images):
+                    span = figure.spans[-1]
+                    job.describe = True
+                    context = self.context_builder.build(markdown, span.offset, span.offset+span.length, output_result.sections)
+                    job.section_name = context.section_name
+                    job.prior_context = context.prior_context
+                    job.post_context = context.post_context
+                    job.context_tokens = context.tokens
+                    job.context_truncated = context.truncated
+                    if self.local_classifier is not None and page_info.doc_page is not None:
+                        job.local_classifier = self.local_classifier
+                        job.signals = figure_signals(page_info.doc_page, output_result.analysis.tables if output_result.analysis is not None else None, region.polygon)
+                jobs.append(job)
+            except Exception as e:
+                print(f"Error processing region {region_idx} of figure {idx}: {e}")
+                continue
+        return jobs
+
+    def _cache_backend(self, file:Path) -> CacheBackend:
+        ## Unless a cache dir is configured, the cache lives in a '.cache' folder next to the PDF (shared by all PDFs in that folder)
+        cache_dir = self._cache_dir if self._cache_dir is not None else file.parent / ".cache"
+        with self._cache_lock:
+            if cache_dir not in self._cache_backends:
+                self._cache_backends[cache_dir] = create_cache_backend(self._args, cache_dir)
+            return self._cache_backends[cache_dir]
+
+    def _image_cache(self, file:Path) -> ImageDescriptionCache:
+        ## The image cache is shared by every document parsed by this parser that uses the same cache backend
+        if not self.use_image_cache:
+            return None
+        backend = self._cache_backend(file)
+        if backend is None:
+            return None
+        with self._cache_lock:
+            if backend not in self._image_caches:
+                self._image_caches[backend] = ImageDescriptionCache(backend, self.image_cache_phash_distance)
+            return self._image_caches[backend]
+
+    def _image_variant(self, use_iterative_image_analyser:bool) -> str:
+        from .image_analysis import prompt_version
+        variant = f"{self.llm.model}|{'iterative' if use_iterative_image_analyser else 'single'}|{prompt_version()}"
+        if use_iterative_image_analyser and self.model_routing.is_enabled():
+            variant += f"|{self.model_routing.variant()}"
+        if use_iterative_image_analyser and self.model_routing.detail_context:
+            variant += "|detail-context"
+        return variant
+
+    def _analyse_image(self, job:FigureJob, use_iterative_image_analyser:bool, metrics:ParseMetrics, analysers:tuple):
+        ## :param analysers: The (single step, iterative) image analysis functions
+        ## :return: The description of the image (a coroutine, for the async analysis functions)
+        analysis_args = { "section_name": job.section_name, "prior_context": job.prior_context, "post_context": job.post_context, "metrics": metrics }
+        if use_iterative_image_analyser:
+            return analysers[1](job.image_bytes, job.image_format, self.llm, routing=self.model_routing, category=job.category, **analysis_args)
+        return analysers[0](job.image_bytes, job.image_format, self.llm, **analysis_args)
+
+    def _record_image_cache(self, job:FigureJob, cache_hit:bool, verbose:bool, metrics:ParseMetrics = None):
+        if metrics is not None: metrics.increment("image_cache_hits" if cache_hit else "image_cache_misses")
+        if cache_hit and verbose: print(f" - Using cached description for image '{job.image_name}'")
+
+    def _image_error(self, error:Exception, metrics:ParseMetrics = None) -> str:
+        ## The figure is kept (without a description) rather than failing the document
+        if metrics is not None: metrics.increment("image_errors")
+        print(f"Error analysing image: {error}")
+        return "<!-- There was an error analysing the image -->"
+
+    def _describe_image(self, job:FigureJob, image_cache:ImageDescriptionCache, use_iterative_image_analyser:bool, verbose:bool, metrics:ParseMetrics = None, batcher:FigureBatcher = None) -> str:
+        from .image_analysis import analyse_image_data, analyse_image_data_iteratively
+
+        ## NB: The (legacy) '<image>.analysis.json' file of each figure is not read, it is keyed by the figure's position (not its content), so it may be the description of another figure
+        def analyse():
+            if batcher is not None:
+                return batcher.describe(job)
+            return self._analyse_image(job, use_iterative_image_analyser, metrics, (analyse_image_data, analyse_image_data_iteratively))
+
+        try:
+            with metrics.time("describe") if metrics is not None else nullcontext():
+                if image_cache is None:
+                    return analyse()
+                result, cache_hit = image_cache.get_or_compute(job.image_bytes, self._image_variant(use_iterative_image_analyser), analyse, job.phash)
+            self._record_image_cache(job, cache_hit, verbose, metrics)
+            return result
+        except Exception as e:
+            return self._image_error(e, metrics)
+
+    def _determine_title(self, file:Path, analysis:DocIntelAnalysis, markdown:str) -> str:
         ## Option 1: Look through the paragraphs list for any with a role of "title"
         title = None
-        
+
         for para in analysis.paragraphs:
             if para.role == "title":
                 title = para.content
                 break
 
-        ## Option 2: Look for the first header in the markdown  
+        ## Option 2: Look for the first header in the markdown
         if title is None:
-            first_header = output_result.markdown.find("\n# ")
+            first_header = markdown.find("\n# ")
             if first_header != -1:
-                first_header_end = output_result.markdown.find("\n", first_header + 2)
+                first_header_end = markdown.find("\n", first_header + 2)
                 if first_header_end == -1:
-                    first_header_end = len(output_result.markdown)
-                title = output_result.markdown[first_header + 2:first_header_end].strip()
+                    first_header_end = len(markdown)
+                title = markdown[first_header + 2:first_header_end].strip()
 
         ## Option 3: Use the filename as the title
         if title is None:
             title = file.stem
 
-        output_result.title = title
-        return output_result
\ No newline at end of file
+        return title
+
+
+class _ChunkAssembler:
+    """
+    Assembles the chunks (pages) of a parse in document order, as the results of their figures come in.
+    Shared by the sync + async parse loops, which only differ in how they wait for the figures.
+    """
+    _parser:PdfParser = None
+    _splicer:MarkdownUtils.MarkdownSplicer = None
+    _page_ranges:list[tuple[int, int, int]] = None
+    _output_result:ParseResult = None
+    _metrics:ParseMetrics = None
+    _cursor:int = 0
+    _images:list[Path] = None
+
+    def __init__(self, parser:PdfParser, splicer:MarkdownUtils.MarkdownSplicer, page_ranges:list[tuple[int, int, int]], output_result:ParseResult, metrics:ParseMetrics):
+        self._parser = parser
+        self._splicer = splicer
+        self._page_ranges = page_ranges
+        self._output_result = output_result
+        self._metrics = metrics
+        self._images = []
+
+    def chunk_count(self) -> int:
+        return len(self._page_ranges)
+
+    def add(self, figure_result:FigureResult, figure_replacements:list[dict]):
+        """
+        Apply the result of a figure of the current chunk.
+        """
+        self._parser._apply_figure_result(figure_result, figure_replacements, self._output_result, self._images)
+
+    def chunk(self, chunk_idx:int) -> ParseChunk:
+        """
+        Assemble the chunk, once the results of all of its figures have been added.
+        :return: The chunk, or None if the page was already written as part of a figure that ran over the end of the previous page.
+        """
+        page_number, _, end = self._page_ranges[chunk_idx]
+        if end <= self._cursor and chunk_idx < len(self._page_ranges) - 1:
+            return None
+
+        with self._metrics.time("assemble"):
+            chunk = self._parser._build_chunk(self._splicer, page_number, self._cursor, end, self._images)
+            chunk.sections = self._output_result.sections
+        self._cursor = max(self._cursor, chunk.span.offset + chunk.span.length)
+        self._images = []
+        return chunk
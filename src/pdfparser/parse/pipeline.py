@@ -0,0 +1,217 @@
+from pathlib import Path
+from typing import Callable
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from fitz import Page as FitzPage
+from .metrics import ParseMetrics
+from .render_policy import RenderPolicy, IMAGE_EXTENSIONS
+from .triage import FigureTriage, TRIAGE_ACTION_SKIP
+from .local_classifier import LocalClassifier, FigureSignals, LocalClassification
+
+class FigureJob:
+    figure_id:int = None
+    region_idx:int = None
+    page_number:int = None
+    pdf_page:FitzPage = None
+    clip:list[float] = None
+    image_name:str = None
+    image_path:Path = None
+    save_image:bool = False
+    describe:bool = False
+    section_name:str = None
+    prior_context:str = None
+    post_context:str = None
+    context_tokens:int = None   # The tokens of the section name + prior + post context
+    context_truncated:bool = False  # Whether the context was cut to fit its token budget
+    compute_phash:bool = False
+    render_policy:RenderPolicy = None   # How to render + encode the figure (the default policy if None)
+    triage:FigureTriage = None  # How to triage the figure before it is described (not triaged if None)
+    text_coverage:float = None  # The fraction of the figure's region that is covered by words
+    local_classifier:LocalClassifier = None     # How to classify the figure locally (the LLM classifies it if None)
+    signals:FigureSignals = None                # What the layout analysis found in the figure's region, for the local classifier
+    image_bytes:bytes = None    # The encoded image, populated by the render stage
+    image_format:str = None     # The format of the encoded image (png, jpeg or webp), populated by the render stage
+    phash:int = None            # The perceptual hash of the image, populated by the render stage (if compute_phash is set)
+    pixels:int = None           # The number of pixels in the rendered image, populated by the render stage
+    scale:float = None          # The scale the image was rendered at, populated by the render stage
+    trimmed:bool = False        # Whether margins were trimmed from the image, populated by the render stage
+    triage_reason:str = None    # Why the figure is not worth describing (None if it is), populated by the render stage
+    local_classification:LocalClassification = None     # The local classifier's best guess at the category, populated by the render stage
+    category:tuple[str, str] = None     # The (category, sub-category) of the figure if the local classifier is confident, populated by the render stage
+
+class FigureResult:
+    figure_id:int = None
+    image_name:str = None
+    image_path:Path = None      # None if the image could not be rendered
+    description:str = None      # None if the image was not described
+    triage_reason:str = None    # Why the figure was not described (None if it wasn't triaged)
+    skip:bool = False           # Whether the figure should be dropped from the markdown
+
+def render_figure(job:FigureJob):
+    """
+    Render the figure's region of the page, and encode it (once) into job.image_bytes, as set by the job's render policy.
+    If the image isn't encoded as PNG, the extension of job.image_name + job.image_path is changed to match.
+    """
+    policy = job.render_policy if job.render_policy is not None else RenderPolicy()
+    figure = policy.render(job.pdf_page, job.clip)
+    job.image_bytes = figure.image_bytes
+    job.image_format = figure.image_format
+    job.pixels = figure.width * figure.height
+    job.scale = figure.scale
+    job.trimmed = figure.trimmed
+    if figure.image_format != "png":
+        extension = IMAGE_EXTENSIONS[figure.image_format]
+        if job.image_name is not None: job.image_name = str(Path(job.image_name).with_suffix("." + extension))
+        if job.image_path is not None: job.image_path = Path(job.image_path).with_suffix("." + extension)
+    if job.triage is not None:
+        job.triage_reason = job.triage.classify(figure.pix, job.clip, job.text_coverage)
+    if job.local_classifier is not None and job.triage_reason is None:
+        job.local_classification = job.local_classifier.classify(job.signals, figure.pix)
+        if job.local_classifier.is_confident(job.local_classification):
+            job.category = (job.local_classification.category, job.local_classification.sub_category)
+    if job.compute_phash and job.triage_reason is None:
+        from .image_cache import perceptual_hash
+        job.phash = perceptual_hash(figure.pix)
+
+def write_figure(job:FigureJob):
+    try:
+        with open(job.image_path, "wb") as f:
+            f.write(job.image_bytes)
+    except Exception as e:
+        print(f"Error saving image '{job.image_path}': {e}")
+
+def apply_triage(job:FigureJob, result:FigureResult, metrics:ParseMetrics = None):
+    """
+    If the figure was triaged as not worth describing, don't describe it (and, when the triage action is 'skip', don't save it either).
+    """
+    if job.triage_reason is None:
+        return
+    job.describe = False
+    result.triage_reason = job.triage_reason
+    if job.triage.action == TRIAGE_ACTION_SKIP:
+        job.save_image = False
+        result.skip = True
+    else:
+        result.description = job.triage.note(job.triage_reason)
+    if metrics is not None:
+        metrics.increment("figures_triaged")
+        metrics.increment(f"figures_triaged:{job.triage_reason}")
+
+def record_render_metrics(metrics:ParseMetrics, job:FigureJob):
+    metrics.increment("images_rendered")
+    metrics.increment("image_bytes", len(job.image_bytes))
+    metrics.increment("image_pixels", job.pixels)
+    if job.trimmed: metrics.increment("images_trimmed")
+    if job.local_classifier is not None and job.triage_reason is None:
+        if job.category is not None:
+            metrics.increment("figures_preclassified")
+            metrics.increment(f"figures_preclassified:{job.category[0]}")
+        else:
+            metrics.increment("figures_preclassify_unsure")
+    if job.context_tokens is not None:
+        metrics.increment("context_tokens", job.context_tokens)
+        if job.context_truncated: metrics.increment("context_truncated")
+    guess = job.local_classification
+    metrics.record_figure(job.page_number, job.figure_id, job.region_idx, pixels=job.pixels, image_bytes=len(job.image_bytes), scale=job.scale, image_format=job.image_format, trimmed=job.trimmed,
+                          category=guess.category if guess is not None else None, confidence=guess.confidence if guess is not None else None, preclassified=job.category is not None, context_tokens=job.context_tokens)
+
+class FigurePipeline:
+    """
+    Runs the figures of a document through separate render, write and describe stages, each with their own workers.
+
+    Rendering + encoding happens on a single dedicated thread (MuPDF documents must not be used from multiple threads at once),
+    as soon as a figure has been encoded it is handed to the write and describe stages, so each figure's LLM request is sent
+    as soon as its own image is ready.
+    """
+    _render_executor:ThreadPoolExecutor = None
+    _write_executor:ThreadPoolExecutor = None
+    _describe_executor:ThreadPoolExecutor = None
+    _describe:Callable[[FigureJob], str] = None
+    _verbose:bool = False
+    _metrics:ParseMetrics = None
+
+    def __init__(self, describe:Callable[[FigureJob], str], describe_workers:int = None, write_workers:int = 2, verbose:bool = False, metrics:ParseMetrics = None):
+        self._describe = describe
+        self._verbose = verbose
+        self._metrics = metrics
+        self._render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="figure-render")
+        self._write_executor = ThreadPoolExecutor(max_workers=max(1, write_workers), thread_name_prefix="figure-write")
+        self._describe_executor = ThreadPoolExecutor(max_workers=describe_workers, thread_name_prefix="figure-describe")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ## If the pipeline is left early (eg. the consumer stopped iterating, or a figure failed), the figures still queued are dropped
+        self.shutdown(cancel_pending=exc_type is not None)
+
+    def shutdown(self, cancel_pending:bool = False):
+        """
+        :param cancel_pending: Drop the figures that haven't started a stage yet (the ones already in a stage are finished).
+        """
+        ## Shutdown in stage order, so that later stages have received all of their work
+        self._render_executor.shutdown(wait=True, cancel_futures=cancel_pending)
+        self._write_executor.shutdown(wait=True, cancel_futures=cancel_pending)
+        self._describe_executor.shutdown(wait=True, cancel_futures=cancel_pending)
+
+    def submit(self, job:FigureJob) -> Future:
+        """
+        Submit a figure to the pipeline.
+        :return: A future that resolves to a FigureResult once the figure has been rendered, saved and described.
+        """
+        result_future = Future()
+        self._render_executor.submit(self._render, job, result_future)
+        return result_future
+
+    def _render(self, job:FigureJob, result_future:Future):
+        result = FigureResult()
+        result.figure_id = job.figure_id
+        result.image_name = job.image_name
+        try:
+            if self._verbose: print(f"  - Extracting image: {job.image_name}")
+            with self._metrics.time("render") if self._metrics is not None else nullcontext():
+                render_figure(job)
+            result.image_name = job.image_name     ## The render may have changed the extension
+            if self._metrics is not None: record_render_metrics(self._metrics, job)
+            result.image_path = job.image_path
+            apply_triage(job, result, self._metrics)
+        except Exception as e:
+            if self._metrics is not None: self._metrics.increment("render_errors")
+            print(f"Error processing region {job.region_idx} of figure {job.figure_id}: {e}")
+            result_future.set_result(result)
+            return
+
+        stages = []
+        if job.save_image:
+            stages.append(self._write_executor.submit(self._write, job))
+        if job.describe:
+            stages.append(self._describe_executor.submit(self._describe_job, job, result))
+        if len(stages) == 0:
+            result_future.set_result(result)
+            return
+
+        ## Resolve the result once every stage for this figure has completed
+        import threading
+        remaining = [len(stages)]
+        lock = threading.Lock()
+        def on_stage_done(_):
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                job.image_bytes = None
+                result_future.set_result(result)
+        for stage in stages:
+            stage.add_done_callback(on_stage_done)
+
+    def _write(self, job:FigureJob):
+        if self._verbose: print(f"  - Saving image to '{job.image_path}'")
+        with self._metrics.time("write") if self._metrics is not None else nullcontext():
+            write_figure(job)
+
+    def _describe_job(self, job:FigureJob, result:FigureResult):
+        try:
+            result.description = self._describe(job)
+        except Exception as e:
+            result.description = "<!-- There was an error analysing the image -->"
+            print(f"Error analysing image: {e}")
@@ -0,0 +1,184 @@
+import os
+
+## The image formats a figure can be encoded as, and their file extensions
+IMAGE_EXTENSIONS = {
+    "png": "png",
+    "jpeg": "jpg",
+    "webp": "webp"
+}
+
+## With format 'auto', images with more distinct colours than this (in a sample of the pixels) are treated as photos + encoded lossily
+PHOTO_COLOUR_COUNT = 2048
+
+## Pixels within this distance (per channel) of the background colour count as background when trimming margins
+TRIM_TOLERANCE = 8
+
+## Images whose colour channels are all within this distance of each other are treated as grayscale
+GRAYSCALE_TOLERANCE = 8
+
+class RenderedFigure:
+    image_bytes:bytes = None    # The encoded image
+    image_format:str = None     # The format of the encoded image (png, jpeg or webp)
+    pix = None                  # The (trimmed) pixmap that was encoded
+    scale:float = None          # The scale the figure was rendered at
+    width:int = None
+    height:int = None
+    trimmed:bool = None         # Whether uniform margins were trimmed from the image
+    grayscale:bool = None       # Whether the image was encoded as grayscale
+
+class RenderPolicy:
+    """
+    How figures are rendered + encoded (args or ENV):
+        --render-max-scale=<n>              (RENDER_MAX_SCALE), the maximum scale to render figures at (default: 2, ie. 144 dpi)
+        --render-pixel-budget=<pixels>      (RENDER_PIXEL_BUDGET), the maximum number of pixels in a figure, larger figures are rendered
+                                            at a lower scale (default: 1048576, 0 = unlimited)
+        --render-trim=true|false            (RENDER_TRIM), trim uniform margins from the figures (default: false)
+        --render-format=png|jpeg|webp|auto  (RENDER_FORMAT), the image format, 'auto' uses JPEG for photos + PNG for everything else (default: png)
+        --render-jpeg-quality=<1-100>       (RENDER_JPEG_QUALITY), the quality of JPEG + WebP images (default: 85)
+        --render-grayscale=auto|always|never    (RENDER_GRAYSCALE), encode as grayscale, 'auto' does so when the figure has no colour (default: never)
+
+    The default pixel budget is above what vision models use for a figure (eg. GPT-4o scales images down to 768 pixels on
+    their shortest side), so it only reduces the size of the payload, not what the model sees. Trimming + grayscale are
+    opt-in, as they change the saved images too.
+    Embedded raster images are never rendered above their native resolution, so small images aren't upscaled for nothing.
+    WebP encoding needs Pillow to be installed.
+    """
+    max_scale:float = None
+    pixel_budget:int = None
+    trim:bool = None
+    image_format:str = None
+    jpeg_quality:int = None
+    grayscale:str = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.max_scale = float(args.get('render-max-scale', os.environ.get("RENDER_MAX_SCALE", 2.0)))
+        self.pixel_budget = int(args.get('render-pixel-budget', os.environ.get("RENDER_PIXEL_BUDGET", 1024 * 1024)))
+        self.trim = args.get('render-trim', os.environ.get("RENDER_TRIM", False)) not in [False, "false", "False", "0"]
+        self.image_format = str(args.get('render-format', os.environ.get("RENDER_FORMAT", "png"))).lower()
+        if self.image_format == "jpg": self.image_format = "jpeg"
+        if self.image_format not in ["png", "jpeg", "webp", "auto"]: raise Exception(f"Unknown render format '{self.image_format}'. Use one of: png, jpeg, webp, auto")
+        self.jpeg_quality = int(args.get('render-jpeg-quality', os.environ.get("RENDER_JPEG_QUALITY", 85)))
+        self.grayscale = str(args.get('render-grayscale', os.environ.get("RENDER_GRAYSCALE", "never"))).lower()
+        if self.grayscale not in ["auto", "always", "never"]: raise Exception(f"Unknown render grayscale mode '{self.grayscale}'. Use one of: auto, always, never")
+
+    def scale(self, page, clip) -> float:
+        """
+        The scale to render the clip of the page at: the max scale, reduced to fit the pixel budget, and capped at the native
+        resolution of the embedded image the clip covers (if any).
+        """
+        from fitz import Rect
+        clip = Rect(clip)
+        area = clip.width * clip.height
+        if area <= 0:
+            return self.max_scale
+        scale = self.max_scale
+        if self.pixel_budget > 0:
+            scale = min(scale, (self.pixel_budget / area) ** 0.5)
+
+        ## If the clip is (mostly) a single embedded image, there's no detail to gain from rendering it above its native resolution
+        for image in page.get_image_info():
+            bbox = Rect(image["bbox"])
+            if bbox.is_empty or (bbox & clip).get_area() < area * 0.9: continue
+            native_scale = max(image["width"] / bbox.width, image["height"] / bbox.height)
+            scale = min(scale, max(1.0, native_scale))
+            break
+        return scale
+
+    def render(self, page, clip) -> RenderedFigure:
+        """
+        Render + encode the clip of the page.
+        """
+        from fitz import Matrix, Pixmap, csGRAY
+        figure = RenderedFigure()
+        figure.scale = self.scale(page, clip)
+        pix = page.get_pixmap(clip=clip, matrix=Matrix(figure.scale, figure.scale), alpha=False)
+
+        figure.trimmed = False
+        if self.trim:
+            trimmed = _trim_margins(pix)
+            if trimmed is not None:
+                pix = trimmed
+                figure.trimmed = True
+
+        figure.grayscale = pix.n == 1
+        if not figure.grayscale and (self.grayscale == "always" or (self.grayscale == "auto" and _is_grayscale(pix))):
+            pix = Pixmap(csGRAY, pix)
+            figure.grayscale = True
+
+        image_format = self.image_format
+        if image_format == "auto":
+            image_format = "jpeg" if _is_photo(pix) else "png"
+        figure.image_bytes = _encode(pix, image_format, self.jpeg_quality)
+        figure.image_format = image_format
+        figure.pix = pix
+        figure.width = pix.width
+        figure.height = pix.height
+        return figure
+
+
+def _samples(pix):
+    import numpy as np
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+def _trim_margins(pix):
+    ## Crop away any border that is the same colour as the corners of the image
+    ## :return: The trimmed pixmap, or None if there's nothing to trim
+    import numpy as np
+    from fitz import Pixmap
+    if pix.width < 4 or pix.height < 4:
+        return None
+    samples = _samples(pix).astype(np.int16)
+    corners = np.array([samples[0, 0], samples[0, -1], samples[-1, 0], samples[-1, -1]])
+    if np.abs(corners - corners[0]).max() > TRIM_TOLERANCE:
+        return None     ## The corners differ, so there is no uniform margin
+    content = np.abs(samples - corners[0]).max(axis=2) > TRIM_TOLERANCE
+    rows = np.flatnonzero(content.any(axis=1))
+    cols = np.flatnonzero(content.any(axis=0))
+    if len(rows) == 0 or len(cols) == 0:
+        return None     ## A blank image
+    padding = 2
+    y0, y1 = max(0, int(rows[0]) - padding), min(pix.height, int(rows[-1]) + 1 + padding)
+    x0, x1 = max(0, int(cols[0]) - padding), min(pix.width, int(cols[-1]) + 1 + padding)
+    if y0 == 0 and x0 == 0 and y1 == pix.height and x1 == pix.width:
+        return None
+    cropped = np.ascontiguousarray(_samples(pix)[y0:y1, x0:x1, :])
+    return Pixmap(pix.colorspace, x1 - x0, y1 - y0, cropped.tobytes(), pix.alpha)
+
+
+def _is_grayscale(pix) -> bool:
+    import numpy as np
+    if pix.n - pix.alpha < 3:
+        return True
+    samples = _samples(pix)[::2, ::2, :3].astype(np.int16)
+    return int(np.abs(samples - samples[:, :, :1]).max()) <= GRAYSCALE_TOLERANCE
+
+
+def _is_photo(pix) -> bool:
+    ## Photos have many distinct colours, while charts, diagrams + text have a few flat colours (which compress better as PNG)
+    import numpy as np
+    samples = _samples(pix)[::4, ::4, :].reshape(-1, pix.n)
+    if len(samples) == 0:
+        return False
+    colours = np.unique(samples, axis=0)
+    return len(colours) > PHOTO_COLOUR_COUNT
+
+
+def _encode(pix, image_format:str, quality:int) -> bytes:
+    if image_format == "png":
+        return pix.tobytes("png")
+    elif image_format == "jpeg":
+        return pix.tobytes("jpg", jpg_quality=quality)
+    elif image_format == "webp":
+        try:
+            from PIL import Image
+        except ImportError:
+            raise Exception("WebP encoding needs Pillow. Install Pillow (pip install Pillow), or use a different '--render-format'")
+        import io
+        mode = "L" if pix.n == 1 else "RGB"
+        image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+        output = io.BytesIO()
+        image.save(output, format="WEBP", quality=quality)
+        return output.getvalue()
+    raise Exception(f"Unknown image format '{image_format}'")
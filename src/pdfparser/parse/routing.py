@@ -0,0 +1,102 @@
+import os
+from pdfparser.util.llmclient import DEFAULT_API_VERSION
+
+## The steps of the (iterative) image analysis that can be sent to a different deployment
+STEP_CLASSIFIER = "classifier"
+STEP_DETAIL = "detail"
+STEP_BATCH = "batch"
+
+## Which steps ask the LLM for structured (JSON schema) outputs
+STRUCTURED_NONE = "none"
+STRUCTURED_CLASSIFIER = "classifier"    # The classifier step, and batch requests (whose responses are JSON)
+STRUCTURED_ALL = "all"                  # The detail step too
+
+## The first API version with structured outputs
+STRUCTURED_OUTPUTS_API_VERSION = "2024-08-01"
+
+class ModelRouting:
+    """
+    Which deployment each step of the iterative image analysis is sent to, and how (args or ENV):
+        --llm-classifier-model=<deployment>     (LLM_CLASSIFIER_MODEL), the (small, fast) deployment that classifies the figures (default: the LLM model)
+        --llm-detail-models=<category>:<deployment>,...     (LLM_DETAIL_MODELS), the deployment that describes the figures of a category,
+                                                eg. 'text:gpt-4o-mini,formula:gpt-4o-mini' (default: the LLM model, for every category)
+        --llm-escalate=true|false               (LLM_ESCALATE), re-run a step with the LLM model when the output of another deployment
+                                                fails validation, eg. unparseable JSON or a malformed markdown table (default: true)
+        --llm-structured-outputs=none|classifier|all    (LLM_STRUCTURED_OUTPUTS), the steps that ask for JSON schema (structured) outputs,
+                                                'classifier' for the classifier step + batch requests, 'all' for the detail step too
+                                                (default: classifier if the LLM API version supports structured outputs, otherwise none)
+        --llm-detail-context=true|false         (LLM_DETAIL_CONTEXT), also send the section + prior/post context of the figure with the
+                                                detail step, at the cost of the context's tokens on every detail request (default: false)
+
+    The single step analysis always uses the LLM model, and is always sent the context of the figure. The deployments are looked up on the endpoint(s) of the LLM client.
+    Structured outputs need API version 2024-08-01-preview (or later), a deployment that rejects them is sent plain requests instead.
+    """
+    classifier_model:str = None
+    detail_models:dict[str, str] = None
+    escalate:bool = None
+    structured_outputs:str = None
+    detail_context:bool = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.classifier_model = args.get('llm-classifier-model', os.environ.get("LLM_CLASSIFIER_MODEL", None))
+        if self.classifier_model is not None and len(str(self.classifier_model).strip()) == 0: self.classifier_model = None
+        self.detail_models = parse_detail_models(args.get('llm-detail-models', os.environ.get("LLM_DETAIL_MODELS", None)))
+        self.escalate = args.get('llm-escalate', os.environ.get("LLM_ESCALATE", True)) not in [False, "false", "False", "0"]
+        self.detail_context = args.get('llm-detail-context', os.environ.get("LLM_DETAIL_CONTEXT", False)) not in [False, "false", "False", "0"]
+        api_version = args.get('llm-api-version', os.environ.get("LLM_API_VERSION", DEFAULT_API_VERSION))
+        default_structured_outputs = STRUCTURED_CLASSIFIER if supports_structured_outputs(api_version) else STRUCTURED_NONE
+        self.structured_outputs = str(args.get('llm-structured-outputs', os.environ.get("LLM_STRUCTURED_OUTPUTS", default_structured_outputs))).lower()
+        if self.structured_outputs not in [STRUCTURED_NONE, STRUCTURED_CLASSIFIER, STRUCTURED_ALL]: raise Exception(f"Unknown structured outputs mode '{self.structured_outputs}'. Use one of: {STRUCTURED_NONE}, {STRUCTURED_CLASSIFIER}, {STRUCTURED_ALL}")
+
+    def is_enabled(self) -> bool:
+        return self.classifier_model is not None or len(self.detail_models) > 0
+
+    def model_for(self, step:str, category:str = None) -> str:
+        """
+        :return: The deployment for the step (+ category of the figure), or None for the LLM model.
+        """
+        if step == STEP_CLASSIFIER:
+            return self.classifier_model
+        elif step == STEP_DETAIL and category is not None:
+            return self.detail_models.get(category, self.detail_models.get("*", None))
+        return None
+
+    def uses_structured_outputs(self, step:str) -> bool:
+        """
+        Whether the step asks for a structured (JSON schema) output.
+        """
+        if step == STEP_DETAIL:
+            return self.structured_outputs == STRUCTURED_ALL
+        return self.structured_outputs != STRUCTURED_NONE
+
+    def variant(self) -> str:
+        """
+        A short description of the routing, used to keep the cached image descriptions of different routings apart ('' if there is no routing).
+        """
+        if not self.is_enabled():
+            return ""
+        detail = ",".join(f"{category}:{model}" for category, model in sorted(self.detail_models.items()))
+        return f"classifier={self.classifier_model or ''};detail={detail};escalate={self.escalate}"
+
+
+def supports_structured_outputs(api_version:str) -> bool:
+    """
+    Whether an Azure OpenAI API version (eg. '2024-10-21' or '2024-08-01-preview') supports structured outputs.
+    """
+    return api_version is not None and str(api_version)[:10] >= STRUCTURED_OUTPUTS_API_VERSION
+
+
+def parse_detail_models(detail_models:str) -> dict[str, str]:
+    """
+    Parse a comma separated list of '<category>:<deployment>' ('*' for every other category).
+    """
+    if detail_models is None or len(str(detail_models).strip()) == 0:
+        return {}
+    models = {}
+    for entry in str(detail_models).split(","):
+        if len(entry.strip()) == 0: continue
+        if ":" not in entry: raise Exception(f"Unknown detail model '{entry}'. Use '<category>:<deployment>', eg. 'text:gpt-4o-mini'")
+        category, model = entry.split(":", 1)
+        models[category.strip().lower()] = model.strip()
+    return models
@@ -0,0 +1,130 @@
+import re
+from bisect import bisect_left, bisect_right
+from typing import Iterator
+from pdfparser.util import markdown as MarkdownUtils
+
+## Paragraphs with these roles are repeated on every page, so they aren't neighbouring text of anything
+NOISE_ROLES = ("pageHeader", "pageFooter", "pageNumber")
+
+class SectionIndex:
+    """
+    An index of a document's markdown, built once per document, that looks up (by offset in the markdown) the section path,
+    the page and the neighbouring paragraphs with a binary search, rather than scanning the markdown for each lookup.
+
+    The headings are the '#' lines of the markdown, or if it has none, the title + section heading paragraphs of the
+    analysis (nested as the analysis' sections are). The pages are the page ranges of the analysis, or the page break
+    comments of the markdown. Available as `ParseResult.sections` (+ `ParseChunk.sections`), eg. for chunking the markdown by section.
+    """
+    heading_offsets:list[int] = None
+    heading_levels:list[int] = None
+    paths:list[list[str]] = None            # The section path at each heading
+    page_starts:list[int] = None
+    page_numbers:list[int] = None
+    paragraphs:list[tuple[int, int]] = None             # The (start, end) of each paragraph, by start
+    _paragraph_starts:list[int] = None
+    _paragraphs_by_end:list[tuple[int, int]] = None
+    _paragraph_ends:list[int] = None
+
+    def __init__(self, markdown:str, analysis = None):
+        """
+        :param markdown: The markdown of the document (which the offsets are into).
+        :param analysis: The analysis of the document (DocIntelAnalysis), for its paragraphs, sections + pages.
+        """
+        headings = MarkdownUtils.find_headings(markdown)
+        if len(headings) == 0 and analysis is not None:
+            headings = _analysis_headings(analysis)
+        self.heading_offsets = [offset for offset, _, _ in headings]
+        self.heading_levels = [level for _, level, _ in headings]
+        self.paths = MarkdownUtils.heading_paths(headings)
+
+        if analysis is not None and analysis.markdown is not None:
+            page_ranges = analysis.page_ranges()
+            self.page_starts = [start for _, start, _ in page_ranges]
+            self.page_numbers = [page_number for page_number, _, _ in page_ranges]
+        else:
+            breaks = [match.end() for match in re.finditer(r"<!--\s*PageBreak\s*-->", markdown or "")]
+            self.page_starts = [0] + breaks
+            self.page_numbers = list(range(1, len(breaks) + 2))
+
+        spans = []
+        for paragraph in (analysis.paragraphs if analysis is not None and analysis.paragraphs is not None else []):
+            if paragraph.role in NOISE_ROLES or paragraph.spans is None or len(paragraph.spans) == 0: continue
+            spans.append((min(span.offset for span in paragraph.spans), max(span.offset + span.length for span in paragraph.spans)))
+        self.paragraphs = sorted(spans)
+        self._paragraph_starts = [start for start, _ in self.paragraphs]
+        self._paragraphs_by_end = sorted(spans, key=lambda span: (span[1], span[0]))
+        self._paragraph_ends = [end for _, end in self._paragraphs_by_end]
+
+    def section_path(self, offset:int) -> list[str]:
+        """
+        :return: The titles of the headings the offset is under, outermost first (empty if it's before the first heading).
+        """
+        idx = bisect_right(self.heading_offsets, offset) - 1
+        return list(self.paths[idx]) if idx >= 0 else []
+
+    def section_name(self, offset:int) -> str:
+        """
+        :return: The section path as a name, eg. 'Title / Section / Sub-section'.
+        """
+        return " / ".join(self.section_path(offset))
+
+    def section_start(self, offset:int, level:int = None) -> int:
+        """
+        :param level: The heading level of the section (defaults to the innermost section).
+        :return: The offset of the heading of the section the offset is in, or None if it's before the first heading (of that level).
+        """
+        idx = bisect_right(self.heading_offsets, offset) - 1
+        while idx >= 0 and level is not None and self.heading_levels[idx] > level:
+            idx -= 1
+        return self.heading_offsets[idx] if idx >= 0 else None
+
+    def page_number(self, offset:int) -> int:
+        """
+        :return: The (1-based) number of the page the offset is on.
+        """
+        idx = bisect_right(self.page_starts, offset) - 1
+        return self.page_numbers[max(0, idx)] if len(self.page_numbers) > 0 else 1
+
+    def paragraphs_before(self, offset:int) -> Iterator[tuple[int, int]]:
+        """
+        The (start, end) of each paragraph that starts before the offset, nearest first.
+        """
+        idx = bisect_left(self._paragraph_starts, offset) - 1
+        while idx >= 0:
+            yield self.paragraphs[idx]
+            idx -= 1
+
+    def paragraphs_after(self, offset:int) -> Iterator[tuple[int, int]]:
+        """
+        The (start, end) of each paragraph that ends after the offset, nearest first.
+        """
+        idx = bisect_right(self._paragraph_ends, offset)
+        while idx < len(self._paragraphs_by_end):
+            yield self._paragraphs_by_end[idx]
+            idx += 1
+
+    def has_paragraphs(self) -> bool:
+        return len(self.paragraphs) > 0
+
+
+def _analysis_headings(analysis) -> list[tuple[int, int, str]]:
+    ## The title (level 1) + section heading paragraphs of the analysis, with the level of a section heading from how deeply its section is nested
+    paragraph_depth = {}
+    sections = analysis.sections or []
+    depths = { 0: 0 }
+    for idx, section in enumerate(sections):
+        depth = depths.get(idx, 0)
+        for element in section.elements or []:
+            kind, _, number = element.strip("/").partition("/")
+            if not number.isdigit(): continue
+            if kind == "sections":
+                depths[int(number)] = depth + 1
+            elif kind == "paragraphs":
+                paragraph_depth.setdefault(int(number), depth)
+
+    headings = []
+    for idx, paragraph in enumerate(analysis.paragraphs or []):
+        if paragraph.role not in ["title", "sectionHeading"] or paragraph.spans is None or len(paragraph.spans) == 0: continue
+        level = 1 if paragraph.role == "title" else min(6, max(2, paragraph_depth.get(idx, 1) + 1))
+        headings.append((min(span.offset for span in paragraph.spans), level, (paragraph.content or "").strip()))
+    return sorted(headings, key=lambda heading: heading[0])
@@ -0,0 +1,127 @@
+import os
+
+## The reasons a figure can be triaged as not worth describing
+TRIAGE_TINY = "tiny"            # The figure is too small (or too thin, eg. a rule line) to hold anything worth describing
+TRIAGE_BLANK = "blank"          # The figure is (close to) a single flat colour
+TRIAGE_LOW_INK = "low_ink"      # Almost all of the figure is background
+TRIAGE_FLAT = "flat"            # The figure is a solid shape of only a couple of colours, eg. a background box
+TRIAGE_TEXT = "text"            # The figure is mostly text (which is already in the markdown)
+
+## What to do with a triaged figure
+TRIAGE_ACTION_MARK = "mark"     # Keep the figure (and its image), with a note instead of a description
+TRIAGE_ACTION_SKIP = "skip"     # Drop the figure from the markdown, and don't save its image
+
+class FigureTriage:
+    """
+    A cheap, local check of each rendered figure, so that blank, tiny + decorative figures (rule lines, background shapes, ...)
+    are not sent to the LLM. Configured with (args or ENV):
+        --figure-triage=true|false          (FIGURE_TRIAGE), triage the figures (default: true)
+        --triage-action=mark|skip           (TRIAGE_ACTION), 'mark' keeps triaged figures with a note instead of a description,
+                                            'skip' drops them from the markdown (default: mark)
+        --triage-min-size=<points>          (TRIAGE_MIN_SIZE), the minimum width + height of a figure on the page (default: 16)
+        --triage-min-stddev=<0-255>         (TRIAGE_MIN_STDDEV), the minimum standard deviation of the (grayscale) pixels (default: 3)
+        --triage-min-ink=<0-1>              (TRIAGE_MIN_INK), the minimum fraction of pixels that differ from the background (default: 0.005)
+        --triage-min-colours=<n>            (TRIAGE_MIN_COLOURS), the minimum number of distinct colours (default: 3)
+        --triage-max-flat-edges=<0-1>       (TRIAGE_MAX_FLAT_EDGES), the maximum edge pixels per ink pixel of a figure with fewer colours
+                                            for it to be a solid shape (default: 0.1), so bitonal line drawings + scans are still described
+        --triage-max-text-coverage=<0-1>    (TRIAGE_MAX_TEXT_COVERAGE), the maximum fraction of the figure covered by words (default: 0.6, 1 = never triage on text)
+    """
+    action:str = None
+    min_size:float = None
+    min_stddev:float = None
+    min_ink:float = None
+    min_colours:int = None
+    max_flat_edges:float = None
+    max_text_coverage:float = None
+
+    def __init__(self, args:dict[str, str] = None):
+        if args is None: args = {}
+        self.action = str(args.get('triage-action', os.environ.get("TRIAGE_ACTION", TRIAGE_ACTION_MARK))).lower()
+        if self.action not in [TRIAGE_ACTION_MARK, TRIAGE_ACTION_SKIP]: raise Exception(f"Unknown triage action '{self.action}'. Use one of: {TRIAGE_ACTION_MARK}, {TRIAGE_ACTION_SKIP}")
+        self.min_size = float(args.get('triage-min-size', os.environ.get("TRIAGE_MIN_SIZE", 16)))
+        self.min_stddev = float(args.get('triage-min-stddev', os.environ.get("TRIAGE_MIN_STDDEV", 3)))
+        self.min_ink = float(args.get('triage-min-ink', os.environ.get("TRIAGE_MIN_INK", 0.005)))
+        self.min_colours = int(args.get('triage-min-colours', os.environ.get("TRIAGE_MIN_COLOURS", 3)))
+        self.max_flat_edges = float(args.get('triage-max-flat-edges', os.environ.get("TRIAGE_MAX_FLAT_EDGES", 0.1)))
+        self.max_text_coverage = float(args.get('triage-max-text-coverage', os.environ.get("TRIAGE_MAX_TEXT_COVERAGE", 0.6)))
+
+    def classify(self, pix, clip:list[float], text_coverage:float = None) -> str:
+        """
+        Triage a rendered figure.
+        :param pix: The rendered figure.
+        :param clip: The region of the page the figure was rendered from (in points).
+        :param text_coverage: The fraction of the figure's region that is covered by words (see `text_coverage`).
+        :return: The reason the figure is not worth describing (one of the TRIAGE_* reasons), or None if it should be described.
+        """
+        import numpy as np
+        if min(clip[2] - clip[0], clip[3] - clip[1]) < self.min_size or pix.width < 2 or pix.height < 2:
+            return TRIAGE_TINY
+
+        samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)[:, :, :pix.n - pix.alpha]
+        gray = samples.mean(axis=2) if samples.shape[2] > 1 else samples[:, :, 0].astype(np.float32)
+        if float(gray.std()) < self.min_stddev:
+            return TRIAGE_BLANK
+
+        ## The background is the most common (quantised) gray level, ink is anything well away from it
+        levels = (gray.astype(np.uint8) >> 3).ravel()
+        background = int(np.bincount(levels, minlength=32).argmax())
+        ink = float(np.mean(np.abs(levels.astype(np.int16) - background) > 2))
+        if ink < self.min_ink:
+            return TRIAGE_LOW_INK
+
+        ## Few colours alone isn't enough (eg. a bitonal line drawing), the ink must also be solid: a shape has edges only along its outline, strokes + text are nearly all edge
+        colours = np.unique((samples[::2, ::2, :] >> 4).reshape(-1, samples.shape[2]), axis=0)
+        if len(colours) < self.min_colours and _edge_ratio(levels.reshape(gray.shape), ink) <= self.max_flat_edges:
+            return TRIAGE_FLAT
+
+        if text_coverage is not None and text_coverage > self.max_text_coverage:
+            return TRIAGE_TEXT
+        return None
+
+    def note(self, reason:str) -> str:
+        """
+        :return: The markdown that replaces the description of a figure marked as not worth describing.
+        """
+        return f"<!-- Decorative image ({reason}), not described -->"
+
+
+def _edge_ratio(levels, ink:float) -> float:
+    ## The edge pixels (that differ from the pixel to their right or below) per ink pixel
+    import numpy as np
+    edges = np.zeros(levels.shape, dtype=bool)
+    levels = levels.astype(np.int16)
+    edges[:, :-1] |= np.abs(np.diff(levels, axis=1)) > 2
+    edges[:-1, :] |= np.abs(np.diff(levels, axis=0)) > 2
+    return float(edges.mean()) / ink if ink > 0 else 0.0
+
+
+def text_coverage(words:list, polygon:list[float]) -> float:
+    """
+    The fraction of a region that is covered by words.
+    :param words: The words on the page (DocIntelAnalysisWord), in the same units as the polygon.
+    :param polygon: The (DocIntel) polygon of the region.
+    """
+    if polygon is None or len(polygon) < 8 or words is None:
+        return 0.0
+    x0, y0, x1, y1 = polygon_bounds(polygon)
+    area = (x1 - x0) * (y1 - y0)
+    if area <= 0:
+        return 0.0
+    covered = 0.0
+    for word in words:
+        if word.polygon is None or len(word.polygon) < 8: continue
+        wx0, wy0, wx1, wy1 = polygon_bounds(word.polygon)
+        width = min(x1, wx1) - max(x0, wx0)
+        height = min(y1, wy1) - max(y0, wy0)
+        if width > 0 and height > 0:
+            covered += width * height
+    return min(1.0, covered / area)
+
+
+def polygon_bounds(polygon:list[float]) -> tuple[float, float, float, float]:
+    """
+    :return: The (x0, y0, x1, y1) bounding box of a (DocIntel) polygon.
+    """
+    xs = polygon[0::2]
+    ys = polygon[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
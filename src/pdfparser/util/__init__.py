@@ -1,5 +1,10 @@
 
 from .llmclient import LLMClient
+from .markdown import MarkdownSplicer
+from .cache import CacheBackend, DirectoryCacheBackend, SqliteCacheBackend, create_cache_backend
+from .journal import BatchJournal
+from .ratelimit import RateLimiter, TokenBucket, get_rate_limiter
+from .concurrency import AdaptiveConcurrency, get_concurrency_controller
 
 def parse_args() -> dict[str, str]:
     import sys
@@ -0,0 +1,233 @@
+import os
+import time
+import threading
+from pathlib import Path
+
+class CacheBackend:
+    """
+    A simple namespaced key/value store used to cache analysis results, with an optional size + age budget.
+    When the cache is over budget, the least recently used entries are evicted first.
+    """
+    max_bytes:int = None    # The maximum total size of the cached values (0 = unlimited)
+    max_age:float = None    # The maximum time (in seconds) since an entry was last used (0 = unlimited)
+
+    def __init__(self, max_bytes:int = 0, max_age:float = 0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def get(self, namespace:str, key:str) -> bytes:
+        raise NotImplementedError()
+
+    def put(self, namespace:str, key:str, value:bytes):
+        raise NotImplementedError()
+
+    def delete(self, namespace:str, key:str):
+        raise NotImplementedError()
+
+    def keys(self, namespace:str) -> list[str]:
+        raise NotImplementedError()
+
+    def evict(self):
+        """
+        Evict expired entries, then the least recently used entries until the cache is within its size budget.
+        """
+        raise NotImplementedError()
+
+    def get_text(self, namespace:str, key:str) -> str:
+        value = self.get(namespace, key)
+        return value.decode("utf-8") if value is not None else None
+
+    def put_text(self, namespace:str, key:str, value:str):
+        self.put(namespace, key, value.encode("utf-8"))
+
+
+class DirectoryCacheBackend(CacheBackend):
+    """
+    Stores each entry as a file within a directory (one sub-directory per namespace).
+    The modified time of each file is used as its last access time, and writes are atomic, so the directory can be shared by multiple processes.
+    """
+    _cache_dir:Path = None
+    _evict_interval:int = 100
+    _puts_since_evict:int = 0
+    _lock:threading.Lock = None
+
+    def __init__(self, cache_dir:Path, max_bytes:int = 0, max_age:float = 0):
+        super().__init__(max_bytes, max_age)
+        self._cache_dir = Path(cache_dir)
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        if self.max_bytes > 0 or self.max_age > 0:
+            self.evict()
+
+    def _entry_file(self, namespace:str, key:str) -> Path:
+        return self._cache_dir / namespace / key[:2] / key
+
+    def get(self, namespace:str, key:str) -> bytes:
+        entry_file = self._entry_file(namespace, key)
+        try:
+            with open(entry_file, "rb") as f:
+                value = f.read()
+            os.utime(entry_file)    ## Mark the entry as recently used
+            return value
+        except FileNotFoundError:
+            return None
+
+    def put(self, namespace:str, key:str, value:bytes):
+        entry_file = self._entry_file(namespace, key)
+        entry_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = entry_file.parent / f".{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(value)
+        os.replace(tmp_file, entry_file)
+
+        with self._lock:
+            self._puts_since_evict += 1
+            should_evict = (self.max_bytes > 0 or self.max_age > 0) and self._puts_since_evict >= self._evict_interval
+            if should_evict: self._puts_since_evict = 0
+        if should_evict:
+            self.evict()
+
+    def delete(self, namespace:str, key:str):
+        try:
+            self._entry_file(namespace, key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def keys(self, namespace:str) -> list[str]:
+        namespace_dir = self._cache_dir / namespace
+        if not namespace_dir.exists():
+            return []
+        return [f.name for f in namespace_dir.glob("*/*") if not f.name.startswith(".")]
+
+    def evict(self):
+        if self.max_bytes <= 0 and self.max_age <= 0:
+            return
+        entries = []
+        now = time.time()
+        for entry_file in self._cache_dir.glob("*/*/*"):
+            if entry_file.name.startswith("."): continue
+            try:
+                stat = entry_file.stat()
+            except FileNotFoundError:
+                continue
+            if self.max_age > 0 and now - stat.st_mtime > self.max_age:
+                self._unlink(entry_file)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_file))
+
+        if self.max_bytes > 0:
+            total_bytes = sum(size for _, size, _ in entries)
+            entries.sort(key=lambda e: e[0])
+            for _, size, entry_file in entries:
+                if total_bytes <= self.max_bytes: break
+                self._unlink(entry_file)
+                total_bytes -= size
+
+    def _unlink(self, entry_file:Path):
+        try:
+            entry_file.unlink()
+        except FileNotFoundError:
+            pass    ## Already evicted by another process
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    Stores the entries in a SQLite database (in WAL mode), which can be safely shared by multiple threads + processes on the same host.
+    """
+    _db_path:Path = None
+    _local:threading.local = None
+    _evict_interval:int = 100
+    _puts_since_evict:int = 0
+    _lock:threading.Lock = None
+
+    def __init__(self, db_path:Path, max_bytes:int = 0, max_age:float = 0):
+        super().__init__(max_bytes, max_age)
+        self._db_path = Path(db_path)
+        self._db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        if self.max_bytes > 0 or self.max_age > 0:
+            self.evict()
+
+    def _connection(self):
+        import sqlite3
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace:str, key:str) -> bytes:
+        with self._connection() as conn:
+            row = conn.execute("SELECT value FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key))
+            return bytes(row[0])
+
+    def put(self, namespace:str, key:str, value:bytes):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries (namespace, key, value, size, accessed) VALUES (?, ?, ?, ?, ?)", (namespace, key, value, len(value), time.time()))
+
+        with self._lock:
+            self._puts_since_evict += 1
+            should_evict = (self.max_bytes > 0 or self.max_age > 0) and self._puts_since_evict >= self._evict_interval
+            if should_evict: self._puts_since_evict = 0
+        if should_evict:
+            self.evict()
+
+    def delete(self, namespace:str, key:str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def keys(self, namespace:str) -> list[str]:
+        with self._connection() as conn:
+            return [row[0] for row in conn.execute("SELECT key FROM entries WHERE namespace = ?", (namespace,))]
+
+    def evict(self):
+        if self.max_bytes <= 0 and self.max_age <= 0:
+            return
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if self.max_age > 0:
+                conn.execute("DELETE FROM entries WHERE accessed < ?", (time.time() - self.max_age,))
+            if self.max_bytes > 0:
+                total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                if total_bytes > self.max_bytes:
+                    evict = []
+                    for namespace, key, size in conn.execute("SELECT namespace, key, size FROM entries ORDER BY accessed ASC"):
+                        if total_bytes <= self.max_bytes: break
+                        evict.append((namespace, key))
+                        total_bytes -= size
+                    conn.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", evict)
+
+
+def create_cache_backend(args:dict[str, str], default_dir:Path) -> CacheBackend:
+    """
+    Create the cache backend configured by the args (or ENV):
+        --cache=directory|sqlite|none   (CACHE_BACKEND)
+        --cache-dir=<dir>               (CACHE_DIR), defaults to default_dir
+        --cache-max-bytes=<bytes>       (CACHE_MAX_BYTES)
+        --cache-max-age=<seconds>       (CACHE_MAX_AGE)
+    :return: The cache backend, or None if caching is disabled.
+    """
+    backend = str(args.get('cache', os.environ.get("CACHE_BACKEND", "directory"))).lower()
+    cache_dir = args.get('cache-dir', os.environ.get("CACHE_DIR", None))
+    cache_dir = Path(cache_dir) if cache_dir is not None else Path(default_dir)
+    max_bytes = int(args.get('cache-max-bytes', os.environ.get("CACHE_MAX_BYTES", 0)))
+    max_age = float(args.get('cache-max-age', os.environ.get("CACHE_MAX_AGE", 0)))
+
+    if backend in ["none", "false", "off"]:
+        return None
+    elif backend in ["directory", "dir", "true"]:
+        return DirectoryCacheBackend(cache_dir, max_bytes, max_age)
+    elif backend == "sqlite":
+        return SqliteCacheBackend(cache_dir / "cache.sqlite", max_bytes, max_age)
+    else:
+        raise Exception(f"Unknown cache backend '{backend}'. Use one of: directory, sqlite, none")
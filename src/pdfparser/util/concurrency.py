@@ -0,0 +1,254 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+
+## The limit is cut by these factors when the service is overloaded (a 429, 5xx or timeout), or when its latency rises
+OVERLOAD_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+
+class _Waiter:
+    event:threading.Event = None        # Set for threads waiting for a slot
+    future:asyncio.Future = None        # Set for tasks waiting for a slot
+    loop:asyncio.AbstractEventLoop = None
+    saturated:bool = False
+
+class AdaptiveConcurrency:
+    """
+    Limits the requests in flight to a service, with a limit that adapts to how the service behaves (AIMD): the limit grows
+    by one for each `limit` successful requests while the limit is being used, and is cut when a request is throttled,
+    fails with a server error or times out, or when the p95 latency of the recent requests rises well above the lowest p95 seen.
+    Shared by every client of the service in the process (see `get_concurrency_controller`), from threads or event loops.
+    """
+    name:str = None
+    limit:float = None
+    min_limit:int = None
+    max_limit:int = None
+    latency_tolerance:float = None      # Cut the limit when the p95 latency is this many times the baseline
+    window:int = None                   # The number of requests the p95 latency is measured over
+    _in_flight:int = 0
+    _waiters:deque = None
+    _latencies:list[float] = None
+    _baseline:float = None              # The lowest p95 latency seen (slowly relaxed upwards, so it can follow a service that slows down for good)
+    _last_decrease:float = 0.0
+    _stats:dict[str, int] = None
+    _lock:threading.Lock = None
+
+    def __init__(self, name:str, initial:int = 4, min_limit:int = 1, max_limit:int = 64, latency_tolerance:float = 2.0, window:int = 20):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial)))
+        self.latency_tolerance = latency_tolerance
+        self.window = window
+        self._waiters = deque()
+        self._latencies = []
+        self._stats = { "increases": 0, "decreases": 0, "overloads": 0, "waits": 0 }
+        self._lock = threading.Lock()
+
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def acquire(self) -> bool:
+        """
+        Wait for a slot.
+        :return: Whether the slot was one of the last (ie. the limit is being used), pass this on to `release`.
+        """
+        with self._lock:
+            if len(self._waiters) == 0 and self._in_flight < self.current_limit():
+                return self._grant()
+            waiter = _Waiter()
+            waiter.event = threading.Event()
+            self._waiters.append(waiter)
+            self._stats["waits"] += 1
+        waiter.event.wait()
+        return waiter.saturated
+
+    async def acquire_async(self) -> bool:
+        """
+        The async version of `acquire`.
+        """
+        with self._lock:
+            if len(self._waiters) == 0 and self._in_flight < self.current_limit():
+                return self._grant()
+            waiter = _Waiter()
+            waiter.loop = asyncio.get_running_loop()
+            waiter.future = waiter.loop.create_future()
+            self._waiters.append(waiter)
+            self._stats["waits"] += 1
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            self.release(succeeded=False, saturated=waiter.saturated)    ## The slot was granted as the task was cancelled
+            raise
+
+    def release(self, succeeded:bool = True, latency:float = None, overloaded:bool = False, saturated:bool = False):
+        """
+        Return a slot, and adapt the limit to the outcome of the request.
+        :param succeeded: Whether the request succeeded.
+        :param latency: The latency of the request (None if its latency isn't meaningful).
+        :param overloaded: Whether the request failed because the service is overloaded.
+        :param saturated: What `acquire` returned.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if overloaded:
+                self._stats["overloads"] += 1
+                self._decrease(OVERLOAD_DECREASE)
+            elif succeeded:
+                if saturated and self.limit < self.max_limit:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                    self._stats["increases"] += 1
+                if latency is not None: self._observe_latency(latency)
+            self._wake()
+
+    @contextmanager
+    def slot(self, measure_latency:bool = True):
+        """
+        Hold a slot for the duration of a request, the outcome of the request is worked out from whether (and how) it raised.
+        """
+        saturated = self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.release(succeeded=False, overloaded=is_overloaded(e), saturated=saturated)
+            raise
+        self.release(latency=time.perf_counter() - start if measure_latency else None, saturated=saturated)
+
+    @asynccontextmanager
+    async def slot_async(self, measure_latency:bool = True):
+        """
+        The async version of `slot`.
+        """
+        saturated = await self.acquire_async()
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.release(succeeded=False, overloaded=is_overloaded(e), saturated=saturated)
+            raise
+        self.release(latency=time.perf_counter() - start if measure_latency else None, saturated=saturated)
+
+    def stats(self) -> dict:
+        """
+        :return: The current limit + requests in flight, along with how often the limit was raised + cut.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({ "limit": self.current_limit(), "in_flight": self._in_flight, "waiting": len(self._waiters), "baseline_p95": self._baseline })
+            return stats
+
+    def _grant(self) -> bool:
+        self._in_flight += 1
+        return self._in_flight >= self.current_limit()
+
+    def _wake(self):
+        while len(self._waiters) > 0 and self._in_flight < self.current_limit():
+            waiter = self._waiters.popleft()
+            waiter.saturated = self._grant()
+            if waiter.event is not None:
+                waiter.event.set()
+            else:
+                waiter.loop.call_soon_threadsafe(_resolve, waiter.future, waiter.saturated)
+
+    def _decrease(self, factor:float):
+        ## Only cut the limit once per burst of failures, ie. at most once per (baseline) request time (or second, until there is a baseline)
+        now = time.monotonic()
+        if now - self._last_decrease < (self._baseline if self._baseline is not None else 1.0):
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        self._stats["decreases"] += 1
+
+    def _observe_latency(self, latency:float):
+        self._latencies.append(latency)
+        if len(self._latencies) < self.window:
+            return
+        ordered = sorted(self._latencies)
+        p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+        self._latencies = []
+        if self._baseline is None or p95 < self._baseline:
+            self._baseline = p95
+        elif p95 > self._baseline * self.latency_tolerance:
+            self._decrease(LATENCY_DECREASE)
+            self._baseline *= 1.05
+        else:
+            self._baseline *= 1.01
+
+
+def _resolve(future:asyncio.Future, saturated:bool):
+    if not future.done(): future.set_result(saturated)
+
+
+def is_overloaded(error:BaseException) -> bool:
+    """
+    Whether an error means the service is overloaded: a throttled request (429), a server error (5xx) or a timeout.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, TimeoutError) or "Timeout" in type(error).__name__
+
+
+_controllers:dict[str, AdaptiveConcurrency] = {}
+_controllers_lock = threading.Lock()
+
+def get_concurrency_controller(name:str, initial:int = 4, min_limit:int = 1, max_limit:int = 64, latency_tolerance:float = 2.0) -> AdaptiveConcurrency:
+    """
+    Get the process-wide concurrency controller of a service (eg. 'llm:<endpoint>|<deployment>'), creating it on first use.
+    """
+    with _controllers_lock:
+        controller = _controllers.get(name, None)
+        if controller is None:
+            controller = AdaptiveConcurrency(name, initial, min_limit, max_limit, latency_tolerance)
+            _controllers[name] = controller
+        return controller
+
+
+def create_concurrency_controller(name:str, args:dict[str, str], max_arg:str, max_env:str, default_max:int) -> AdaptiveConcurrency:
+    """
+    Get the concurrency controller of a service, if adaptive concurrency is turned on (args or ENV):
+        --adaptive-concurrency=true|false       (ADAPTIVE_CONCURRENCY), adapt the requests in flight to each service (default: false)
+        --adaptive-initial-concurrency=<n>      (ADAPTIVE_INITIAL_CONCURRENCY), the limit to start from (default: 4)
+        --adaptive-latency-tolerance=<x>        (ADAPTIVE_LATENCY_TOLERANCE), cut the limit when the p95 latency rises this many times above its baseline (default: 2)
+        --<max_arg>=<n>                         (<max_env>), the most requests in flight to the service (default: default_max)
+    :return: The controller, or None if adaptive concurrency is off.
+    """
+    if args.get('adaptive-concurrency', os.environ.get("ADAPTIVE_CONCURRENCY", False)) in [False, "false", "False", "0"]:
+        return None
+    return get_concurrency_controller(
+        name,
+        initial=int(args.get('adaptive-initial-concurrency', os.environ.get("ADAPTIVE_INITIAL_CONCURRENCY", 4))),
+        max_limit=int(args.get(max_arg, os.environ.get(max_env, default_max))),
+        latency_tolerance=float(args.get('adaptive-latency-tolerance', os.environ.get("ADAPTIVE_LATENCY_TOLERANCE", 2.0)))
+    )
+
+
+def concurrency_slot(controller:AdaptiveConcurrency, measure_latency:bool = True):
+    """
+    :return: A slot of the controller, or a no-op context if there is no controller.
+    """
+    return controller.slot(measure_latency) if controller is not None else nullcontext()
+
+
+def concurrency_slot_async(controller:AdaptiveConcurrency, measure_latency:bool = True):
+    """
+    :return: A slot of the controller, or a no-op async context if there is no controller.
+    """
+    return controller.slot_async(measure_latency) if controller is not None else nullcontext()
+
+
+def concurrency_snapshot() -> dict[str, dict]:
+    """
+    :return: The stats of every concurrency controller in the process, keyed by name.
+    """
+    with _controllers_lock:
+        controllers = list(_controllers.values())
+    return { controller.name: controller.stats() for controller in controllers }
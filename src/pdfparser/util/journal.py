@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+## The states a file goes through in a batch run, in order
+STATE_QUEUED = "queued"
+STATE_ANALYSED = "analysed"             # The layout analysis is done (and cached)
+STATE_FIGURES_DONE = "figures_done"     # Every figure has been described (and the descriptions cached)
+STATE_WRITTEN = "written"               # The markdown has been written, ie. the file is complete
+STATE_FAILED = "failed"
+
+class BatchJournal:
+    """
+    An append-only JSONL journal of the state of each file in a batch run, so a run that dies part way through can be resumed.
+    Each line is one state change of one file. Lines are appended with a single write to a file opened in append mode, so
+    several processes can share the same journal.
+    """
+    file:Path = None
+    _fd:int = None
+    _lock:threading.Lock = None
+
+    def __init__(self, file:Path):
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, file:Path, state:str, seconds:float = None, error:str = None):
+        """
+        Append a state change of a file to the journal.
+        :param seconds: The time since the file was started.
+        :param error: The error, if the file failed.
+        """
+        entry = { "file": _file_id(file), "state": state, "time": time.time() }
+        entry.update(_file_identity(file))
+        if seconds is not None: entry["seconds"] = seconds
+        if error is not None: entry["error"] = error
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fd is None: raise Exception(f"Journal '{self.file}' is closed")
+            os.write(self._fd, line)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def load_journal(journal_file:Path) -> dict[str, dict]:
+    """
+    Load the latest state of each file in a journal.
+    :return: The latest journal entry of each file, keyed by file (or an empty dict if there's no journal yet).
+    """
+    journal_file = Path(journal_file)
+    states = {}
+    if not journal_file.exists():
+        return states
+    with open(journal_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0: continue
+            try:
+                entry = json.loads(line)
+            except Exception:
+                continue    ## A partially written line (eg. the process was killed mid-write)
+            states[entry.get("file", "")] = entry
+    return states
+
+
+def is_complete(states:dict[str, dict], file:Path) -> bool:
+    """
+    Whether the file was completed in a previous run (and hasn't changed since).
+    """
+    entry = states.get(_file_id(file), None)
+    if entry is None or entry.get("state", None) != STATE_WRITTEN:
+        return False
+    identity = _file_identity(file)
+    return entry.get("size", None) == identity.get("size", None) and entry.get("mtime_ns", None) == identity.get("mtime_ns", None)
+
+
+def _file_id(file:Path) -> str:
+    return str(Path(file).resolve())
+
+
+def _file_identity(file:Path) -> dict:
+    try:
+        stat = Path(file).stat()
+        return { "size": stat.st_size, "mtime_ns": stat.st_mtime_ns }
+    except OSError:
+        return {}
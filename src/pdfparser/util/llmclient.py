@@ -1,16 +1,81 @@
-from openai import AzureOpenAI
+import time
+import random
+import asyncio
+import threading
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from openai.types.responses import ResponseInputParam
+from .ratelimit import RateLimiter, get_rate_limiter, is_throttled, retry_after_seconds, retry_delay, DEFAULT_THROTTLE_PAUSE
+from .concurrency import AdaptiveConcurrency, create_concurrency_controller, concurrency_slot, concurrency_slot_async, is_overloaded
+
+## The API version used unless one is given, NB: structured outputs need 2024-08-01-preview (or later)
+DEFAULT_API_VERSION = "2024-02-15-preview"
+
+## The tokens counted for each image in a request (a 'high' detail image of ~1024x1024)
+IMAGE_TOKENS = 765
+
+## A pool member that fails with a server error, a timeout or a connection error is ejected for this long, doubling with each consecutive failure
+BASE_EJECTION = 1.0
+MAX_EJECTION = 30.0
+
+class LLMPoolMember:
+    """
+    One deployment of the LLM client's pool, with its own clients, rate limiter + (adaptive) concurrency limit, and health.
+    """
+    endpoint:str = None
+    deployment:str = None
+    weight:float = None
+    api_key:str = None
+    client:AzureOpenAI = None
+    async_client:AsyncAzureOpenAI = None
+    rate_limiter:RateLimiter = None
+    concurrency:AdaptiveConcurrency = None
+    in_flight:int = 0
+    ejected_until:float = 0.0       # The member isn't sent requests until then (unless every member is ejected)
+    failures:int = 0                # The consecutive failed requests
+    stats:dict[str, int] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.endpoint}|{self.deployment}"
+
+    def is_healthy(self, now:float) -> bool:
+        return self.ejected_until <= now and self.rate_limiter.paused_for() <= 0
+
 
 class LLMClient:
+    """
+    Generates chat completions with an Azure OpenAI deployment, or a pool of them (args or ENV):
+        --llm-endpoint=<url>            (LLM_ENDPOINT), the Azure OpenAI endpoint
+        --llm-model=<deployment>        (LLM_MODEL), the deployment (default: gpt-4o)
+        --llm-api-key=<key>             (LLM_API_KEY)
+        --llm-pool=<endpoint>|<deployment>|<weight>|<api key env var>,...   (LLM_POOL), spread the requests over several deployments,
+                                        eg. in different regions. Only the endpoint is required, the deployment defaults to the
+                                        LLM model, the weight to 1 and the API key to the LLM API key.
+        --llm-max-retries=<n>           (LLM_MAX_RETRIES), how many times a request that every member of the pool failed (throttled,
+                                        a server error, a timeout or a connection error) is retried (default: 2)
+
+    Each request goes to the healthy member of the pool with the fewest requests in flight (relative to its weight). A member
+    that throttles a request is ejected from the pool until the service says to retry, and a member that fails with a server
+    error, a timeout or a connection error is ejected for an exponential backoff. A request that fails on one member is
+    retried straight away on another healthy member, if there is one. Once every member has failed it, the request is retried
+    after the rate limiter's pause (if it was throttled) or an exponential backoff, up to the max retries.
+    """
     _model:str = None
     _api_key:str = None
     _api_version:str = None
     _endpoint:str = None
-    _client = None
     _default_instruction:str = None
     _default_temperature:float = 0.6
     _default_max_tokens:int = 4092
     _default_top_p:float = 1.0
+    _requests_per_minute:float = None
+    _tokens_per_minute:float = None
+    _sdk_retries:int = None
+    _max_retries:int = None
+    _args:dict[str, str] = None
+    _members:list[LLMPoolMember] = None                 # The pool of deployments of the LLM model
+    _tiers:dict[str, list[LLMPoolMember]] = None        # The pools of the other deployments requests were sent to, by deployment
+    _pool_lock:threading.Lock = None
     
 
     def __init__(self, args:dict[str, str]):
@@ -18,43 +83,264 @@ class LLMClient:
         
         self._model = args.get('llm-model', os.environ.get("LLM_MODEL", "gpt-4o"))
         self._api_key = args.get('llm-api-key', os.environ.get("LLM_API_KEY", None))
-        if self._api_key is None: raise Exception("LLM API key not specified. Provide either the '--llm-api-key' argument or specify the 'LLM_API_KEY' environment variable")
-        self._api_version = args.get('llm-api-version', os.environ.get("LLM_API_VERSION", "2024-02-15-preview"))
+        self._api_version = args.get('llm-api-version', os.environ.get("LLM_API_VERSION", DEFAULT_API_VERSION))
         self._endpoint = args.get('llm-endpoint', os.environ.get("LLM_ENDPOINT", os.environ.get("AZURE_OPENAI_ENDPOINT", None))) 
-        if self._endpoint is None: raise Exception("LLM endpoint not specified. Provide either the '--llm-endpoint' argument or specify the 'LLM_ENDPOINT' environment variable")
+        pool = parse_pool(args.get('llm-pool', os.environ.get("LLM_POOL", None)), self._model, self._api_key)
+        if len(pool) == 0:
+            if self._api_key is None: raise Exception("LLM API key not specified. Provide either the '--llm-api-key' argument or specify the 'LLM_API_KEY' environment variable")
+            if self._endpoint is None: raise Exception("LLM endpoint not specified. Provide either the '--llm-endpoint' argument or specify the 'LLM_ENDPOINT' environment variable")
+            pool = [(self._endpoint, self._model, 1.0, self._api_key)]
+        else:
+            self._endpoint = pool[0][0]
 
         self._default_instruction = args.get('llm-instruction', os.environ.get("LLM_INSTRUCTION", "You are a helpful assistant. Answer the question as best you can."))
 
-        self._client = AzureOpenAI(
-            azure_endpoint=self._endpoint,
-            azure_deployment=self._model,
-            api_key=self._api_key,
+        ## Every client of the same deployment (in this process) shares one rate limiter (+ concurrency controller)
+        self._requests_per_minute = float(args.get('llm-rpm', os.environ.get("LLM_RPM", 0)))
+        self._tokens_per_minute = float(args.get('llm-tpm', os.environ.get("LLM_TPM", 0)))
+
+        ## Failed requests are retried by `generate` (after the rate limiter's pause), rather than by each SDK client on its own
+        self._sdk_retries = int(args.get('llm-sdk-retries', os.environ.get("LLM_SDK_RETRIES", 0)))
+        self._max_retries = int(args.get('llm-max-retries', os.environ.get("LLM_MAX_RETRIES", 2)))
+
+        self._args = args
+        self._pool_lock = threading.Lock()
+        self._tiers = {}
+        self._members = [self._create_member(endpoint, deployment, weight, api_key) for endpoint, deployment, weight, api_key in pool]
+
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        ## The rate limiter of the first deployment in the pool
+        return self._members[0].rate_limiter
+
+    @property
+    def concurrency(self) -> AdaptiveConcurrency:
+        ## The concurrency controller of the first deployment in the pool
+        return self._members[0].concurrency
+
+    @property
+    def max_concurrency(self) -> int:
+        """
+        The most requests the pool can have in flight with adaptive concurrency (None if adaptive concurrency is off).
+        """
+        if self._members[0].concurrency is None:
+            return None
+        return sum(member.concurrency.max_limit for member in self._members)
+
+    @property
+    def members(self) -> list[LLMPoolMember]:
+        return list(self._members)
+
+    def pool_stats(self) -> dict[str, dict]:
+        """
+        :return: The requests, failures, ejections, fail overs + (cached) prompt tokens of each deployment that requests were sent to, keyed by '<endpoint>|<deployment>'.
+        """
+        now = time.monotonic()
+        with self._pool_lock:
+            members = self._members + [member for members in self._tiers.values() for member in members if member not in self._members]
+            return { member.name: dict(member.stats, in_flight=member.in_flight, healthy=member.ejected_until <= now) for member in members }
+
+    def _create_member(self, endpoint:str, deployment:str, weight:float, api_key:str) -> LLMPoolMember:
+        member = LLMPoolMember()
+        member.endpoint = endpoint
+        member.deployment = deployment
+        member.weight = weight
+        member.api_key = api_key
+        member.stats = { "requests": 0, "failures": 0, "ejections": 0, "failovers": 0, "prompt_tokens": 0, "cached_tokens": 0 }
+        member.rate_limiter = get_rate_limiter(f"llm:{endpoint}|{deployment}", self._requests_per_minute, self._tokens_per_minute)
+        member.concurrency = create_concurrency_controller(f"llm:{endpoint}|{deployment}", self._args, 'llm-max-concurrency', "LLM_MAX_CONCURRENCY", 64)
+        member.client = AzureOpenAI(
+            azure_endpoint=endpoint,
+            azure_deployment=deployment,
+            api_key=api_key,
             api_version=self._api_version,
+            max_retries=self._sdk_retries,
         )
+        return member
+
+    def _members_for(self, model:str) -> list[LLMPoolMember]:
+        ## The members of the pool that serve the deployment
+        if model is None or len(model) == 0 or model == self._model:
+            return self._members
+        with self._pool_lock:
+            members = self._tiers.get(model, None)
+            if members is None:
+                members = [member for member in self._members if member.deployment == model]
+                if len(members) == 0:
+                    ## Other deployments (eg. a smaller model) are expected under the same name on each endpoint of the pool
+                    endpoints = {}
+                    for member in self._members: endpoints.setdefault(member.endpoint, member)
+                    members = [self._create_member(member.endpoint, model, member.weight, member.api_key) for member in endpoints.values()]
+                self._tiers[model] = members
+            return members
 
+    def _pick(self, members:list[LLMPoolMember], tried:list[LLMPoolMember]) -> LLMPoolMember:
+        ## The healthy member with the fewest requests in flight (relative to its weight) that hasn't been tried for this request yet
+        now = time.monotonic()
+        with self._pool_lock:
+            candidates = [member for member in members if member not in tried]
+            healthy = [member for member in candidates if member.is_healthy(now)]
+            if len(healthy) == 0:
+                if len(tried) > 0 or len(candidates) == 0:
+                    return None
+                healthy = [min(candidates, key=lambda member: member.ejected_until)]    ## Every member is ejected, use the one that is back first
+            load = { id(member): (member.in_flight + 1) / member.weight for member in healthy }
+            lowest = min(load.values())
+            member = random.choice([member for member in healthy if load[id(member)] <= lowest])
+            member.in_flight += 1
+            member.stats["requests"] += 1
+            return member
 
-    def generate(self, messages:list[dict|ResponseInputParam], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None) -> str:
+    def _release(self, member:LLMPoolMember, error:Exception = None):
+        ## Return the member to the pool, ejecting it for a while if the request failed because of the member
+        with self._pool_lock:
+            member.in_flight -= 1
+            if error is None:
+                member.failures = 0
+                return
+            if not is_member_failure(error):
+                return
+            member.failures += 1
+            member.stats["failures"] += 1
+            if is_throttled(error):
+                retry_after = retry_after_seconds(error)
+                eject_for = retry_after if retry_after is not None else DEFAULT_THROTTLE_PAUSE
+            else:
+                eject_for = min(MAX_EJECTION, BASE_EJECTION * (2 ** (member.failures - 1)))
+            member.ejected_until = max(member.ejected_until, time.monotonic() + eject_for)
+            member.stats["ejections"] += 1
+        if is_throttled(error): member.rate_limiter.on_throttled(retry_after_seconds(error))
+
+    def _fail_over(self, member:LLMPoolMember, error:Exception, members:list[LLMPoolMember], tried:list[LLMPoolMember]) -> LLMPoolMember:
+        ## :return: The member to retry the request on, or None if the error should be raised
+        tried.append(member)
+        if not is_member_failure(error):
+            return None
+        next_member = self._pick(members, tried)
+        if next_member is not None:
+            with self._pool_lock:
+                member.stats["failovers"] += 1
+        return next_member
+
+    def _retry(self, member:LLMPoolMember, error:Exception, members:list[LLMPoolMember], tried:list[LLMPoolMember], retries:list[int], max_retries:int = None) -> tuple[LLMPoolMember, float]:
+        ## :param retries: The [retries] of the request so far, updated in place
+        ## :return: The member to retry the request on + how long to wait first, or (None, 0) if the error should be raised
+        next_member = self._fail_over(member, error, members, tried)
+        if next_member is not None:
+            return next_member, 0.0
+        if max_retries is None: max_retries = self._max_retries
+        if not is_member_failure(error) or retries[0] >= max_retries:
+            return None, 0.0
+        ## Every member has failed the request, so start over with the whole pool. A throttled request waits in the rate limiter (which is paused until the service said to retry)
+        delay = 0.0 if is_throttled(error) else retry_delay(error, retries[0])
+        retries[0] += 1
+        tried.clear()
+        return self._pick(members, tried), delay
+
+    def _record_usage(self, member:LLMPoolMember, response):
+        ## The prompt tokens, and how many of them were read from the provider's prompt cache
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        with self._pool_lock:
+            member.stats["prompt_tokens"] += usage.prompt_tokens or 0
+            member.stats["cached_tokens"] += (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+    def _completion_args(self, messages:list[dict|ResponseInputParam], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None) -> dict:
         if model is None or len(model) == 0:
             model = self._model
-        if temperature is None or len(temperature) == 0:
+        if temperature is None:
             temperature = self._default_temperature
-        if max_tokens is None or len(max_tokens) == 0:
+        if max_tokens is None:
             max_tokens = self._default_max_tokens
-        if top_p is None or len(top_p) == 0:
+        if top_p is None:
             top_p = self._default_top_p
+        completion_args = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p,
+        }
+        if response_format is not None:
+            completion_args["response_format"] = response_format
+        return completion_args
 
-        response = self._client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            top_p=top_p,
-        )
-        return response.choices[0].message.content
+    def generate(self, messages:list[dict|ResponseInputParam], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None, max_retries:int = None) -> str:
+        """
+        :param model: The deployment to send the request to (eg. a smaller model for a simple step), defaults to the LLM model.
+        :param response_format: The format of the response, eg. a JSON schema for a structured output (defaults to text).
+        :param max_retries: How many times to retry a request that every member of the pool failed, defaults to the '--llm-max-retries' (0 if the caller retries it).
+        """
+        members = self._members_for(model)
+        tried = []
+        retries = [0]
+        member = self._pick(members, tried)
+        while True:
+            completion_args = self._completion_args(messages, member.deployment, temperature, max_tokens, top_p, response_format)
+            member.rate_limiter.acquire(estimate_tokens(messages, completion_args["max_tokens"]))
+            try:
+                with concurrency_slot(member.concurrency):
+                    raw_response = member.client.chat.completions.with_raw_response.create(**completion_args)
+            except Exception as e:
+                self._release(member, e)
+                member, delay = self._retry(member, e, members, tried, retries, max_retries)
+                if member is None: raise
+                if delay > 0: time.sleep(delay)
+                continue
+            self._release(member)
+            member.rate_limiter.observe_headers(raw_response.headers)
+            response = raw_response.parse()
+            self._record_usage(member, response)
+            return response.choices[0].message.content
+
+    async def generate_async(self, messages:list[dict|ResponseInputParam], model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, response_format:dict = None, max_retries:int = None) -> str:
+        members = self._members_for(model)
+        tried = []
+        retries = [0]
+        member = self._pick(members, tried)
+        while True:
+            if member.async_client is None:
+                member.async_client = AsyncAzureOpenAI(
+                    azure_endpoint=member.endpoint,
+                    azure_deployment=member.deployment,
+                    api_key=member.api_key,
+                    api_version=self._api_version,
+                    max_retries=self._sdk_retries,
+                )
+            completion_args = self._completion_args(messages, member.deployment, temperature, max_tokens, top_p, response_format)
+            try:
+                await member.rate_limiter.acquire_async(estimate_tokens(messages, completion_args["max_tokens"]))
+                async with concurrency_slot_async(member.concurrency):
+                    raw_response = await member.async_client.chat.completions.with_raw_response.create(**completion_args)
+            except BaseException as e:
+                self._release(member, e if isinstance(e, Exception) else None)
+                if not isinstance(e, Exception): raise
+                member, delay = self._retry(member, e, members, tried, retries, max_retries)
+                if member is None: raise
+                if delay > 0: await asyncio.sleep(delay)
+                continue
+            self._release(member)
+            member.rate_limiter.observe_headers(raw_response.headers)
+            response = raw_response.parse()
+            self._record_usage(member, response)
+            return response.choices[0].message.content
+
+    async def close_async(self):
+        with self._pool_lock:
+            members = self._members + [member for members in self._tiers.values() for member in members]
+        for member in members:
+            if member.async_client is not None:
+                await member.async_client.close()
+                member.async_client = None
     
-    def generate_text(self, prompt: str, instruction:str = None, model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None) -> str:
-        if model is None or len(model) == 0:
-            model = self._model
+    def generate_text(self, prompt: str, instruction:str = None, model:str = None, temperature:float = None, max_tokens:int = None, top_p:float = None, max_retries:int = None) -> str:
         if temperature is None or len(temperature) == 0:
             temperature = self._default_temperature
         if max_tokens is None or len(max_tokens) == 0:
@@ -64,12 +350,78 @@ class LLMClient:
         if instruction is None or len(instruction) == 0:
             instruction = self._default_instruction
 
-        response = self._client.responses.create(
-            model=model,
-            instructions=instruction,
-            input=prompt,
-            temperature=temperature,
-            max_output_tokens=max_tokens,
-            top_p=top_p,
-        )
-        return response.output_text
\ No newline at end of file
+        members = self._members_for(model)
+        tried = []
+        retries = [0]
+        member = self._pick(members, tried)
+        while True:
+            member.rate_limiter.acquire(estimate_tokens([{ "content": instruction }, { "content": prompt }], max_tokens))
+            try:
+                response = member.client.responses.create(
+                    model=member.deployment,
+                    instructions=instruction,
+                    input=prompt,
+                    temperature=temperature,
+                    max_output_tokens=max_tokens,
+                    top_p=top_p,
+                )
+            except Exception as e:
+                self._release(member, e)
+                member, delay = self._retry(member, e, members, tried, retries, max_retries)
+                if member is None: raise
+                if delay > 0: time.sleep(delay)
+                continue
+            self._release(member)
+            return response.output_text
+
+
+def parse_pool(pool:str, default_deployment:str, default_api_key:str) -> list[tuple[str, str, float, str]]:
+    """
+    Parse a pool of deployments: a comma separated list of '<endpoint>|<deployment>|<weight>|<api key env var>', where only the endpoint is required.
+    :return: The (endpoint, deployment, weight, api key) of each member of the pool.
+    """
+    import os
+    if pool is None or len(str(pool).strip()) == 0:
+        return []
+    members = []
+    for entry in str(pool).split(","):
+        fields = [field.strip() for field in entry.strip().split("|")]
+        if len(fields[0]) == 0: continue
+        endpoint = fields[0]
+        deployment = fields[1] if len(fields) > 1 and len(fields[1]) > 0 else default_deployment
+        weight = float(fields[2]) if len(fields) > 2 and len(fields[2]) > 0 else 1.0
+        if weight <= 0: raise Exception(f"The weight of LLM pool member '{endpoint}|{deployment}' must be greater than 0")
+        api_key = default_api_key
+        if len(fields) > 3 and len(fields[3]) > 0:
+            api_key = os.environ.get(fields[3], None)
+            if api_key is None: raise Exception(f"The API key of LLM pool member '{endpoint}|{deployment}' is read from the '{fields[3]}' environment variable, which is not set")
+        if api_key is None: raise Exception(f"LLM API key not specified for LLM pool member '{endpoint}|{deployment}'. Provide either the '--llm-api-key' argument, the 'LLM_API_KEY' environment variable, or the name of an environment variable with the key in the pool")
+        members.append((endpoint, deployment, weight, api_key))
+    return members
+
+
+def is_member_failure(error:Exception) -> bool:
+    """
+    Whether a request failed because of the deployment it was sent to (so it's worth retrying on another one): a throttled
+    request, a server error, a timeout or a connection error.
+    """
+    return is_overloaded(error) or "Connection" in type(error).__name__
+
+
+def estimate_tokens(messages:list[dict], max_tokens:int = 0) -> int:
+    """
+    Estimate the tokens a request counts against the tokens per minute quota: the prompt (~4 characters per token,
+    plus a fixed cost per image) and the max tokens of the completion (which the service reserves up front).
+    """
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content", None) if type(message) is dict else None
+        if type(content) is str:
+            chars += len(content)
+        elif type(content) is list:
+            for part in content:
+                if type(part) is not dict: continue
+                if part.get("type", None) == "image_url": images += 1
+                elif type(part.get("text", None)) is str: chars += len(part["text"])
+    return chars // 4 + images * IMAGE_TOKENS + (max_tokens if type(max_tokens) is int else 0)
@@ -1,39 +1,115 @@
+from typing import Callable, TextIO
+
+class MarkdownSplicer:
+    """
+    Applies a set of span replacements to a source string in a single pass, writing the result to a text stream (eg. a file or io.StringIO).
+
+    Replacements are applied in order of their start offset. Where replacements overlap, the one that starts first wins (and for duplicate
+    start offsets, the one that was added first wins), any replacement that starts inside an already applied replacement is dropped.
+    """
+    _source:str = None
+    _replacements:list[tuple[int, int, int, str|Callable[[], str]]] = None
+    _accepted:list[tuple[int, int, int, str|Callable[[], str]]] = None
+    _accepted_starts:list[int] = None
+
+    def __init__(self, source:str):
+        self._source = source if source is not None else ""
+        self._replacements = []
+        self._accepted = None
+        self._accepted_starts = None
+
+    def add(self, start:int, end:int, text:str|Callable[[], str]):
+        """
+        Add a replacement of the source between start and end.
+        :param text: The replacement text, or a callable that returns the text (called when the replacement is written).
+        """
+        if start is None or end is None or start < 0 or end < start or start > len(self._source):
+            return
+        self._replacements.append((start, min(end, len(self._source)), len(self._replacements), text))
+        self._accepted = None
+
+    def _resolve(self):
+        if self._accepted is not None: return
+        self._accepted = []
+        last_start = -1
+        last_end = -1
+        for rep in sorted(self._replacements, key=lambda r: (r[0], r[2])):
+            if rep[0] < last_end or rep[0] == last_start: continue
+            self._accepted.append(rep)
+            last_start = rep[0]
+            last_end = rep[1]
+        self._accepted_starts = [rep[0] for rep in self._accepted]
+
+    def write(self, out:TextIO, start:int = 0, end:int = None) -> int:
+        """
+        Write the source between start and end to the output, with the replacements applied.
+        A replacement that starts within the range but runs past the end is written in full.
+        :return: The offset in the source that the output was written up to (the start of the next range to write).
+        """
+        from bisect import bisect_left
+        self._resolve()
+        if end is None or end > len(self._source): end = len(self._source)
+
+        cursor = start
+        idx = bisect_left(self._accepted_starts, start)
+        while idx < len(self._accepted) and self._accepted[idx][0] < end:
+            rep_start, rep_end, _, text = self._accepted[idx]
+            if rep_start > cursor:
+                out.write(self._source[cursor:rep_start])
+            out.write(text() if callable(text) else text)
+            cursor = max(cursor, rep_end)
+            idx += 1
+
+        if cursor < end:
+            out.write(self._source[cursor:end])
+            cursor = end
+        return cursor
+
+    def build(self) -> str:
+        """
+        Apply all the replacements and return the resulting string.
+        """
+        import io
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+
+def find_headings(markdown:str) -> list[tuple[int, int, str]]:
+    """
+    Find the headings ('#' to '######' lines) of the markdown.
+    :return: The (offset, level, title) of each heading, in order.
+    """
+    import re
+    if markdown is None:
+        return []
+    return [(match.start(), len(match.group(1)), match.group(2).strip()) for match in re.finditer(r"^(#{1,6})[ \t]+(\S.*)$", markdown, re.M)]
+
+
+def heading_paths(headings:list[tuple[int, int, str]]) -> list[list[str]]:
+    """
+    The section path (the titles of the enclosing headings, outermost first) at each heading, eg. ['Title', 'Section', 'Sub-section'].
+    A heading closes any open heading of the same or a deeper level.
+    """
+    paths = []
+    stack = []
+    for _, level, title in headings:
+        while len(stack) > 0 and stack[-1][0] >= level:
+            stack.pop()
+        stack.append((level, title))
+        paths.append([heading_title for _, heading_title in stack])
+    return paths
 
 
 def determine_section_name_at_offset(markdown:str, offset:int) -> str:
-    ## Find the nearest heading before the offset
-    ## Find the nearest heading after the offset
-    ## Return the heading with the smallest distance
-    h1_name = None
-    h2_name = None
-    h3_name = None
-    h4_name = None
-    arr = markdown.split("\n")
-    counter = 0
-    for idx, line in enumerate(arr):
-        if line.startswith("# "):
-            h1_name = line[2:].strip()
-        elif line.startswith("## "):
-            h2_name = line[3:].strip()
-        elif line.startswith("### "):
-            h3_name = line[4:].strip()
-        elif line.startswith("#### "):
-            h4_name = line[5:].strip()
-        counter += len(line)
-        if counter >= offset: break
-
-    section_name = ""
-    if h1_name is not None: section_name = h1_name
-    if h2_name is not None:
-        if len(section_name) == 0: section_name = h2_name
-        else: section_name = f"{section_name} / {h2_name}"
-    if h3_name is not None:
-        if len(section_name) == 0: section_name = h3_name
-        else: section_name = f"{section_name} / {h3_name}"
-    if h4_name is not None:
-        if len(section_name) == 0: section_name = h4_name
-        else: section_name = f"{section_name} / {h4_name}"
-    return section_name
+    ## The path of the headings before the offset, eg. 'Title / Section / Sub-section'
+    ## This scans the whole markdown, for many lookups in the same markdown use a SectionIndex (pdfparser.parse.sections)
+    from bisect import bisect_right
+    headings = find_headings(markdown)
+    idx = bisect_right([heading[0] for heading in headings], offset) - 1
+    if idx < 0:
+        return ""
+    return " / ".join(heading_paths(headings[:idx + 1])[-1])
 
 def find_prior_context(markdown:str, offset:int) -> str:
     # Look back from the offset to find the last 2 paragraphs of text
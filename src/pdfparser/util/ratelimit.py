@@ -0,0 +1,246 @@
+import time
+import random
+import asyncio
+import threading
+
+## How long to pause every caller after a throttled request that didn't say how long to wait
+DEFAULT_THROTTLE_PAUSE = 1.0
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, refilled at a constant rate up to its capacity.
+    Callers reserve tokens up front (the bucket can go into debt), so waiting callers are served in the order they arrived.
+    """
+    rate:float = None           # Tokens added per second
+    capacity:float = None       # The most tokens the bucket can hold (ie. the largest burst)
+    _level:float = None
+    _updated:float = None
+    _lock:threading.Lock = None
+
+    def __init__(self, rate:float, capacity:float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount:float = 1) -> float:
+        """
+        Take tokens from the bucket.
+        :return: How long (in seconds) the caller must wait before the tokens are available.
+        """
+        with self._lock:
+            self._refill()
+            self._level -= amount
+            return 0.0 if self._level >= 0 else -self._level / self.rate
+
+    def clamp(self, available:float):
+        """
+        Lower the tokens in the bucket to (at most) the tokens the service says are available.
+        """
+        with self._lock:
+            self._refill()
+            self._level = min(self._level, available)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimiter:
+    """
+    Limits the requests (and tokens) per minute sent to a service, shared by every client of that service in the process
+    (see `get_rate_limiter`). When the service throttles a request (or reports that the quota is used up), every caller is
+    paused until the service says the quota is available again.
+    """
+    name:str = None
+    requests:TokenBucket = None     # None = no limit on requests
+    tokens:TokenBucket = None       # None = no limit on tokens
+    _paused_until:float = 0.0
+    _lock:threading.Lock = None
+    _stats:dict[str, float] = None
+
+    def __init__(self, name:str, requests_per_minute:float = 0, tokens_per_minute:float = 0):
+        self.name = name
+        self._lock = threading.Lock()
+        self._stats = { "requests": 0, "waits": 0, "wait_seconds": 0.0, "throttled": 0 }
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute:float = 0, tokens_per_minute:float = 0):
+        """
+        Set the requests + tokens per minute (0 = unlimited). The buckets start full, with up to one second of quota as burst.
+        """
+        self.requests = TokenBucket(requests_per_minute / 60.0, max(1.0, requests_per_minute / 60.0)) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, max(1.0, tokens_per_minute / 60.0)) if tokens_per_minute > 0 else None
+
+    def reserve(self, tokens:int = 0) -> float:
+        """
+        Reserve quota for one request.
+        :return: How long (in seconds) the caller must wait before sending the request.
+        """
+        wait = 0.0
+        if self.requests is not None: wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None and tokens > 0: wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            wait = max(wait, self._paused_until - time.monotonic())
+            self._stats["requests"] += 1
+            if wait > 0:
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += wait
+        return max(0.0, wait)
+
+    def acquire(self, tokens:int = 0) -> float:
+        """
+        Wait until there is quota for one request (of the given number of tokens).
+        :return: The time spent waiting.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0: time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens:int = 0) -> float:
+        """
+        The async version of `acquire`.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0: await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds:float):
+        """
+        Hold back every caller for (at least) the given time.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self) -> float:
+        """
+        :return: How long (in seconds) callers are still being held back for, 0 if they aren't.
+        """
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def on_throttled(self, retry_after:float = None):
+        """
+        Called when a request was throttled (a 429), pauses every caller until the service says to retry.
+        """
+        with self._lock:
+            self._stats["throttled"] += 1
+        self.pause(retry_after if retry_after is not None else DEFAULT_THROTTLE_PAUSE)
+
+    def observe_headers(self, headers):
+        """
+        Update the limiter from the rate limit headers of a response (x-ratelimit-remaining-requests/tokens + x-ratelimit-reset-requests/tokens).
+        """
+        if headers is None:
+            return
+        for kind, bucket in [("requests", self.requests), ("tokens", self.tokens)]:
+            remaining = _header_float(headers, f"x-ratelimit-remaining-{kind}")
+            if remaining is None: continue
+            if bucket is not None: bucket.clamp(remaining)
+            if remaining <= 0:
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}", None))
+                self.pause(reset if reset is not None else DEFAULT_THROTTLE_PAUSE)
+
+    def stats(self) -> dict[str, float]:
+        """
+        :return: The number of requests, the number (+ total time) of waits, and the number of throttled requests.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+_limiters:dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name:str, requests_per_minute:float = 0, tokens_per_minute:float = 0) -> RateLimiter:
+    """
+    Get the process-wide rate limiter of a service (eg. 'llm:<endpoint>|<deployment>'), creating it on first use.
+    A non-zero limit replaces the limit the rate limiter was created with.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name, None)
+        if limiter is None:
+            limiter = RateLimiter(name, requests_per_minute, tokens_per_minute)
+            _limiters[name] = limiter
+        elif requests_per_minute > 0 or tokens_per_minute > 0:
+            limiter.configure(requests_per_minute, tokens_per_minute)
+        return limiter
+
+
+def is_throttled(error:Exception) -> bool:
+    """
+    Whether an (OpenAI or Azure SDK) error is a throttled request.
+    """
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after_seconds(error:Exception) -> float:
+    """
+    How long the service asked to wait before retrying, from the Retry-After (or retry-after-ms / x-ratelimit-reset) headers of an error.
+    :return: The time in seconds, or None if the error doesn't say.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) if response is not None else None
+    if headers is None:
+        return None
+    retry_after_ms = _header_float(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000.0
+    retry_after = headers.get("retry-after", None)
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                from email.utils import parsedate_to_datetime
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except Exception:
+                pass
+    resets = [parse_duration(headers.get(f"x-ratelimit-reset-{kind}", None)) for kind in ["requests", "tokens"]]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if len(resets) > 0 else None
+
+
+def retry_delay(error:Exception, attempt:int, base:float = 0.5, max_delay:float = 30.0) -> float:
+    """
+    How long to wait before retrying a failed request: the time the service asked for (if any), otherwise an exponential
+    backoff (from `base`, doubling each attempt, up to `max_delay`) with jitter, so that callers that failed together don't retry together.
+    :param attempt: The (0-based) attempt that failed.
+    """
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    delay = min(max_delay, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_duration(value:str) -> float:
+    """
+    Parse a rate limit reset duration, either a number of seconds (eg. '1.5') or a duration like '6m0s', '1s' or '250ms'.
+    :return: The duration in seconds, or None if it can't be parsed.
+    """
+    import re
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if len(parts) == 0:
+        return None
+    units = { "h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001 }
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def _header_float(headers, name:str) -> float:
+    value = headers.get(name, None)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
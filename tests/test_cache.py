@@ -0,0 +1,144 @@
+import time
+import asyncio
+import threading
+import pytest
+from pdfparser.util.cache import DirectoryCacheBackend, SqliteCacheBackend, create_cache_backend
+from pdfparser.parse.image_cache import ImageDescriptionCache
+
+
+@pytest.fixture(params=["directory", "sqlite"])
+def backend_factory(request, tmp_path):
+    def create(max_bytes:int = 0, max_age:float = 0):
+        if request.param == "directory":
+            return DirectoryCacheBackend(tmp_path / "cache", max_bytes, max_age)
+        return SqliteCacheBackend(tmp_path / "cache.sqlite", max_bytes, max_age)
+    return create
+
+
+def test_put_get_delete(backend_factory):
+    backend = backend_factory()
+    assert backend.get("ns", "missing") is None
+    backend.put("ns", "abc", b"value")
+    backend.put_text("other", "abc", "text")
+    assert backend.get("ns", "abc") == b"value"
+    assert backend.get_text("other", "abc") == "text"
+    assert backend.keys("ns") == ["abc"]
+    backend.delete("ns", "abc")
+    backend.delete("ns", "abc")     ## Deleting a missing entry is fine
+    assert backend.get("ns", "abc") is None
+    assert backend.get_text("other", "abc") == "text"
+
+
+def test_evicts_least_recently_used(backend_factory):
+    backend = backend_factory()
+    backend.put("ns", "aa", b"123456")
+    time.sleep(0.02)
+    backend.put("ns", "bb", b"123456")
+    time.sleep(0.02)
+    backend.put("ns", "cc", b"123456")
+    time.sleep(0.02)
+    backend.get("ns", "aa")         ## Now the most recently used
+
+    backend.max_bytes = 12
+    backend.evict()
+    assert backend.get("ns", "bb") is None
+    assert backend.get("ns", "aa") == b"123456"
+    assert backend.get("ns", "cc") == b"123456"
+
+
+def test_evicts_expired_entries(backend_factory):
+    backend = backend_factory()
+    backend.put("ns", "old", b"x")
+    time.sleep(0.2)
+    backend.put("ns", "new", b"x")
+
+    backend.max_age = 0.1
+    backend.evict()
+    assert backend.get("ns", "old") is None
+    assert backend.get("ns", "new") == b"x"
+
+
+def test_create_cache_backend(tmp_path):
+    assert create_cache_backend({ "cache": "none" }, tmp_path) is None
+    assert isinstance(create_cache_backend({ "cache": "directory" }, tmp_path), DirectoryCacheBackend)
+    assert isinstance(create_cache_backend({ "cache": "sqlite", "cache-dir": str(tmp_path / "db") }, tmp_path), SqliteCacheBackend)
+    with pytest.raises(Exception):
+        create_cache_backend({ "cache": "redis" }, tmp_path)
+
+
+def test_image_cache_computes_each_image_once(tmp_path):
+    cache = ImageDescriptionCache(DirectoryCacheBackend(tmp_path))
+    calls = []
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return "a description"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute(b"image", "variant", compute))) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in results) == [False, True, True, True]
+    assert all(description == "a description" for description, _ in results)
+
+    ## Served from the cache, but not for another variant
+    assert cache.get_or_compute(b"image", "variant", compute) == ("a description", True)
+    assert cache.get_or_compute(b"image", "other", compute) == ("a description", False)
+    assert len(calls) == 2
+
+
+def test_image_cache_async_computes_each_image_once(tmp_path):
+    cache = ImageDescriptionCache(DirectoryCacheBackend(tmp_path))
+    calls = []
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "a description"
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_compute_async(b"image", "variant", compute) for _ in range(4)])
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in results) == [False, True, True, True]
+    assert asyncio.run(cache.get_or_compute_async(b"image", "variant", compute)) == ("a description", True)
+
+
+def test_image_cache_doesnt_cache_failures(tmp_path):
+    cache = ImageDescriptionCache(DirectoryCacheBackend(tmp_path))
+    def fail():
+        raise Exception("boom")
+    with pytest.raises(Exception, match="boom"):
+        cache.get_or_compute(b"image", "variant", fail)
+    assert cache.get_or_compute(b"image", "variant", lambda: "ok") == ("ok", False)
+
+
+def test_image_cache_near_duplicates_need_the_same_variant(tmp_path):
+    backend = DirectoryCacheBackend(tmp_path)
+    cache = ImageDescriptionCache(backend, phash_distance=4)
+    cache.get_or_compute(b"image", "gpt-4o|iterative", lambda: "iterative description", phash=0b1111)
+    cache.get_or_compute(b"image", "gpt-4o|single", lambda: "single description", phash=0b1111)
+
+    ## A near-duplicate (1 bit away) is only a hit for the variant it was described with
+    assert cache.get_or_compute(b"similar", "gpt-4o|single", lambda: "computed", phash=0b1110) == ("single description", True)
+    assert cache.get_or_compute(b"other", "gpt-4o-mini|single", lambda: "computed", phash=0b1110) == ("computed", False)
+    ## Too far away
+    assert cache.get_or_compute(b"far", "gpt-4o|iterative", lambda: "computed", phash=0b11110000) == ("computed", False)
+
+    ## The index is persisted (by variant)
+    reloaded = ImageDescriptionCache(backend, phash_distance=4)
+    assert reloaded.get(reloaded.key(b"new", "gpt-4o|iterative"), 0b0111, "gpt-4o|iterative") == "iterative description"
+
+
+def test_image_cache_near_duplicates_skip_evicted_entries(tmp_path):
+    backend = DirectoryCacheBackend(tmp_path)
+    cache = ImageDescriptionCache(backend, phash_distance=4)
+    cache.put(cache.key(b"nearest", "variant"), "nearest description", "variant", 0b0000)
+    cache.put(cache.key(b"next", "variant"), "next description", "variant", 0b0011)
+    assert cache.get(cache.key(b"new", "variant"), 0b0001, "variant") == "nearest description"
+
+    backend.delete(ImageDescriptionCache.NAMESPACE, cache.key(b"nearest", "variant"))
+    assert cache.get(cache.key(b"new", "variant"), 0b0001, "variant") == "next description"
+    ## The evicted entry is dropped from the index
+    assert len(backend.keys(ImageDescriptionCache.PHASH_NAMESPACE)) == 1
@@ -0,0 +1,91 @@
+import time
+import asyncio
+import threading
+import pytest
+from pdfparser.util.concurrency import AdaptiveConcurrency, is_overloaded
+
+
+class _Error(Exception):
+    status_code:int = None
+
+    def __init__(self, status_code:int):
+        super().__init__(f"Error {status_code}")
+        self.status_code = status_code
+
+
+def test_limit_grows_while_it_is_used():
+    controller = AdaptiveConcurrency("test", initial=2, max_limit=4)
+    assert controller.acquire() is False
+    assert controller.acquire() is True         ## The last slot, ie. the limit is being used
+    controller.release(saturated=False)
+    controller.release(saturated=True)
+    assert controller.limit == pytest.approx(2.5)
+    assert controller.current_limit() == 2
+
+    ## Successes without using the limit don't raise it
+    controller.acquire()
+    controller.release(saturated=False)
+    assert controller.limit == pytest.approx(2.5)
+
+
+def test_limit_is_cut_when_overloaded():
+    controller = AdaptiveConcurrency("test", initial=8, min_limit=2)
+    with pytest.raises(_Error):
+        with controller.slot():
+            raise _Error(429)
+    assert controller.current_limit() == 4
+    ## Only cut once per burst of failures
+    with pytest.raises(_Error):
+        with controller.slot():
+            raise _Error(503)
+    assert controller.current_limit() == 4
+    assert controller.stats()["overloads"] == 2
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_waiters_are_granted_in_order():
+    controller = AdaptiveConcurrency("test", initial=1)
+    controller.acquire()
+    granted = []
+    def wait(idx:int):
+        controller.acquire()
+        granted.append(idx)
+        controller.release()
+    threads = [threading.Thread(target=wait, args=(idx,)) for idx in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    assert granted == []
+    assert controller.stats()["waiting"] == 3
+    controller.release()
+    for thread in threads: thread.join(timeout=5)
+    assert granted == [0, 1, 2]
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_async_waiter_cancelled_gives_up_its_place():
+    controller = AdaptiveConcurrency("test", initial=1)
+
+    async def run():
+        await controller.acquire_async()
+        waiter = asyncio.create_task(controller.acquire_async())
+        await asyncio.sleep(0.01)
+        assert controller.stats()["waiting"] == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.stats()["waiting"] == 0
+        controller.release()
+        async with controller.slot_async():
+            assert controller.stats()["in_flight"] == 1
+
+    asyncio.run(run())
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_is_overloaded():
+    assert is_overloaded(_Error(429))
+    assert is_overloaded(_Error(502))
+    assert not is_overloaded(_Error(400))
+    assert is_overloaded(TimeoutError())
+    assert not is_overloaded(ValueError())
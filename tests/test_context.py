@@ -0,0 +1,60 @@
+from pdfparser.parse.context import ContextBuilder
+from pdfparser.parse.docintel import DocIntelAnalysis
+from pdfparser.parse.sections import SectionIndex
+
+FIGURE = "<figure>A figure</figure>"
+
+
+def _document(before:list[str], after:list[str]) -> tuple[str, SectionIndex]:
+    ## A document of paragraphs around a figure, with a paragraph per text
+    markdown = "# Title\n\n## Section\n\n" + "\n\n".join(before) + "\n\n" + FIGURE + "\n\n" + "\n\n".join(after)
+    paragraphs = [{ "content": text, "spans": [{ "offset": markdown.index(text), "length": len(text) }] } for text in before + after]
+    return markdown, SectionIndex(markdown, DocIntelAnalysis.from_json({ "markdown": markdown, "paragraphs": paragraphs }))
+
+
+def test_whole_paragraphs_nearest_first():
+    before = [f"Paragraph {idx} before the figure." for idx in range(20)]
+    after = [f"Paragraph {idx} after the figure." for idx in range(20)]
+    markdown, sections = _document(before, after)
+    offset = markdown.index(FIGURE)
+
+    context = ContextBuilder({ "context-prior-tokens": "24", "context-post-tokens": "16" }).build(markdown, offset, offset + len(FIGURE), sections)
+    assert context.section_name == "Title / Section"
+    assert context.prior_context.endswith(before[-1])
+    assert context.post_context.startswith(after[0])
+    ## Only whole paragraphs
+    assert context.prior_context.split("\n\n")[0] in before
+    assert context.post_context.split("\n\n")[-1] in after
+    assert 0 < len(context.prior_context.split("\n\n")) < len(before)
+    assert not context.truncated
+    assert context.tokens > 0
+
+
+def test_long_paragraph_is_cut():
+    long_paragraph = " ".join(["word"] * 500)
+    markdown, sections = _document([long_paragraph], ["After."])
+    offset = markdown.index(FIGURE)
+    context = ContextBuilder({ "context-prior-tokens": "32" }).build(markdown, offset, offset + len(FIGURE), sections)
+    assert context.truncated
+    assert 0 < len(context.prior_context) < len(long_paragraph)
+    assert long_paragraph.endswith(context.prior_context)
+    assert context.post_context == "After."
+
+
+def test_zero_budget_leaves_the_part_out():
+    markdown, sections = _document(["Before."], ["After."])
+    offset = markdown.index(FIGURE)
+    context = ContextBuilder({ "context-section-tokens": "0", "context-post-tokens": "0" }).build(markdown, offset, offset + len(FIGURE), sections)
+    assert context.section_name is None
+    assert context.post_context is None
+    assert context.prior_context == "Before."
+
+
+def test_without_a_section_index():
+    markdown = "# Title\n\nSome text before.\n<!-- PageBreak -->\n" + FIGURE + "\n\nSome text after.\n\nThe end."
+    offset = markdown.index(FIGURE)
+    context = ContextBuilder().build(markdown, offset, offset + len(FIGURE))
+    assert context.section_name == "Title"
+    assert "PageBreak" not in context.prior_context
+    assert "Some text before." in context.prior_context
+    assert "Some text after." in context.post_context
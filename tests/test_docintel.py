@@ -0,0 +1,98 @@
+from pdfparser.parse.docintel import DocIntelAnalysis, PAGE_BREAK, format_pages
+
+
+def _analysis(pages:list[str], figure_page:int = None) -> DocIntelAnalysis:
+    ## An analysis of the given page texts, with one paragraph per page (and optionally a figure on one page)
+    markdown = ""
+    page_json = []
+    paragraphs = []
+    figures = []
+    for idx, text in enumerate(pages):
+        if idx > 0: markdown += PAGE_BREAK
+        offset = len(markdown)
+        markdown += text
+        page_json.append({ "page_number": idx + 1, "spans": [{ "offset": offset, "length": len(text) }], "words": [] })
+        paragraphs.append({ "content": text, "bounding_regions": [{ "page_number": idx + 1, "polygon": [0, 0, 1, 0, 1, 1, 0, 1] }], "spans": [{ "offset": offset, "length": len(text) }] })
+        if figure_page == idx + 1:
+            figures.append({ "bounding_regions": [{ "page_number": idx + 1, "polygon": [0, 0, 1, 0, 1, 1, 0, 1] }], "spans": [{ "offset": offset, "length": 4 }], "caption": "A figure" })
+    sections = [{ "spans": [{ "offset": 0, "length": len(markdown) }], "elements": [f"/paragraphs/{idx}" for idx in range(len(pages))] + [f"/figures/{idx}" for idx in range(len(figures))] }]
+    return DocIntelAnalysis.from_json({ "markdown": markdown, "pages": page_json, "paragraphs": paragraphs, "figures": figures, "sections": sections })
+
+
+def test_page_ranges_cover_the_markdown():
+    analysis = _analysis(["first page", "second page", "third page"])
+    ranges = analysis.page_ranges()
+    assert [page_number for page_number, _, _ in ranges] == [1, 2, 3]
+    assert ranges[0][1] == 0
+    assert ranges[-1][2] == len(analysis.markdown)
+    for (_, _, end), (_, start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    assert analysis.markdown[ranges[1][1]:ranges[1][2]].startswith("second page")
+
+
+def test_page_ranges_without_pages():
+    analysis = DocIntelAnalysis.from_json({ "markdown": "just text" })
+    assert analysis.page_ranges() == [(1, 0, len("just text"))]
+
+
+def test_page_ranges_merge_out_of_order_pages():
+    analysis = _analysis(["first page", "second page"])
+    analysis.pages[1].spans[0].offset = 0
+    assert [page_number for page_number, _, _ in analysis.page_ranges()] == [1]
+
+
+def test_merge_shifts_spans_and_renumbers_references():
+    first = _analysis(["first page"])
+    second = _analysis(["second page"], figure_page=1)
+    merged = DocIntelAnalysis.merge([first, second])
+
+    assert merged.markdown == "first page" + PAGE_BREAK + "second page"
+    assert len(merged.paragraphs) == 2
+    shift = len("first page" + PAGE_BREAK)
+    assert merged.paragraphs[1].spans[0].offset == shift
+    assert merged.figures[0].spans[0].offset == shift
+    assert merged.sections[1].elements == ["/paragraphs/1", "/figures/0"]
+    for paragraph in merged.paragraphs:
+        span = paragraph.spans[0]
+        assert merged.markdown[span.offset:span.offset + span.length] == paragraph.content
+
+
+def test_split_pages_rebases_each_page():
+    analysis = _analysis(["first page", "second page", "third page"], figure_page=2)
+    pages = analysis.split_pages([2, 3, 7])
+    assert len(pages) == 2      ## Page 7 isn't in the analysis
+
+    second = pages[0]
+    assert second.markdown == "second page"
+    assert [page.page_number for page in second.pages] == [2]
+    assert len(second.paragraphs) == 1 and second.paragraphs[0].spans[0].offset == 0
+    assert len(second.figures) == 1 and second.figures[0].spans[0].offset == 0
+    assert len(second.sections) == 0        ## The section starts on the first page
+    assert pages[1].markdown == "third page"
+    assert len(pages[1].figures) == 0
+
+    ## Only the references to elements on the page are kept (+ renumbered), the figure is on the second page
+    first = analysis.split_pages([1])[0]
+    assert first.sections[0].elements == ["/paragraphs/0"]
+    assert first.sections[0].spans[0].length == len("first page")
+
+
+def test_split_then_merge_round_trips_the_markdown():
+    analysis = _analysis(["first page", "second page", "third page"])
+    merged = DocIntelAnalysis.merge(analysis.split_pages([1, 2, 3]))
+    assert merged.markdown == analysis.markdown
+    assert [paragraph.spans[0].offset for paragraph in merged.paragraphs] == [paragraph.spans[0].offset for paragraph in analysis.paragraphs]
+
+
+def test_renumber_pages():
+    analysis = _analysis(["first page", "second page"], figure_page=2)
+    renumbered = analysis.renumber_pages([5, 9])
+    assert [page.page_number for page in renumbered.pages] == [5, 9]
+    assert renumbered.figures[0].bounding_regions[0].page_number == 9
+    assert [page.page_number for page in analysis.pages] == [1, 2]       ## A copy, the original is unchanged
+    assert [page.page_number for page in analysis.renumber_pages({ 2: 4 }).pages] == [1, 4]
+
+
+def test_format_pages():
+    assert format_pages([1, 2, 3, 5]) == "1-3,5"
+    assert format_pages([7, 3, 3]) == "3,7"
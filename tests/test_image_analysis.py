@@ -0,0 +1,150 @@
+import json
+import asyncio
+import pytest
+from pdfparser.parse.image_analysis import (extract_json, parse_classifier_output, parse_batch_output, batch_request_ids, build_batch_messages, build_analysis_messages, validate_analysis_output,
+    analyse_image_data, analyse_image_data_async, analyse_image_data_iteratively, analyse_image_data_iteratively_async, analyse_image_batch, analyse_image_batch_async,
+    analyse_image_batch_iteratively, analyse_image_batch_iteratively_async, BatchImage, BATCH_ANALYSIS_INSTRUCTIONS)
+from pdfparser.parse.metrics import ParseMetrics
+from pdfparser.parse.routing import ModelRouting
+
+
+class _FakeLLM:
+    """
+    Answers the classifier step with a bar chart, and the detail step with a description (batch requests leave out the last figure).
+    """
+    model:str = "big"
+    requests:list[list[dict]] = None
+    failures:int = 0
+
+    def __init__(self, failures:int = 0):
+        self.requests = []
+        self.failures = failures
+
+    def _output(self, messages:list[dict]) -> str:
+        self.requests.append(messages)
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception("The request failed")
+        ids = batch_request_ids(messages)
+        if "classify" in messages[0]["content"]:
+            if len(ids) > 0: return json.dumps({ "figures": [{ "id": figure_id, "result": { "category": "chart", "sub_category": "bar" } } for figure_id in ids] })
+            return '{"category": "chart", "sub_category": "bar"}'
+        if len(ids) > 0: return json.dumps({ "figures": [{ "id": figure_id, "result": f"Figure {figure_id} is a chart" } for figure_id in ids[:-1]] })
+        return "A chart"
+
+    def generate(self, messages:list[dict], **kwargs) -> str:
+        return self._output(messages)
+
+    async def generate_async(self, messages:list[dict], **kwargs) -> str:
+        return self._output(messages)
+
+
+def _images(count:int) -> list[BatchImage]:
+    images = []
+    for idx in range(count):
+        image = BatchImage()
+        image.id = str(idx)
+        image.data = b"image"
+        image.img_ext = "png"
+        image.section_name = "A section"
+        image.prior_context = "The text before"
+        images.append(image)
+    return images
+
+
+def _sent_context(messages:list[dict]) -> bool:
+    return any("[START PRIOR CONTEXT]" in part.get("text", "") for part in messages[1]["content"])
+
+
+@pytest.mark.parametrize("output, expected", [
+    ('{"a": 1}', { "a": 1 }),
+    ('```json\n{"a": 1}\n```', { "a": 1 }),
+    ('Here is the result: {"a": {"b": 2}} as requested', { "a": { "b": 2 } }),
+    ('The list [1, 2] and more', [1, 2]),
+    ("No JSON here", None),
+    (None, None),
+])
+def test_extract_json(output, expected):
+    assert extract_json(output) == expected
+
+
+@pytest.mark.parametrize("output, expected", [
+    ('{"category": "chart", "sub_category": "bar"}', ("chart", "bar")),
+    ('{"category": "Chart", "subcategory": "Time Series"}', ("chart", "time-series")),
+    ('{"category": "radiograph", "sub_category": "X_Ray"}', ("radiograph", "x-ray")),
+    ('{"category": "chart", "sub_category": "hologram"}', ("chart", "other")),
+    ('[{"category": "table", "sub_category": "pivot"}]', ("table", "pivot")),
+    (json.dumps('{"category": "formula"}'), ("formula", "other")),
+    ('{"category": "sculpture"}', (None, None)),
+    ("I'm sorry, I can't classify this", (None, None)),
+])
+def test_parse_classifier_output(output, expected):
+    assert parse_classifier_output(output) == expected
+
+
+def test_parse_batch_output():
+    ids = ["1", "2", "3"]
+    output = '```json\n{"figures": [{"id": "Figure 1", "result": "one"}, {"id": "2", "result": {"category": "text"}}, {"id": "9", "result": "unknown"}, {"id": "3"}]}\n```'
+    assert parse_batch_output(output, ids) == { "1": "one", "2": '{"category": "text"}' }
+    assert parse_batch_output('{"figures": {"1": "one"}}', ids) == { "1": "one" }
+    assert parse_batch_output("Not JSON", ids) == {}
+
+
+def test_batch_instructions_have_single_braces():
+    ## The instructions aren't formatted, so doubled braces would be sent as is
+    assert "{{" not in BATCH_ANALYSIS_INSTRUCTIONS and "}}" not in BATCH_ANALYSIS_INSTRUCTIONS
+    messages = build_batch_messages(_images(2))
+    assert '{ "figures": [ { "id": "<figure id>"' in messages[0]["content"]
+    assert batch_request_ids(messages) == ["0", "1"]
+
+
+def test_validate_analysis_output():
+    assert validate_analysis_output("| a | b |\n| --- | --- |\n| 1 | 2 |", "table")
+    assert not validate_analysis_output("| a | b |\n| 1 | 2 |", "table")
+    assert not validate_analysis_output("| a | b |\n| --- | --- |\n| 1 |", "table")
+    assert validate_analysis_output("\\begin{tabular}{ll} a & b \\end{tabular}", "table")
+    assert not validate_analysis_output("$$ x = 1", "formula")
+    assert not validate_analysis_output("I'm sorry, I can't help with that")
+    assert not validate_analysis_output("  ")
+    assert validate_analysis_output("A photo of a cat", "picture")
+
+
+def test_sync_and_async_analysis_match():
+    for analyse, analyse_async in [(analyse_image_data, analyse_image_data_async), (analyse_image_data_iteratively, analyse_image_data_iteratively_async)]:
+        metrics, async_metrics = ParseMetrics(), ParseMetrics()
+        output = analyse(b"image", "png", _FakeLLM(failures=1), metrics=metrics)
+        async_output = asyncio.run(analyse_async(b"image", "png", _FakeLLM(failures=1), metrics=async_metrics))
+        assert output == async_output == "A chart"
+        assert metrics.counters == async_metrics.counters
+        assert metrics.counters["llm_retries"] == 1
+
+
+def test_sync_and_async_batches_match():
+    for analyse, analyse_async in [(analyse_image_batch, analyse_image_batch_async), (analyse_image_batch_iteratively, analyse_image_batch_iteratively_async)]:
+        metrics, async_metrics = ParseMetrics(), ParseMetrics()
+        results = analyse(_images(3), _FakeLLM(), metrics=metrics)
+        async_results = asyncio.run(analyse_async(_images(3), _FakeLLM(), metrics=async_metrics))
+        ## The last figure is missing from the batch response, so is analysed on its own
+        assert results == async_results == { "0": "Figure 0 is a chart", "1": "Figure 1 is a chart", "2": "A chart" }
+        assert metrics.counters == async_metrics.counters
+        assert metrics.counters["llm_batch_fallbacks"] == 1
+
+
+def test_failed_analysis_raises_after_retries():
+    llm = _FakeLLM(failures=5)
+    with pytest.raises(Exception, match="The request failed"):
+        analyse_image_data(b"image", "png", llm, max_retries=2)
+    assert len(llm.requests) == 2
+
+
+def test_detail_context_is_only_sent_when_enabled():
+    llm = _FakeLLM()
+    analyse_image_data_iteratively(b"image", "png", llm, section_name="A section", prior_context="The text before")
+    assert [_sent_context(messages) for messages in llm.requests] == [False, False]
+
+    llm = _FakeLLM()
+    analyse_image_data_iteratively(b"image", "png", llm, section_name="A section", prior_context="The text before", routing=ModelRouting({ "llm-detail-context": "true" }))
+    assert [_sent_context(messages) for messages in llm.requests] == [False, True]
+
+    ## The single step analysis always is
+    assert _sent_context(build_analysis_messages(b"image", "png"))
@@ -0,0 +1,62 @@
+import fitz
+from pdfparser.parse.incremental import RevisionPlan, page_fingerprints, stitch_analysis
+from pdfparser.parse.local_layout import analyse_pdf_layout_data
+
+
+def _pdf_bytes(pages:list[str]) -> bytes:
+    ## A PDF with a line of text on each page
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page(width=300, height=300).insert_text((20, 40), text, fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _pdf(path, pages:list[str]):
+    path.write_bytes(_pdf_bytes(pages))
+    return path
+
+
+def test_plan_matches_pages_by_fingerprint():
+    previous = analyse_pdf_layout_data(_pdf_bytes(["one", "two", "three"]))
+    plan = RevisionPlan(["new", "a", "b", "changed"], previous, ["a", "b", "c"])
+    assert plan.reused == { 2: 1, 3: 2 }
+    assert plan.changed == [1, 4]
+    assert plan.is_incremental()
+
+    assert not RevisionPlan(["a", "b"]).is_incremental()
+    assert RevisionPlan(["a", "b"]).changed == [1, 2]
+    ## Pages missing from the previous analysis aren't reused
+    assert RevisionPlan(["a", "b", "c", "d"], previous, ["a", "b", "c", "d"]).changed == [4]
+
+
+def test_fingerprints_change_with_the_page(tmp_path):
+    first = page_fingerprints(_pdf(tmp_path / "first.pdf", ["Page one text", "Page two text"]))
+    second = page_fingerprints(_pdf(tmp_path / "second.pdf", ["Page zero text", "Page one text", "Page two, revised"]))
+    assert len(first) == 2 and len(second) == 3
+    assert second[1] == first[0]
+    assert second[0] not in first and second[2] not in first
+
+
+def test_stitched_analysis_matches_a_full_analysis(tmp_path):
+    previous_pages = ["Page one text", "Page two text", "Page three text"]
+    revised_pages = ["A new first page", "Page one text", "Page two text", "Page three, revised"]
+    previous_file = _pdf(tmp_path / "previous.pdf", previous_pages)
+    revised_file = _pdf(tmp_path / "revised.pdf", revised_pages)
+    previous = analyse_pdf_layout_data(previous_file.read_bytes())
+    full = analyse_pdf_layout_data(revised_file.read_bytes())
+
+    plan = RevisionPlan(page_fingerprints(revised_file), previous, page_fingerprints(previous_file))
+    assert plan.changed == [1, 4]
+    changed = analyse_pdf_layout_data(revised_file.read_bytes(), plan.changed)
+    stitched = stitch_analysis(plan, changed)
+
+    assert stitched.markdown == full.markdown
+    assert [page.page_number for page in stitched.pages] == [1, 2, 3, 4]
+    assert [paragraph.content for paragraph in stitched.paragraphs] == [paragraph.content for paragraph in full.paragraphs]
+    assert [paragraph.bounding_regions[0].page_number for paragraph in stitched.paragraphs] == [1, 2, 3, 4]
+    for paragraph in stitched.paragraphs:
+        span = paragraph.spans[0]
+        assert stitched.markdown[span.offset:span.offset + span.length] == paragraph.content
+
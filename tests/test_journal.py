@@ -0,0 +1,57 @@
+import pytest
+from pdfparser.util.journal import BatchJournal, load_journal, is_complete, STATE_QUEUED, STATE_ANALYSED, STATE_WRITTEN, STATE_FAILED
+
+
+def test_load_journal_keeps_the_latest_state(tmp_path):
+    first = tmp_path / "first.pdf"
+    second = tmp_path / "second.pdf"
+    first.write_bytes(b"first")
+    second.write_bytes(b"second")
+    journal_file = tmp_path / "run" / "journal.jsonl"
+
+    with BatchJournal(journal_file) as journal:
+        journal.record(first, STATE_QUEUED)
+        journal.record(second, STATE_QUEUED)
+        journal.record(first, STATE_ANALYSED, seconds=1.5)
+        journal.record(second, STATE_FAILED, seconds=2, error="boom")
+        journal.record(first, STATE_WRITTEN, seconds=3)
+
+    states = load_journal(journal_file)
+    assert len(states) == 2
+    assert states[str(first.resolve())]["state"] == STATE_WRITTEN
+    assert states[str(first.resolve())]["seconds"] == 3
+    assert states[str(second.resolve())]["state"] == STATE_FAILED
+    assert states[str(second.resolve())]["error"] == "boom"
+    assert is_complete(states, first)
+    assert not is_complete(states, second)
+
+
+def test_load_journal_skips_partial_lines(tmp_path):
+    file = tmp_path / "doc.pdf"
+    file.write_bytes(b"doc")
+    journal_file = tmp_path / "journal.jsonl"
+    with BatchJournal(journal_file) as journal:
+        journal.record(file, STATE_WRITTEN)
+    with open(journal_file, "a", encoding="utf-8") as f:
+        f.write('{"file": "half a li')
+
+    assert is_complete(load_journal(journal_file), file)
+    assert load_journal(tmp_path / "missing.jsonl") == {}
+
+
+def test_changed_file_isnt_complete(tmp_path):
+    file = tmp_path / "doc.pdf"
+    file.write_bytes(b"doc")
+    journal_file = tmp_path / "journal.jsonl"
+    with BatchJournal(journal_file) as journal:
+        journal.record(file, STATE_WRITTEN)
+    file.write_bytes(b"a new revision of the doc")
+    assert not is_complete(load_journal(journal_file), file)
+
+
+def test_closed_journal_raises(tmp_path):
+    journal = BatchJournal(tmp_path / "journal.jsonl")
+    journal.close()
+    journal.close()
+    with pytest.raises(Exception):
+        journal.record(tmp_path / "doc.pdf", STATE_QUEUED)
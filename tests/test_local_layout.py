@@ -0,0 +1,68 @@
+import fitz
+from pdfparser.parse.local_layout import probe_pages, analyse_pdf_layout, analyse_pdf_layout_data, PAGE_TEXT, PAGE_IMAGE, PAGE_MIXED
+
+BODY = "This is the body text of the page, long enough to count as a text layer."
+
+
+def _image(width:int = 60, height:int = 60) -> fitz.Pixmap:
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    pix.set_rect(pix.irect, (120, 160, 200))
+    return pix
+
+
+def _document() -> bytes:
+    doc = fitz.open()
+    ## A born-digital page: a title, a heading, body text and a figure (with a caption inside it)
+    page = doc.new_page(width=400, height=500)
+    page.insert_text((40, 50), "Annual Report", fontsize=24)
+    page.insert_text((40, 90), "Results", fontsize=15)
+    page.insert_text((40, 120), BODY, fontsize=9)
+    page.insert_text((40, 135), BODY, fontsize=9)
+    page.insert_image(fitz.Rect(40, 200, 240, 350), pixmap=_image())
+    page.insert_text((60, 300), "Chart label", fontsize=9)
+    ## A scanned page: only an image
+    doc.new_page(width=400, height=500).insert_image(fitz.Rect(0, 0, 400, 500), pixmap=_image())
+    ## A page of text over a large image
+    page = doc.new_page(width=400, height=500)
+    page.insert_image(fitz.Rect(0, 0, 400, 400), pixmap=_image())
+    page.insert_text((40, 450), BODY, fontsize=9)
+    ## A blank page
+    doc.new_page(width=400, height=500)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_probe_pages():
+    assert probe_pages(_document()) == [PAGE_TEXT, PAGE_IMAGE, PAGE_MIXED, PAGE_TEXT]
+
+
+def test_layout_of_a_born_digital_page():
+    result = analyse_pdf_layout(_document(), pages=[1])
+    markdown = result["content"]
+    assert markdown.startswith("# Annual Report\n\n## Results\n\n")
+    assert [page["pageNumber"] for page in result["pages"]] == [1]
+    assert [paragraph.get("role", None) for paragraph in result["paragraphs"]][:3] == ["title", "sectionHeading", None]
+
+    ## The text within the figure is part of the figure, not the body
+    assert len(result["figures"]) == 1
+    figure = result["figures"][0]
+    span = figure["spans"][0]
+    figure_markdown = markdown[span["offset"]:span["offset"] + span["length"]]
+    assert figure_markdown.startswith("<figure>") and "Chart label" in figure_markdown
+    assert figure["boundingRegions"][0]["polygon"][:2] == [40 / 72, 200 / 72]
+
+    ## Every span is into the markdown
+    for paragraph in result["paragraphs"]:
+        span = paragraph["spans"][0]
+        assert markdown[span["offset"]:span["offset"] + span["length"]] == paragraph["content"]
+    for word in result["pages"][0]["words"]:
+        assert markdown[word["span"]["offset"]:word["span"]["offset"] + word["span"]["length"]] == word["content"]
+
+
+def test_layout_of_selected_pages():
+    analysis = analyse_pdf_layout_data(_document(), pages=[3, 4])
+    assert [page.page_number for page in analysis.pages] == [3, 4]
+    assert [page_number for page_number, _, _ in analysis.page_ranges()] == [3, 4]
+    assert "<!-- PageBreak -->" in analysis.markdown
+    assert BODY in analysis.markdown
@@ -0,0 +1,59 @@
+import io
+from pdfparser.util.markdown import MarkdownSplicer, find_headings, heading_paths, determine_section_name_at_offset
+
+
+def test_splicer_applies_replacements_in_order():
+    splicer = MarkdownSplicer("aaa BBB ccc DDD eee")
+    splicer.add(12, 15, "ddd")
+    splicer.add(4, 7, lambda: "bbb")
+    assert splicer.build() == "aaa bbb ccc ddd eee"
+
+
+def test_splicer_first_replacement_wins_on_overlap():
+    splicer = MarkdownSplicer("0123456789")
+    splicer.add(2, 6, "X")
+    splicer.add(4, 8, "Y")      ## Starts inside the first replacement, so is dropped
+    splicer.add(2, 3, "Z")      ## Same start as the first replacement, which was added first
+    assert splicer.build() == "01X6789"
+
+
+def test_splicer_ignores_invalid_replacements():
+    splicer = MarkdownSplicer("abc")
+    splicer.add(None, 1, "X")
+    splicer.add(-1, 1, "X")
+    splicer.add(2, 1, "X")
+    splicer.add(4, 5, "X")
+    splicer.add(1, 10, "Y")     ## Clamped to the end of the source
+    assert splicer.build() == "aY"
+
+
+def test_splicer_writes_ranges():
+    splicer = MarkdownSplicer("page one [figure] page two")
+    splicer.add(9, 17, "<fig>")
+    out = io.StringIO()
+    ## The replacement starts in the first range but runs past its end, so it is written in full
+    cursor = splicer.write(out, 0, 12)
+    assert out.getvalue() == "page one <fig>"
+    assert cursor == 17
+    cursor = splicer.write(out, cursor, None)
+    assert out.getvalue() == "page one <fig> page two"
+    assert cursor == len("page one [figure] page two")
+
+
+def test_splicer_callable_is_called_when_written():
+    calls = []
+    splicer = MarkdownSplicer("abc")
+    splicer.add(1, 2, lambda: calls.append(1) or "B")
+    assert len(calls) == 0
+    assert splicer.build() == "aBc"
+    assert len(calls) == 1
+
+
+def test_headings_and_section_names():
+    markdown = "# Title\n\nintro\n\n## Section\n\ntext\n\n### Sub\n\nmore\n\n## Other\n\nend"
+    headings = find_headings(markdown)
+    assert [(level, title) for _, level, title in headings] == [(1, "Title"), (2, "Section"), (3, "Sub"), (2, "Other")]
+    assert heading_paths(headings) == [["Title"], ["Title", "Section"], ["Title", "Section", "Sub"], ["Title", "Other"]]
+    assert determine_section_name_at_offset(markdown, markdown.index("more")) == "Title / Section / Sub"
+    assert determine_section_name_at_offset(markdown, markdown.index("end")) == "Title / Other"
+    assert determine_section_name_at_offset("no headings", 3) == ""
@@ -0,0 +1,124 @@
+import time
+import threading
+import fitz
+import pytest
+from pdfparser.parse.metrics import ParseMetrics
+from pdfparser.parse.pipeline import FigurePipeline, FigureJob
+from pdfparser.parse.render_policy import RenderPolicy
+from pdfparser.parse.triage import FigureTriage, TRIAGE_BLANK
+
+
+class _SlowPolicy(RenderPolicy):
+    ## Renders the figures after the first one slowly, recording when each render finishes
+    events:list[str] = None
+
+    def __init__(self, events:list[str], delay:float = 0.1):
+        super().__init__()
+        self.events = events
+        self.delay = delay
+
+    def render(self, page, clip):
+        figure = super().render(page, clip)
+        if clip[0] > 0: time.sleep(self.delay)
+        self.events.append(f"rendered {int(clip[0])}")
+        return figure
+
+
+@pytest.fixture
+def page():
+    doc = fitz.open()
+    page = doc.new_page(width=400, height=200)
+    for x in range(0, 400, 100):
+        page.draw_rect(fitz.Rect(x + 10, 10, x + 90, 90), color=(0, 0, 0), fill=(0.9, 0.2, 0.2))
+        page.insert_text((x + 20, 120), f"Figure at {x}", fontsize=9)
+    yield page
+    doc.close()
+
+
+def _jobs(page, tmp_path, count:int = 4, policy:RenderPolicy = None, save_image:bool = False) -> list[FigureJob]:
+    jobs = []
+    for idx in range(count):
+        job = FigureJob()
+        job.figure_id = idx
+        job.region_idx = 0
+        job.page_number = 1
+        job.pdf_page = page
+        job.clip = [idx * 100, 0, idx * 100 + 100, 150]
+        job.image_name = f"figure_{idx}.png"
+        job.image_path = tmp_path / job.image_name
+        job.save_image = save_image
+        job.describe = True
+        job.render_policy = policy
+        jobs.append(job)
+    return jobs
+
+
+def test_results_match_their_figures(page, tmp_path):
+    def describe(job:FigureJob) -> str:
+        assert job.image_bytes is not None and job.image_format == "png"
+        time.sleep(0.05 * (4 - job.figure_id))      ## The first figures finish last
+        return f"Figure {job.figure_id}"
+
+    metrics = ParseMetrics()
+    with FigurePipeline(describe, describe_workers=4, metrics=metrics) as pipeline:
+        futures = [pipeline.submit(job) for job in _jobs(page, tmp_path, save_image=True)]
+        results = [future.result(timeout=10) for future in futures]
+    assert [result.description for result in results] == ["Figure 0", "Figure 1", "Figure 2", "Figure 3"]
+    assert all(result.image_path.exists() for result in results)
+    assert metrics.counters["images_rendered"] == 4
+
+
+def test_figure_is_described_as_soon_as_it_is_rendered(page, tmp_path):
+    events = []
+    lock = threading.Lock()
+    def describe(job:FigureJob) -> str:
+        with lock: events.append(f"described {job.figure_id}")
+        return ""
+
+    with FigurePipeline(describe, describe_workers=2) as pipeline:
+        futures = [pipeline.submit(job) for job in _jobs(page, tmp_path, policy=_SlowPolicy(events))]
+        for future in futures: future.result(timeout=10)
+    ## The first figure's description doesn't wait for the other figures to render
+    assert events.index("described 0") < events.index("rendered 300")
+
+
+def test_triaged_and_failed_figures(page, tmp_path):
+    described = []
+    jobs = _jobs(page, tmp_path, count=2)
+    jobs[0].clip = [380, 150, 400, 200]       ## An empty corner of the page
+    jobs[0].triage = FigureTriage({ "triage-min-size": "1" })
+    jobs[1].clip = None
+    jobs[1].render_policy = "not a policy"   ## Rendering fails
+
+    metrics = ParseMetrics()
+    with FigurePipeline(lambda job: described.append(job) or "", metrics=metrics) as pipeline:
+        blank, failed = [pipeline.submit(job).result(timeout=10) for job in jobs]
+    assert described == []
+    assert blank.triage_reason == TRIAGE_BLANK and "not described" in blank.description
+    assert failed.image_path is None and failed.description is None
+    assert metrics.counters["render_errors"] == 1
+
+
+def test_leaving_early_drops_the_queued_figures(page, tmp_path):
+    started = threading.Event()
+    release = threading.Event()
+    described = []
+    def describe(job:FigureJob) -> str:
+        described.append(job.figure_id)
+        started.set()
+        release.wait(timeout=10)
+        return "described"
+
+    futures = []
+    with pytest.raises(RuntimeError):
+        with FigurePipeline(describe, describe_workers=1) as pipeline:
+            futures = [pipeline.submit(job) for job in _jobs(page, tmp_path)]
+            started.wait(timeout=10)
+            time.sleep(0.1)         ## Let the other figures render, and queue for the describe stage
+            threading.Timer(0.2, release.set).start()      ## Once the pipeline is shutting down
+            raise RuntimeError("The consumer failed")
+    ## The figure being described is finished, the queued figures are dropped (+ still resolve, without a description)
+    assert described == [0]
+    results = [future.result(timeout=1) for future in futures]
+    assert results[0].description == "described"
+    assert [result.description for result in results[1:]] == [None, None, None]
@@ -0,0 +1,78 @@
+import pytest
+from pdfparser.util.ratelimit import TokenBucket, RateLimiter, parse_duration, retry_after_seconds, retry_delay, is_throttled
+
+
+class _Response:
+    headers:dict = None
+
+    def __init__(self, headers:dict):
+        self.headers = headers
+
+
+class _Error(Exception):
+    status_code:int = None
+    response:_Response = None
+
+    def __init__(self, status_code:int = 429, headers:dict = None):
+        super().__init__(f"Error {status_code}")
+        self.status_code = status_code
+        self.response = _Response(headers) if headers is not None else None
+
+
+def test_token_bucket_allows_a_burst_then_waits():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+    ## Callers reserve up front, so the next caller waits behind the last
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.02)
+
+
+def test_token_bucket_clamp():
+    bucket = TokenBucket(rate=1, capacity=10)
+    bucket.clamp(0)
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.02)
+
+
+def test_rate_limiter_pause():
+    limiter = RateLimiter("test", requests_per_minute=0)
+    assert limiter.reserve() == 0
+    limiter.on_throttled(0.5)
+    assert 0.4 < limiter.paused_for() <= 0.5
+    assert 0.4 < limiter.reserve() <= 0.5
+    assert limiter.stats()["throttled"] == 1
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("1.5", 1.5),
+    ("6m0s", 360.0),
+    ("1s", 1.0),
+    ("250ms", 0.25),
+    ("1h2m", 3720.0),
+    ("-3", 0.0),
+    ("soon", None),
+    (None, None),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(_Error(headers={ "retry-after-ms": "1500", "retry-after": "9" })) == 1.5
+    assert retry_after_seconds(_Error(headers={ "retry-after": "2" })) == 2.0
+    assert retry_after_seconds(_Error(headers={ "x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "3s" })) == 3.0
+    assert retry_after_seconds(_Error(headers={})) is None
+    assert retry_after_seconds(_Error()) is None
+    assert retry_after_seconds(Exception("no response")) is None
+
+
+def test_retry_delay():
+    assert 2.0 <= retry_delay(_Error(headers={ "retry-after": "2" }), 0) <= 2.5
+    for attempt, delay in [(0, 0.5), (2, 2.0), (10, 30.0)]:
+        assert delay / 2 <= retry_delay(Exception("failed"), attempt) <= delay
+
+
+def test_is_throttled():
+    assert is_throttled(_Error(429))
+    assert not is_throttled(_Error(500))
+    assert not is_throttled(Exception("failed"))
@@ -0,0 +1,63 @@
+import fitz
+import pytest
+from pdfparser.parse.render_policy import RenderPolicy
+
+
+def _page(draw) -> fitz.Page:
+    doc = fitz.open()
+    page = doc.new_page(width=400, height=400)
+    draw(page)
+    return page
+
+
+def _boxes(page):
+    page.draw_rect(fitz.Rect(150, 150, 250, 250), color=None, fill=(0.1, 0.1, 0.1))
+
+
+def test_defaults_render_png_at_max_scale():
+    figure = RenderPolicy().render(_page(_boxes), [100, 100, 300, 300])
+    assert figure.image_format == "png" and figure.image_bytes.startswith(b"\x89PNG")
+    assert figure.scale == 2.0
+    assert (figure.width, figure.height) == (400, 400)
+    assert not figure.trimmed and not figure.grayscale
+
+
+def test_pixel_budget_lowers_the_scale():
+    policy = RenderPolicy({ "render-pixel-budget": "10000" })
+    assert policy.scale(_page(_boxes), [0, 0, 200, 200]) == pytest.approx(0.5)
+    figure = policy.render(_page(_boxes), [0, 0, 200, 200])
+    assert figure.width * figure.height <= 10000
+    assert RenderPolicy({ "render-pixel-budget": "0" }).scale(_page(_boxes), [0, 0, 400, 400]) == 2.0
+
+
+def test_embedded_image_isnt_upscaled():
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 50, 50), False)
+    pix.set_rect(pix.irect, (200, 100, 50))
+    page = _page(lambda page: page.insert_image(fitz.Rect(0, 0, 200, 200), pixmap=pix))
+    assert RenderPolicy().scale(page, [0, 0, 200, 200]) == 1.0
+
+
+def test_trim_and_grayscale_are_opt_in():
+    page = _page(_boxes)
+    assert not RenderPolicy().render(page, [100, 100, 300, 300]).grayscale
+    figure = RenderPolicy({ "render-trim": "true", "render-grayscale": "auto" }).render(page, [100, 100, 300, 300])
+    assert figure.trimmed and figure.grayscale
+    assert figure.width < 400 and figure.height < 400
+    assert figure.pix.n == 1
+
+    coloured = _page(lambda page: page.draw_rect(fitz.Rect(150, 150, 250, 250), color=None, fill=(1, 0, 0)))
+    assert not RenderPolicy({ "render-grayscale": "auto" }).render(coloured, [100, 100, 300, 300]).grayscale
+
+
+def test_jpeg_and_auto_formats():
+    figure = RenderPolicy({ "render-format": "jpg" }).render(_page(_boxes), [100, 100, 300, 300])
+    assert figure.image_format == "jpeg" and figure.image_bytes.startswith(b"\xff\xd8")
+    ## A flat diagram is encoded as PNG
+    assert RenderPolicy({ "render-format": "auto" }).render(_page(_boxes), [100, 100, 300, 300]).image_format == "png"
+
+
+def test_invalid_options():
+    with pytest.raises(Exception):
+        RenderPolicy({ "render-format": "gif" })
+    with pytest.raises(Exception):
+        RenderPolicy({ "render-grayscale": "sometimes" })
@@ -0,0 +1,62 @@
+from pdfparser.parse.docintel import DocIntelAnalysis
+from pdfparser.parse.sections import SectionIndex
+
+MARKDOWN = "# Title\n\nIntro\n\n## Methods\n\nText\n\n### Setup\n\nMore text\n<!-- PageBreak -->\n## Results\n\nNumbers"
+
+
+def test_section_path():
+    sections = SectionIndex(MARKDOWN)
+    assert sections.section_path(0) == ["Title"]
+    assert sections.section_name(MARKDOWN.index("More text")) == "Title / Methods / Setup"
+    assert sections.section_name(MARKDOWN.index("Numbers")) == "Title / Results"
+    assert SectionIndex("Before any heading\n# Title").section_path(0) == []
+
+
+def test_section_start():
+    sections = SectionIndex(MARKDOWN)
+    offset = MARKDOWN.index("More text")
+    assert sections.section_start(offset) == MARKDOWN.index("### Setup")
+    assert sections.section_start(offset, level=2) == MARKDOWN.index("## Methods")
+    assert sections.section_start(offset, level=1) == 0
+    assert SectionIndex("Text\n# Title").section_start(0) is None
+
+
+def test_page_number_from_page_breaks():
+    sections = SectionIndex(MARKDOWN)
+    assert sections.page_number(0) == 1
+    assert sections.page_number(MARKDOWN.index("More text")) == 1
+    assert sections.page_number(MARKDOWN.index("Numbers")) == 2
+    assert not sections.has_paragraphs()
+
+
+def _paragraph(markdown:str, text:str, role:str = None) -> dict:
+    paragraph = { "content": text, "spans": [{ "offset": markdown.index(text), "length": len(text) }] }
+    if role is not None: paragraph["role"] = role
+    return paragraph
+
+
+def test_headings_and_paragraphs_from_the_analysis():
+    markdown = "Report\n\nOverview\n\nThe first paragraph.\n\nPage 1\n\nThe second paragraph."
+    analysis = DocIntelAnalysis.from_json({
+        "markdown": markdown,
+        "paragraphs": [
+            _paragraph(markdown, "Report", "title"),
+            _paragraph(markdown, "Overview", "sectionHeading"),
+            _paragraph(markdown, "The first paragraph."),
+            _paragraph(markdown, "Page 1", "pageNumber"),
+            _paragraph(markdown, "The second paragraph."),
+        ],
+        "sections": [
+            { "elements": ["/paragraphs/0", "/sections/1"] },
+            { "elements": ["/paragraphs/1", "/paragraphs/2", "/paragraphs/4"] },
+        ],
+    })
+    sections = SectionIndex(markdown, analysis)
+    offset = markdown.index("The second paragraph.")
+    assert sections.section_name(offset) == "Report / Overview"
+
+    ## The page number paragraph is left out, as it isn't text of the document
+    before = [markdown[start:end] for start, end in sections.paragraphs_before(offset)]
+    assert before == ["The first paragraph.", "Overview", "Report"]
+    after = [markdown[start:end] for start, end in sections.paragraphs_after(markdown.index("Overview") + len("Overview"))]
+    assert after == ["The first paragraph.", "The second paragraph."]
@@ -0,0 +1,61 @@
+import fitz
+import numpy as np
+from pdfparser.parse.triage import FigureTriage, text_coverage, TRIAGE_FLAT, TRIAGE_BLANK, TRIAGE_TINY, TRIAGE_LOW_INK, TRIAGE_TEXT
+
+CLIP = [0, 0, 300, 300]
+
+
+def _render(draw, gray:bool = False) -> fitz.Pixmap:
+    ## Render a page with the given drawing, as the render stage would (at 2x)
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=300)
+    draw(page)
+    return page.get_pixmap(matrix=fitz.Matrix(2, 2), colorspace=fitz.csGRAY if gray else fitz.csRGB)
+
+
+def _bitonal(pix:fitz.Pixmap) -> fitz.Pixmap:
+    ## Threshold a gray pixmap to black + white, like a 1-bit scan
+    samples = np.frombuffer(pix.samples, dtype=np.uint8)
+    return fitz.Pixmap(fitz.csGRAY, pix.width, pix.height, np.where(samples < 128, 0, 255).astype(np.uint8).tobytes(), False)
+
+
+def _line_drawing(page):
+    for idx in range(8):
+        page.draw_line((20 + idx * 30, 20), (280 - idx * 20, 280), color=(0, 0, 0), width=1)
+    page.draw_rect(fitz.Rect(30, 30, 120, 90), color=(0, 0, 0), width=1)
+    page.insert_text((150, 60), "Valve A", fontsize=10)
+
+
+def test_bitonal_diagram_is_described():
+    assert FigureTriage().classify(_bitonal(_render(_line_drawing, gray=True)), CLIP) is None
+
+
+def test_flat_box_is_triaged():
+    pix = _render(lambda page: page.draw_rect(fitz.Rect(50, 50, 250, 200), color=None, fill=(0.2, 0.4, 0.8)))
+    assert FigureTriage().classify(pix, CLIP) == TRIAGE_FLAT
+
+
+def test_blank_tiny_and_low_ink():
+    triage = FigureTriage()
+    assert triage.classify(_render(lambda page: None), CLIP) == TRIAGE_BLANK
+    assert triage.classify(_render(_line_drawing), [0, 0, 300, 10]) == TRIAGE_TINY
+    dot = _render(lambda page: page.draw_rect(fitz.Rect(150, 150, 151, 151), color=None, fill=(0, 0, 0)))
+    assert triage.classify(dot, CLIP, text_coverage=0) in [TRIAGE_BLANK, TRIAGE_LOW_INK]
+
+
+def test_mostly_text_is_triaged():
+    triage = FigureTriage()
+    pix = _render(_line_drawing)
+    assert triage.classify(pix, CLIP, text_coverage=0.9) == TRIAGE_TEXT
+    assert FigureTriage({ "triage-max-text-coverage": "1" }).classify(pix, CLIP, text_coverage=0.9) is None
+
+
+def test_text_coverage():
+    class _Word:
+        def __init__(self, x0, y0, x1, y1):
+            self.polygon = [x0, y0, x1, y0, x1, y1, x0, y1]
+    polygon = [0, 0, 10, 0, 10, 10, 0, 10]
+    assert text_coverage([_Word(0, 0, 5, 10)], polygon) == 0.5
+    assert text_coverage([_Word(5, 0, 20, 10)], polygon) == 0.5        ## Only the part within the region
+    assert text_coverage([_Word(0, 0, 10, 10), _Word(0, 0, 10, 10)], polygon) == 1.0
+    assert text_coverage(None, polygon) == 0.0